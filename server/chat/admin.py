@@ -1,16 +1,26 @@
 from django.contrib import admin
+from django.urls import reverse
+from django.utils.html import format_html
 from .models import ChatSession, Message, Feedback
-
-
-class MessageInline(admin.TabularInline):
-    model = Message
-    extra = 0
+from .search import get_search_backend
 
 
 @admin.register(ChatSession)
 class ChatSessionAdmin(admin.ModelAdmin):
     list_display = ("id", "created_at", "updated_at")
-    inlines = [MessageInline]
+    readonly_fields = ("message_history",)
+
+    @admin.display(description="Messages")
+    def message_history(self, obj):
+        # The paginated message changelist rather than an inline that loads
+        # every message of the session onto this page
+        url = reverse("admin:chat_message_changelist")
+        return format_html(
+            '<a href="{}?session__id__exact={}">{} messages</a>',
+            url,
+            obj.id,
+            obj.messages.count(),
+        )
 
 
 @admin.register(Message)
@@ -19,6 +29,12 @@ class MessageAdmin(admin.ModelAdmin):
     list_filter = ("role", "created_at")
     search_fields = ("content",)
 
+    def get_search_results(self, request, queryset, search_term):
+        # Full-text index instead of a LIKE scan over every message
+        if not search_term:
+            return queryset, False
+        return get_search_backend().filter_messages(queryset, search_term), False
+
     @admin.display(description="Content")
     def short_content(self, obj):
         return obj.content[:50] + "..." if len(obj.content) > 50 else obj.content
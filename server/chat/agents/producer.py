@@ -1,28 +1,74 @@
+import logging
+
+from django.conf import settings
 from langchain.prompts import PromptTemplate
 
+logger = logging.getLogger(__name__)
+
 
 class ProducerAgent:
-    def __init__(self, llm):
+    classic_template = """
+    <|im_start|>system
+    You are a helpful AI assistant. Below is the content from uploaded documents and our conversation history.
+    DOCUMENTS CONTENT:
+    {documents}
+    CONVERSATION SUMMARY:
+    {summary}
+    CONVERSATION HISTORY:
+    {history}
+    {feedback}
+    {doc_presence}
+    INSTRUCTIONS:
+    1. Provide accurate, detailed responses based on context
+    2. Maintain conversational flow
+    3. Address all aspects of the user's query
+    4. If unsure, ask clarifying questions
+    <|im_end|>
+    <|im_start|>user
+    {question}
+    <|im_end|>
+    <|im_start|>assistant
+    """
+
+    # Everything that stays the same across retries comes first and the
+    # feedback and question last, so Ollama reuses the KV cache it built
+    # for the prefix instead of re-evaluating the documents
+    stable_template = """
+    <|im_start|>system
+    You are a helpful AI assistant. Below is the content from uploaded documents and our conversation history.
+    INSTRUCTIONS:
+    1. Provide accurate, detailed responses based on context
+    2. Maintain conversational flow
+    3. Address all aspects of the user's query
+    4. If unsure, ask clarifying questions
+    {doc_presence}
+    DOCUMENTS CONTENT:
+    {documents}
+    CONVERSATION SUMMARY:
+    {summary}
+    CONVERSATION HISTORY:
+    {history}
+    {feedback}
+    <|im_end|>
+    <|im_start|>user
+    {question}
+    <|im_end|>
+    <|im_start|>assistant
+    """
+
+    templates = {"classic": classic_template, "stable": stable_template}
+    default_layout = "classic"
+
+    def __init__(self, llm, layout=None):
         self.llm = llm
-        self.template = """
-        <|im_start|>system
-        You are a helpful AI assistant. Below is the content from uploaded documents and our conversation history.
-        DOCUMENTS CONTENT:
-        {documents}
-        CONVERSATION HISTORY:
-        {history}
-        {feedback}
-        INSTRUCTIONS:
-        1. Provide accurate, detailed responses based on context
-        2. Maintain conversational flow
-        3. Address all aspects of the user's query
-        4. If unsure, ask clarifying questions
-        <|im_end|>
-        <|im_start|>user
-        {question}
-        <|im_end|>
-        <|im_start|>assistant
-        """
+        self.template = self.template_for(layout)
+
+    @classmethod
+    def template_for(cls, layout=None):
+        """The template of a PROMPT_LAYOUT, the configured one by default"""
+        if layout is None:
+            layout = settings.AGENT_CONFIG.get("PROMPT_LAYOUT", cls.default_layout)
+        return cls.templates[layout]
 
     def _build_prompt(self, context, question, feedback):
         history_text = "\n".join(
@@ -47,14 +93,27 @@ class ProducerAgent:
             input_variables=["documents", "history", "question"], template=self.template
         ).format(
             documents=context["documents"] or "No documents available",
+            summary=context.get("summary") or "No earlier conversation",
             history=history_text,
             question=question,
-            feedback=f"{feedback_section}\n{doc_presence}",
+            feedback=feedback_section,
+            doc_presence=doc_presence,
         )
 
-    async def generate_response(self, context, question, feedback=None):
+    async def generate_response(self, context, question, feedback=None, options=None):
         prompt = self._build_prompt(context, question, feedback)
-        print("producer-prompt", prompt)
-        response = await self.llm.agenerate([prompt])
-        print("producer-response", response)
+        logger.debug("Producer prompt: %s", prompt)
+        if options:
+            response = await self.llm.agenerate([prompt], options=options)
+        else:
+            response = await self.llm.agenerate([prompt])
+        logger.debug("Producer response: %s", response)
         return response.generations[0][0].text.strip()
+
+    async def stream_response(self, context, question, feedback=None):
+        """Yield response chunks as Ollama generates them"""
+        prompt = self._build_prompt(context, question, feedback)
+        logger.debug("Producer prompt: %s", prompt)
+        async for chunk in self.llm.astream(prompt):
+            if chunk:
+                yield chunk
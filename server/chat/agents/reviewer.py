@@ -1,3 +1,15 @@
+import logging
+import re
+
+from ..llm.cache import CachedLLM
+from ..llm.options import ollama_options
+
+# Matches a streamed verdict line such as "3. YES"
+VERDICT_PATTERN = re.compile(r"^\s*([1-5])\.\s*(YES|NO)\b", re.IGNORECASE)
+
+logger = logging.getLogger(__name__)
+
+
 class ReviewerAgent:
     REVIEW_TEMPLATE = """Evaluate this response considering CONTEXT PRESENCE:
     {context_presence}
@@ -17,8 +29,21 @@ class ReviewerAgent:
     4. YES/NO
     5. YES/NO"""
 
-    def __init__(self, llm):
+    ASPECTS = [
+        "relevance",
+        "context_usage",
+        "coherence",
+        "completeness",
+        "instructions",
+    ]
+
+    def __init__(self, llm, early_exit=False, max_tokens=None):
         self.llm = llm
+        # Stream the verdicts and stop once the outcome can no longer change
+        self.early_exit = early_exit
+        self.options = (
+            ollama_options(llm, num_predict=max_tokens) if max_tokens else None
+        )
 
     async def evaluate_response(self, response, context, question):
         # Handle empty document context
@@ -31,18 +56,74 @@ class ReviewerAgent:
         evaluation_prompt = self.REVIEW_TEMPLATE.format(
             question=question, response=response, context_presence=context_presence
         )
-        print("evaluation-prompt", evaluation_prompt)
+        logger.debug("Evaluation prompt: %s", evaluation_prompt)
 
-        raw_eval = await self._get_evaluation(evaluation_prompt)
-        print("evaluation-response", raw_eval)
-        aspects = self._parse_evaluation(raw_eval, context)
-        print("evaluation-aspects", aspects)
+        if self.early_exit:
+            aspects = await self._stream_evaluation(evaluation_prompt, context)
+        else:
+            raw_eval = await self._get_evaluation(evaluation_prompt)
+            logger.debug("Evaluation response: %s", raw_eval)
+            aspects = self._parse_evaluation(raw_eval, context)
+        logger.debug("Evaluation aspects: %s", aspects)
         return self._compile_review(aspects, response, context)
 
     async def _get_evaluation(self, prompt):
-        response = await self.llm.agenerate([prompt])
+        if self.options:
+            response = await self.llm.agenerate([prompt], options=self.options)
+        else:
+            response = await self.llm.agenerate([prompt])
         return response.generations[0][0].text.strip()
 
+    async def _stream_evaluation(self, prompt, context):
+        """Parse verdict lines as they stream and stop once the review is decided"""
+        required_score = self._required_score(context)
+        aspects = {}
+        if not context.get("documents"):
+            aspects["context_usage"] = True  # Auto-approve if no docs
+
+        kwargs = {"options": self.options} if self.options else {}
+        stream = self.llm.astream(prompt, **kwargs)
+        buffer = ""
+        read = []  # Complete lines, up to the one that decided the review
+        decided = False
+        try:
+            async for chunk in stream:
+                buffer += chunk
+                *lines, buffer = buffer.split("\n")
+                for line in lines:
+                    read.append(line)
+                    self._record_verdict(line, aspects)
+                    decided = self._is_decided(aspects, required_score)
+                    if decided:
+                        break
+                if decided:
+                    logger.debug("Evaluation decided early: %s", aspects)
+                    break
+            else:
+                self._record_verdict(buffer, aspects)
+        finally:
+            # Closing the stream aborts the remaining generation
+            await stream.aclose()
+
+        if decided and isinstance(self.llm, CachedLLM):
+            # The cache only stores finished streams; the lines read so far
+            # give the same verdicts when replayed
+            await self.llm.aremember(prompt, "\n".join(read), **kwargs)
+
+        # Verdicts that never arrived count as failures, as in _parse_evaluation
+        return {aspect: aspects.get(aspect, False) for aspect in self.ASPECTS}
+
+    def _record_verdict(self, line, aspects):
+        match = VERDICT_PATTERN.match(line)
+        if match:
+            aspect = self.ASPECTS[int(match.group(1)) - 1]
+            aspects.setdefault(aspect, match.group(2).upper() == "YES")
+
+    def _is_decided(self, aspects, required_score):
+        score = sum(aspects.values())
+        pending = len(self.ASPECTS) - len(aspects)
+        return score >= required_score or score + pending < required_score
+
     def _parse_evaluation(self, raw_response, context):
         """Convert raw LLM response to boolean scores"""
         lines = [
@@ -65,18 +146,22 @@ class ReviewerAgent:
             "instructions": lines[4].startswith("5. YES") if len(lines) > 4 else False,
         }
 
-    def _compile_review(self, aspects, response, context):
+    def _required_score(self, context):
         # Dynamic scoring based on context presence
-        required_score = 3 if context.get("documents") else 2
+        return 3 if context.get("documents") else 2
+
+    def _compile_review(self, aspects, response, context):
+        required_score = self._required_score(context)
         score = sum(aspects.values())
-        print("score", score)
 
         if score >= required_score:
-            return {"status": "approved", "response": response}
+            logger.info("Review approved with score %d", score)
+            return {"status": "approved", "response": response, "score": score}
 
         feedback = self._generate_feedback(aspects, context)
-        print("feedback", feedback)
-        return {"status": "rejected", "feedback": feedback}
+        logger.info("Review rejected with score %d", score)
+        logger.debug("Review feedback: %s", feedback)
+        return {"status": "rejected", "feedback": feedback, "score": score}
 
     def _generate_feedback(self, aspects, context):
         feedback_lines = []
@@ -0,0 +1,28 @@
+class SummarizerAgent:
+    SUMMARY_TEMPLATE = """Update the running summary of a conversation between a user and an AI assistant.
+
+    CURRENT SUMMARY:
+    {summary}
+
+    NEW MESSAGES:
+    {messages}
+
+    Write the updated summary in at most {max_words} words. Keep facts, names,
+    decisions and open questions. Answer with the summary only."""
+
+    def __init__(self, llm, max_words=200):
+        self.llm = llm
+        self.max_words = max_words
+
+    async def summarize(self, summary, messages):
+        """Fold (role, content) pairs into the existing summary"""
+        messages_text = "\n".join(
+            f"{role.capitalize()}: {content}" for role, content in messages
+        )
+        prompt = self.SUMMARY_TEMPLATE.format(
+            summary=summary or "No summary yet",
+            messages=messages_text,
+            max_words=self.max_words,
+        )
+        response = await self.llm.agenerate([prompt])
+        return response.generations[0][0].text.strip()
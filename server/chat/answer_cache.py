@@ -0,0 +1,111 @@
+import threading
+import time
+
+import numpy as np
+from django.conf import settings
+
+from . import metrics
+
+
+class AnswerCache:
+    """Approved answers keyed by question embedding and document set.
+
+    Entries live in a preallocated matrix of normalized question vectors; a
+    lookup is one matrix-vector product over the entries for the same
+    documents fingerprint, and hits at or above THRESHOLD cosine similarity
+    return the stored answer. When full, the least recently used entry is
+    replaced. Each worker keeps its own cache.
+    """
+
+    def __init__(self, max_entries=2048, threshold=0.92, ttl=24 * 3600):
+        self.max_entries = max_entries
+        self.threshold = threshold
+        self.ttl = ttl
+        self._matrix = None  # Allocated on the first store, once the dim is known
+        self._fingerprints = np.empty(max_entries, dtype=object)
+        self._expires_at = np.zeros(max_entries)
+        self._last_used = np.zeros(max_entries)
+        self._answers = [None] * max_entries
+        self._seconds = np.zeros(max_entries)  # What producing the answer took
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.saved_seconds = 0.0
+
+    @classmethod
+    def from_settings(cls):
+        config = settings.ANSWER_CACHE
+        return cls(
+            max_entries=config["MAX_ENTRIES"],
+            threshold=config["THRESHOLD"],
+            ttl=config["TTL"],
+        )
+
+    @staticmethod
+    def _normalize(vector):
+        vector = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def lookup(self, vector, fingerprint):
+        """Return the cached answer closest to the question, or None"""
+        vector = self._normalize(vector)
+        now = time.monotonic()
+        with self._lock:
+            index = None
+            if self._size and vector.shape[0] == self._matrix.shape[1]:
+                live = slice(0, self._size)
+                scores = self._matrix[live] @ vector
+                usable = (self._fingerprints[live] == fingerprint) & (
+                    self._expires_at[live] > now
+                )
+                scores[~usable] = -np.inf
+                best = int(np.argmax(scores))
+                if scores[best] >= self.threshold:
+                    index = best
+
+            if index is None:
+                self.misses += 1
+                metrics.answer_cache_lookups_total.inc(result="miss")
+                return None
+            self._last_used[index] = now
+            self.hits += 1
+            self.saved_seconds += self._seconds[index]
+            metrics.answer_cache_lookups_total.inc(result="hit")
+            metrics.answer_cache_saved_seconds_total.inc(self._seconds[index])
+            return self._answers[index]
+
+    def store(self, vector, fingerprint, answer, seconds=0.0):
+        """Remember an approved answer and how long it took to produce"""
+        vector = self._normalize(vector)
+        now = time.monotonic()
+        with self._lock:
+            if self._matrix is None or self._matrix.shape[1] != vector.shape[0]:
+                # First entry, or the embedder changed: start over
+                self._matrix = np.zeros(
+                    (self.max_entries, vector.shape[0]), dtype=np.float32
+                )
+                self._size = 0
+            if self._size < self.max_entries:
+                index = self._size
+                self._size += 1
+            else:
+                index = int(np.argmin(self._last_used))
+            self._matrix[index] = vector
+            self._fingerprints[index] = fingerprint
+            self._expires_at[index] = now + self.ttl
+            self._last_used[index] = now
+            self._answers[index] = answer
+            self._seconds[index] = seconds
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "saved_seconds": self.saved_seconds,
+                "entries": self._size,
+            }
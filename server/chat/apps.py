@@ -1,5 +1,13 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_migrate
+
 
 class ChatConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
-    name = 'chat'
\ No newline at end of file
+    name = 'chat'
+
+    def ready(self):
+        from .search import install_search_index
+
+        # The full-text index lives outside the models, see chat.search
+        post_migrate.connect(install_search_index, sender=self)
@@ -0,0 +1,109 @@
+import asyncio
+import json
+import random
+import time
+
+from aiohttp import web
+from documents.retrieval import HashingEmbedder
+
+
+class FakeOllama:
+    """Minimal Ollama HTTP API for benchmarks.
+
+    /api/generate streams canned tokens at TOKEN_RATE per second after a
+    first-token LATENCY; reviewer prompts get a verdict that rejects with
+    REJECT_RATE probability. /api/embed returns hashed bag-of-words vectors.
+    """
+
+    REVIEW_PREFIX = "Evaluate this response"
+
+    def __init__(
+        self,
+        token_rate=50.0,
+        latency=0.1,
+        tokens=40,
+        reject_rate=0.0,
+        embedding_dim=768,
+        seed=0,
+    ):
+        self.token_rate = token_rate
+        self.latency = latency
+        self.tokens = tokens
+        self.reject_rate = reject_rate
+        self.embedder = HashingEmbedder(dim=embedding_dim)
+        self.random = random.Random(seed)
+        self.requests = 0
+        self._runner = None
+        self.url = None
+
+    async def start(self, host="127.0.0.1", port=0):
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post("/api/generate", self.generate)
+        app.router.add_post("/api/embed", self.embed)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://{host}:{port}"
+        return self.url
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    def _pieces(self, prompt, num_predict):
+        if prompt.lstrip().startswith(self.REVIEW_PREFIX):
+            verdict = "NO" if self.random.random() < self.reject_rate else "YES"
+            pieces = [f"{number}. {verdict}\n" for number in range(1, 6)]
+        else:
+            pieces = [" word"] * self.tokens
+        if num_predict and num_predict > 0:
+            pieces = pieces[:num_predict]
+        return pieces
+
+    async def generate(self, request):
+        self.requests += 1
+        body = await request.json()
+        prompt = body.get("prompt", "")
+        options = body.get("options") or {}
+        pieces = self._pieces(prompt, options.get("num_predict"))
+
+        response = web.StreamResponse(headers={"Content-Type": "application/x-ndjson"})
+        await response.prepare(request)
+        started = time.perf_counter_ns()
+        try:
+            await asyncio.sleep(self.latency)
+            prompt_done = time.perf_counter_ns()
+            for index, piece in enumerate(pieces):
+                if index:
+                    await asyncio.sleep(1 / self.token_rate)
+                line = {"model": body["model"], "response": piece, "done": False}
+                await response.write(json.dumps(line).encode() + b"\n")
+
+            final = {
+                "model": body["model"],
+                "response": "",
+                "done": True,
+                "done_reason": "stop",
+                "prompt_eval_count": max(len(prompt) // 4, 1),
+                "prompt_eval_duration": prompt_done - started,
+                "eval_count": len(pieces),
+                "eval_duration": time.perf_counter_ns() - prompt_done,
+                "total_duration": time.perf_counter_ns() - started,
+            }
+            await response.write(json.dumps(final).encode() + b"\n")
+            await response.write_eof()
+        except ConnectionResetError:
+            pass  # The client aborted the generation
+        return response
+
+    async def embed(self, request):
+        self.requests += 1
+        body = await request.json()
+        inputs = body.get("input", [])
+        if isinstance(inputs, str):
+            inputs = [inputs]
+        embeddings = [self.embedder.embed_query(text).tolist() for text in inputs]
+        return web.json_response({"model": body["model"], "embeddings": embeddings})
@@ -0,0 +1,183 @@
+import asyncio
+import time
+import uuid
+from collections import defaultdict
+
+from channels.testing import WebsocketCommunicator
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import AsyncClient
+
+from ..consumers import ChatConsumer
+from ..stats import percentile
+
+
+def summarize(timings, wall_seconds):
+    """Return count, p50, p99, mean (seconds) and throughput per stage"""
+    return {
+        stage: {
+            "count": len(values),
+            "p50": percentile(values, 0.5),
+            "p99": percentile(values, 0.99),
+            "mean": sum(values) / len(values),
+            "throughput": len(values) / wall_seconds if wall_seconds else 0.0,
+        }
+        for stage, values in timings.items()
+        if values
+    }
+
+
+def make_pdf(pages):
+    """Build a minimal PDF with one line of Helvetica text per page"""
+    page_count = len(pages)
+    kids = " ".join(f"{4 + 2 * index} 0 R" for index in range(page_count))
+    objects = [
+        "<< /Type /Catalog /Pages 2 0 R >>",
+        f"<< /Type /Pages /Kids [{kids}] /Count {page_count} >>",
+        "<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+    ]
+    for index, text in enumerate(pages):
+        objects.append(
+            "<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] "
+            f"/Resources << /Font << /F1 3 0 R >> >> /Contents {5 + 2 * index} 0 R >>"
+        )
+        stream = f"BT /F1 12 Tf 72 720 Td ({text}) Tj ET"
+        objects.append(f"<< /Length {len(stream)} >>\nstream\n{stream}\nendstream")
+
+    output = b"%PDF-1.4\n"
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(output))
+        output += f"{number} 0 obj\n{body}\nendobj\n".encode()
+    xref = len(output)
+    output += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode()
+    for offset in offsets:
+        output += f"{offset:010d} 00000 n \n".encode()
+    output += (
+        f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\n"
+        f"startxref\n{xref}\n%%EOF\n"
+    ).encode()
+    return output
+
+
+class BenchmarkConsumer(ChatConsumer):
+    """ChatConsumer that records how long each pipeline stage takes"""
+
+    timings = None  # stage -> list of seconds, set by LoadTest
+
+    async def _timed(self, stage, awaitable):
+        started = time.perf_counter()
+        try:
+            return await awaitable
+        finally:
+            self.timings[stage].append(time.perf_counter() - started)
+
+    async def get_context(self, question):
+        return await self._timed("get_context", super().get_context(question))
+
+    async def process_with_llama(self, user_message, context, on_delta=None):
+        return await self._timed(
+            "process_with_llama",
+            super().process_with_llama(user_message, context, on_delta=on_delta),
+        )
+
+    async def save_message(self, role, content):
+        return await self._timed("persistence", super().save_message(role, content))
+
+
+class LoadTest:
+    """Drives concurrent WebSocket sessions through BenchmarkConsumer.
+
+    The first UPLOADS sessions upload a PDF and wait for it to be indexed
+    before chatting. Every session then sends MESSAGES questions in turn.
+    """
+
+    def __init__(self, sessions=50, messages=3, uploads=0, pages=5, timeout=600):
+        self.sessions = sessions
+        self.messages = messages
+        self.uploads = uploads
+        self.pages = pages
+        self.timeout = timeout
+        self.timings = defaultdict(list)
+        self.errors = 0
+
+    async def run(self):
+        BenchmarkConsumer.timings = self.timings
+        started = time.perf_counter()
+        await asyncio.gather(
+            *(self.run_session(index) for index in range(self.sessions))
+        )
+        wall_seconds = time.perf_counter() - started
+        return {
+            "wall_seconds": wall_seconds,
+            "errors": self.errors,
+            "stages": summarize(self.timings, wall_seconds),
+        }
+
+    async def run_session(self, index):
+        session_id = str(uuid.uuid4())
+        communicator = WebsocketCommunicator(
+            BenchmarkConsumer.as_asgi(), f"/ws/chat/?session_id={session_id}"
+        )
+        started = time.perf_counter()
+        connected, _ = await communicator.connect(timeout=self.timeout)
+        if not connected:
+            self.errors += 1
+            return
+        self.timings["connect"].append(time.perf_counter() - started)
+
+        try:
+            if index < self.uploads:
+                await self.upload(communicator, session_id, index)
+            for turn in range(self.messages):
+                started = time.perf_counter()
+                await communicator.send_json_to(
+                    {
+                        "type": "message",
+                        "text": f"Question {turn} from session {index}: "
+                        "what does the quarterly report say about revenue?",
+                    }
+                )
+                frame = await self.receive_until(communicator, {"message", "error"})
+                if frame["type"] == "error":
+                    self.errors += 1
+                else:
+                    self.timings["turn"].append(time.perf_counter() - started)
+        finally:
+            await communicator.disconnect()
+
+    async def upload(self, communicator, session_id, index):
+        pdf = make_pdf(
+            [
+                f"Page {page} of report {index}: revenue grew {page * 3} percent"
+                for page in range(1, self.pages + 1)
+            ]
+        )
+        started = time.perf_counter()
+        response = await AsyncClient().post(
+            "/api/upload/",
+            {
+                "file": SimpleUploadedFile(
+                    f"report-{index}.pdf", pdf, content_type="application/pdf"
+                ),
+                "session_id": session_id,
+            },
+        )
+        if response.status_code != 202:
+            self.errors += 1
+            return
+
+        while True:
+            frame = await self.receive_until(communicator, {"document"})
+            if frame["status"] != "pending":
+                break
+        if frame["status"] == "failed":
+            self.errors += 1
+        else:
+            self.timings["upload"].append(time.perf_counter() - started)
+
+    async def receive_until(self, communicator, types):
+        """Skip deltas, typing and other frames until one of the given types"""
+        while True:
+            frame = await communicator.receive_json_from(timeout=self.timeout)
+            if frame["type"] in types:
+                return frame
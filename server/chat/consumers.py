@@ -1,28 +1,49 @@
+import asyncio
 import json
+import logging
+import time
 import uuid
 
 from channels.db import database_sync_to_async
 from channels.generic.websocket import AsyncWebsocketConsumer
-from documents.models import Document
-from langchain.schema import AIMessage, HumanMessage
-from langchain_ollama import OllamaLLM
+from django.conf import settings
+from documents.retrieval import asearch, invalidate_session_index
 
+from . import metrics
 from .agents.producer import ProducerAgent
-from .agents.reviewer import ReviewerAgent
+from .agents.summarizer import SummarizerAgent
+from .answer_cache import AnswerCache
+from .context import ContextAssembler
+from .llm.client import track_prompt_eval
+from .llm.scheduler import PRIORITY_BACKGROUND, llm_request_context
 from .models import ChatSession, Message
-
-# Initialize Ollama model globally with optimized settings
-llm = OllamaLLM(
-    model="llama3.2",
-    temperature=0.3,
-    num_ctx=4096,  # Increased context window for improved answer accuracy
-    num_thread=4,  # Optimize for multi-threading
-    stop=["</s>", "Human:", "Assistant:"],  # Better conversation control
+from .persistence import message_writer
+from .pipeline import (
+    AnswerPipeline,
+    build_llm,
+    load_context_snapshot,
+    to_history_message,
 )
 
+llm = build_llm()
+
+context_assembler = ContextAssembler()
+
+# Approved answers reused for the same question about the same documents
+answer_cache = AnswerCache.from_settings() if settings.ANSWER_CACHE["ENABLED"] else None
+
+# Background summary updates per session, so only one runs at a time
+summary_tasks = {}
+
+logger = logging.getLogger(__name__)
+
 
 class ChatConsumer(AsyncWebsocketConsumer):
     async def connect(self):
+        with metrics.connect_seconds.time():
+            await self.join_session()
+
+    async def join_session(self):
         try:
             # Parse query string more safely
             query_string = self.scope["query_string"].decode()
@@ -36,13 +57,18 @@ class ChatConsumer(AsyncWebsocketConsumer):
             # Extract clean session_id & Remove any trailing query params
             session_id = query_params.get("session_id", "").split("?")[0]
             self.scope["session_id"] = session_id
-            print(f"Connecting with session ID: {session_id}")
+            logger.debug("Connecting with session ID: %s", session_id)
 
             # Initialize room_group_name before potential errors
             self.room_group_name = None
+            # In-memory history and summary, loaded on the first turn
+            self.context_snapshot = None
+            # Pending and running turns, oldest first
+            self.turns = []
+            self.closed = False
 
             if not session_id:
-                print("No session ID provided")
+                logger.warning("No session ID provided")
                 await self.close()
                 return
 
@@ -52,10 +78,14 @@ class ChatConsumer(AsyncWebsocketConsumer):
             await self.channel_layer.group_add(self.room_group_name, self.channel_name)
 
         except Exception as e:
-            print(f"Connection error: {str(e)}")
+            logger.exception("Connection error: %s", e)
             await self.close()
 
     async def disconnect(self, close_code):
+        # Stop generating answers nobody will read
+        self.closed = True
+        self.cancel_turns()
+
         # Check if room_group_name exists before trying to access it
         if hasattr(self, "room_group_name") and self.room_group_name:
             await self.channel_layer.group_discard(
@@ -72,6 +102,41 @@ class ChatConsumer(AsyncWebsocketConsumer):
         # Send message to WebSocket
         await self.send(text_data=json.dumps({"type": "message", "message": message}))
 
+    async def document_status(self, event):
+        """
+        Handler for document_status events sent by the document pipeline
+        when a document is added, becomes ready or fails to process.
+        """
+        # Another worker may have indexed it, drop this process's copy
+        invalidate_session_index(self.chat_session.id)
+        await self.send(
+            text_data=json.dumps(
+                {
+                    "type": "document",
+                    "document_id": event["document_id"],
+                    "title": event["title"],
+                    "status": event["status"],
+                    "error": event.get("error"),
+                }
+            )
+        )
+
+    async def context_invalidate(self, event):
+        """
+        Handler for context_invalidate events, sent when another connection
+        to the same session saved messages or updated the summary.
+        """
+        if event.get("origin") != self.channel_name:
+            self.context_snapshot = None
+
+    async def turn_cancel(self, event):
+        """
+        Handler for turn_cancel events, sent when a newer message in the same
+        session supersedes the turns still running on other connections.
+        """
+        if event.get("origin") != self.channel_name:
+            self.cancel_turns()
+
     async def receive(self, text_data):
         text_data_json = json.loads(text_data)
         message_type = text_data_json.get("type", "message")
@@ -79,130 +144,282 @@ class ChatConsumer(AsyncWebsocketConsumer):
         if message_type == "message":
             user_message = text_data_json["text"]
 
-            # Only send typing indicator when actually processing a message
-            await self.send(json.dumps({"type": "typing", "isTyping": True}))
-
-            try:
-                # Process message and get response
-                response = await self.process_with_llama(
-                    user_message, await self.get_context()
+            if settings.AGENT_CONFIG.get("SUPERSEDE_PREVIOUS_TURN"):
+                self.cancel_turns()
+                await self.channel_layer.group_send(
+                    self.room_group_name,
+                    {"type": "turn_cancel", "origin": self.channel_name},
                 )
 
-                # Save messages after successful processing
-                await self.save_message("user", user_message)
-                message_data = await self.save_message("assistant", response)
-
-                # Send response and stop typing indicator
-                await self.send(
-                    json.dumps(
-                        {
-                            "type": "message",
-                            "message": message_data["content"],
-                            "message_id": message_data[
-                                "id"
-                            ],  # Include message ID in response
-                        }
-                    )
+            # Turns run as tasks so cancel and disconnect are handled while
+            # Ollama is still generating; they are answered in order
+            previous = self.turns[-1] if self.turns else None
+            turn = asyncio.create_task(self.run_turn(user_message, previous))
+            self.turns.append(turn)
+            turn.add_done_callback(self.turns.remove)
+
+        elif message_type == "cancel":
+            self.cancel_turns()
+
+    def cancel_turns(self):
+        """Abort every queued or running turn along with its Ollama requests"""
+        for turn in self.turns:
+            turn.cancel()
+
+    async def run_turn(self, user_message, previous=None):
+        if previous is not None:
+            await asyncio.wait([previous])
+
+        # Only send typing indicator when actually processing a message
+        await self.send(json.dumps({"type": "typing", "isTyping": True}))
+        started = time.perf_counter()
+        outcome = "error"
+
+        # Forward producer tokens as they arrive when streaming is enabled
+        on_delta = (
+            self.send_delta if settings.AGENT_CONFIG.get("STREAM_RESPONSES") else None
+        )
+
+        try:
+            # Process message and get response
+            with llm_request_context(
+                session=self.room_group_name, on_queued=self.send_queued
+            ), track_prompt_eval() as prompt_eval:
+                # Fit documents and history into the model's context window
+                context = context_assembler.assemble(
+                    await self.get_context(user_message),
+                    user_message,
+                    ProducerAgent.template_for(),
                 )
+                answer = await self.process_with_llama(
+                    context["question"], context, on_delta=on_delta
+                )
+                response = answer.text
+            metrics.turn_prompt_eval_seconds.observe(prompt_eval.seconds)
+            logger.info(
+                "Turn prompt eval: %d tokens in %.2fs over %d calls",
+                prompt_eval.tokens,
+                prompt_eval.seconds,
+                prompt_eval.calls,
+            )
 
-            except Exception as e:
-                await self.send(
-                    json.dumps({"type": "error", "message": f"Error: {str(e)}"})
+            # Save messages after successful processing
+            # Both rows go out in the same batch; the assistant message_id
+            # is only sent once they are committed
+            _, message_data = await asyncio.gather(
+                self.save_message("user", user_message),
+                self.save_message("assistant", response),
+            )
+            await self.remember_turn(user_message, response)
+            self.schedule_summary_update()
+
+            # Send response and stop typing indicator
+            await self.send(
+                json.dumps(
+                    {
+                        "type": "message",
+                        "message": message_data["content"],
+                        "message_id": message_data[
+                            "id"
+                        ],  # Include message ID in response
+                        **self.cached_flag(answer),
+                    }
                 )
-            finally:
-                # Always ensure typing indicator is turned off
+            )
+            outcome = "answered"
+
+        except asyncio.CancelledError:
+            outcome = "cancelled"
+            # Nothing is saved for an abandoned turn
+            if not self.closed:
+                await self.send(json.dumps({"type": "cancelled"}))
+            raise
+        except Exception as e:
+            logger.exception("Error processing message: %s", e)
+            await self.send(
+                json.dumps({"type": "error", "message": f"Error: {str(e)}"})
+            )
+        finally:
+            metrics.turn_seconds.observe(time.perf_counter() - started, outcome=outcome)
+            # Always ensure typing indicator is turned off
+            if not self.closed:
                 await self.send(json.dumps({"type": "typing", "isTyping": False}))
 
+    async def send_delta(self, attempt, text):
+        """Send one incremental chunk of the draft for the given attempt"""
+        await self.send(json.dumps({"type": "delta", "attempt": attempt, "text": text}))
+
+    async def send_queued(self, position):
+        """Tell the client its request is waiting for an LLM slot"""
+        await self.send(json.dumps({"type": "queued", "position": position}))
+
+    async def send_rejected(self, attempt):
+        """Tell the client to discard the streamed draft of a rejected attempt"""
+        await self.send(json.dumps({"type": "rejected", "attempt": attempt}))
+
     @database_sync_to_async
     def get_or_create_chat_session(self):
-        # Add debug prints
         session_id = self.scope.get("session_id", None)
-        print(f"Attempting to get/create session with ID: {session_id}")
-
         session, created = ChatSession.objects.get_or_create(id=session_id)
-        print(f"Session found/created: {session.id}, Created new: {created}")
+        logger.debug("Session %s found/created, created new: %s", session.id, created)
         return session
 
-    @database_sync_to_async
-    def save_message(self, role, content):
+    async def save_message(self, role, content):
         try:
-            message = Message.objects.create(
+            message = Message(
                 id=uuid.uuid4(),  # Explicitly generate UUID
                 session=self.chat_session,
                 role=role,
                 content=content,
             )
+            await message_writer.save(message)
             return {
                 "id": str(message.id),  # Convert UUID to string
                 "content": message.content,
                 "role": message.role,
             }
         except Exception as e:
-            print(f"Error saving message: {str(e)}")
+            logger.error("Error saving message: %s", e)
             raise
 
-    @database_sync_to_async
-    def get_context(self):
-        """Get chat history and document context"""
-        # Debug current session
-        print(f"Current chat session ID: {self.chat_session.id}")
-
-        # Get all documents for this session
-        docs = Document.objects.filter(session=self.chat_session)
-
-        # Verify document count
-        doc_count = docs.count()
-        print(f"Number of documents found: {doc_count}")
-
-        # Rest of the function remains same
-        doc_context = ""
-        for doc in docs:
-            if doc.content:
-                doc_context += f"\nDocument '{doc.title}':\n{doc.content}\n---\n"
-        print("doc_context", doc_context)
-
-        # Get recent chat history
-        messages = Message.objects.filter(session=self.chat_session).order_by(
-            "-created_at"
-        )[:5]
-        print("messages", messages)
-        history = []
-        for msg in reversed(messages):
-            if msg.role == "user":
-                history.append(HumanMessage(content=msg.content))
-            else:
-                history.append(AIMessage(content=msg.content))
-        print("history", history)
-
-        return {"history": history, "documents": doc_context}
-
-    async def process_with_llama(self, user_message, context):
-        producer = ProducerAgent(llm)
-        reviewer = ReviewerAgent(llm)
-        max_retries = 3
-        feedback = None
-        final_response = None
-
-        for attempt in range(max_retries):
-            # Generate response with current context and feedback
-            response = await producer.generate_response(
-                context=context, question=user_message, feedback=feedback
-            )
+    async def get_context(self, question):
+        """Get chat history and the document excerpts relevant to the question"""
+        with metrics.context_seconds.time():
+            return await self.load_context(question)
 
-            # Review the generated response
-            review = await reviewer.evaluate_response(
-                response=response, context=context, question=user_message
+    async def load_context(self, question):
+        # History and summary come from the snapshot; DB work is writes only
+        if self.context_snapshot is None:
+            self.context_snapshot = await database_sync_to_async(load_context_snapshot)(
+                self.chat_session.id
             )
 
-            if review["status"] == "approved":
-                final_response = review["response"]
-                break
+        # Select only the top-k chunks so the prompt size stays fixed
+        chunks, question_vector, fingerprint = await asearch(
+            self.chat_session.id, question
+        )
+        logger.debug(
+            "Retrieved %d document chunks for session %s",
+            len(chunks),
+            self.chat_session.id,
+        )
+        documents = [(title, text) for title, text, score in chunks]
+
+        return {
+            "history": list(self.context_snapshot["history"]),
+            "documents": documents,
+            "summary": self.context_snapshot["summary"],
+            # For the answer cache
+            "question_vector": question_vector,
+            "documents_fingerprint": fingerprint,
+        }
+
+    async def remember_turn(self, user_message, response):
+        """Update the snapshot in place and tell other connections it changed"""
+        if self.context_snapshot is not None:
+            self.context_snapshot["history"].append(
+                to_history_message("user", user_message)
+            )
+            self.context_snapshot["history"].append(
+                to_history_message("assistant", response)
+            )
+            self.context_snapshot["unsummarized"] += 2
+        await self.notify_context_changed()
+
+    async def notify_context_changed(self):
+        await self.channel_layer.group_send(
+            self.room_group_name,
+            {"type": "context_invalidate", "origin": self.channel_name},
+        )
+
+    def schedule_summary_update(self):
+        """Fold messages that left the history window into the session summary"""
+        snapshot = self.context_snapshot
+        if snapshot is None:
+            return  # Invalidated meanwhile, the next turn reloads it
+        outside_window = snapshot["unsummarized"] - snapshot["history"].maxlen
+        if outside_window < settings.AGENT_CONFIG["SUMMARY_BATCH"]:
+            return  # Nothing to fold yet, skip the DB read
+
+        session_id = str(self.chat_session.id)
+        running = summary_tasks.get(session_id)
+        if running and not running.done():
+            return  # The next turn picks up whatever this run misses
+
+        with llm_request_context(
+            session=self.room_group_name, priority=PRIORITY_BACKGROUND, on_queued=None
+        ):
+            task = asyncio.create_task(self.update_summary())
+        summary_tasks[session_id] = task
+        task.add_done_callback(
+            lambda done: (
+                summary_tasks.pop(session_id, None)
+                if summary_tasks.get(session_id) is done
+                else None
+            )
+        )
 
-            feedback = review.get("feedback", "General quality improvement needed")
+    async def update_summary(self):
+        try:
+            summary, pending = await self.get_unsummarized_messages()
+            if len(pending) < settings.AGENT_CONFIG["SUMMARY_BATCH"]:
+                return
 
-        if not final_response:
-            final_response = (
-                "Unable to generate satisfactory response after multiple attempts"
+            summarizer = SummarizerAgent(
+                llm, max_words=settings.AGENT_CONFIG["SUMMARY_MAX_WORDS"]
+            )
+            summary = await summarizer.summarize(
+                summary, [(role, content) for role, content, _ in pending]
             )
+            await self.store_summary(summary, pending[-1][2])
+            if self.context_snapshot is not None:
+                self.context_snapshot["summary"] = summary
+                self.context_snapshot["unsummarized"] -= len(pending)
+            await self.notify_context_changed()
+        except Exception as e:
+            logger.exception("Error updating summary: %s", e)
 
-        return final_response
+    @database_sync_to_async
+    def get_unsummarized_messages(self):
+        """Return the summary and messages older than the history window not yet in it"""
+        session = ChatSession.objects.get(id=self.chat_session.id)
+        messages = Message.objects.filter(session=session)
+        window_start = (
+            messages.order_by("-created_at")
+            .values_list("created_at", flat=True)[
+                settings.AGENT_CONFIG["HISTORY_WINDOW"] - 1 :
+            ]
+            .first()
+        )
+        if window_start is None:
+            return session.summary, []
+
+        pending = messages.filter(created_at__lt=window_start)
+        if session.summarized_until:
+            pending = pending.filter(created_at__gt=session.summarized_until)
+        pending = pending.order_by("created_at").values_list(
+            "role", "content", "created_at"
+        )
+        return session.summary, list(
+            pending[: settings.AGENT_CONFIG["SUMMARY_MAX_BATCH"]]
+        )
+
+    @database_sync_to_async
+    def store_summary(self, summary, summarized_until):
+        ChatSession.objects.filter(id=self.chat_session.id).update(
+            summary=summary, summarized_until=summarized_until
+        )
+
+    async def process_with_llama(self, user_message, context, on_delta=None):
+        return await AnswerPipeline(llm, answer_cache=answer_cache).answer(
+            user_message,
+            context,
+            on_delta=on_delta,
+            on_rejected=self.send_rejected if on_delta else None,
+        )
+
+    @staticmethod
+    def cached_flag(answer):
+        if answer.cached and settings.ANSWER_CACHE["MARK_CACHED"]:
+            return {"cached": True}
+        return {}
@@ -0,0 +1,127 @@
+import logging
+import math
+import threading
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+class TokenEstimator:
+    """Estimates token counts from character length.
+
+    The characters-per-token ratio starts from CONTEXT_BUDGET and is
+    calibrated with the prompt_eval_count Ollama reports for real prompts.
+    Ollama leaves a prefix it already had in its KV cache out of that
+    count, so observations far above the current ratio are ignored.
+    """
+
+    def __init__(self, chars_per_token=3.8, smoothing=0.1, max_deviation=1.5):
+        self.chars_per_token = chars_per_token
+        self.smoothing = smoothing
+        self.max_deviation = max_deviation
+        self._lock = threading.Lock()
+
+    def count(self, text):
+        return math.ceil(len(text) / self.chars_per_token) if text else 0
+
+    def calibrate(self, text, token_count):
+        """Move the ratio towards the one observed for a prompt Ollama evaluated"""
+        if not text or not token_count:
+            return
+        observed = len(text) / token_count
+        if observed > self.chars_per_token * self.max_deviation:
+            return  # Part of the prompt came from the cache
+        with self._lock:
+            self.chars_per_token += self.smoothing * (observed - self.chars_per_token)
+
+
+estimator = TokenEstimator(settings.CONTEXT_BUDGET["CHARS_PER_TOKEN"])
+
+
+def format_document_chunk(title, text):
+    return f"\nDocument '{title}' (excerpt):\n{text}\n---\n"
+
+
+class ContextAssembler:
+    """Fits documents, history and the question into the prompt budget.
+
+    The budget is num_ctx minus the tokens reserved for the answer. The
+    question, the fixed prompt template and the conversation summary are
+    kept first, then the rest is
+    shared between document excerpts and history. The lowest-ranked excerpts
+    and the oldest messages are dropped first, and whatever one side does
+    not use goes to the other.
+    """
+
+    def __init__(self, budget=None, token_estimator=None):
+        self.budget = budget or settings.CONTEXT_BUDGET
+        self.estimator = token_estimator or estimator
+
+    def assemble(self, context, question, template=""):
+        count = self.estimator.count
+        available = (
+            self.budget["NUM_CTX"]
+            - self.budget["RESERVED_OUTPUT"]
+            - self.budget["RESERVED_FEEDBACK"]
+            - count(template)
+            - count(context.get("summary", ""))
+        )
+
+        question_tokens = count(question)
+        if question_tokens > self.budget["QUESTION"]:
+            # Keep the end of an oversized question, where the ask usually is
+            max_chars = int(self.budget["QUESTION"] * self.estimator.chars_per_token)
+            logger.info(
+                "Context budget: question truncated from %d tokens", question_tokens
+            )
+            question = question[-max_chars:]
+            question_tokens = count(question)
+        available = max(available - question_tokens, 0)
+
+        sections = [
+            format_document_chunk(title, text) for title, text in context["documents"]
+        ]
+        history = context["history"]
+        section_tokens = [count(section) for section in sections]
+        message_tokens = [count(message.content) + 2 for message in history]
+
+        document_budget = int(available * self.budget["DOCUMENTS_SHARE"])
+        history_budget = available - document_budget
+        # Hand over whatever one side does not need to the other
+        if sum(section_tokens) < document_budget:
+            history_budget += document_budget - sum(section_tokens)
+        elif sum(message_tokens) < history_budget:
+            document_budget += history_budget - sum(message_tokens)
+
+        # Excerpts arrive best first; keep them in order until the budget is spent
+        kept_sections, used = [], 0
+        for section, tokens in zip(sections, section_tokens):
+            if used + tokens > document_budget:
+                break
+            kept_sections.append(section)
+            used += tokens
+
+        # Keep the most recent messages that fit
+        kept_history, used = [], 0
+        for message, tokens in zip(reversed(history), reversed(message_tokens)):
+            if used + tokens > history_budget:
+                break
+            kept_history.insert(0, message)
+            used += tokens
+
+        dropped_sections = len(sections) - len(kept_sections)
+        dropped_messages = len(history) - len(kept_history)
+        if dropped_sections or dropped_messages:
+            logger.info(
+                "Context budget: dropped %d document excerpts and %d history messages",
+                dropped_sections,
+                dropped_messages,
+            )
+
+        return {
+            **context,
+            "history": kept_history,
+            "documents": "".join(kept_sections),
+            "question": question,
+        }
@@ -0,0 +1,43 @@
+"""ASGI lifespan support for servers that send lifespan events (e.g. uvicorn).
+
+Daphne does not send them, so every shutdown hook registered here must also
+be safe to skip, with an atexit fallback where data could be lost.
+"""
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+startup_hooks = []
+shutdown_hooks = []
+
+
+def on_startup(hook):
+    startup_hooks.append(hook)
+    return hook
+
+
+def on_shutdown(hook):
+    shutdown_hooks.append(hook)
+    return hook
+
+
+async def lifespan_app(scope, receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            try:
+                for hook in startup_hooks:
+                    await hook()
+            except Exception as e:
+                await send({"type": "lifespan.startup.failed", "message": str(e)})
+                return
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            for hook in shutdown_hooks:
+                try:
+                    await hook()
+                except Exception as e:
+                    logger.exception("Shutdown hook failed: %s", e)
+            await send({"type": "lifespan.shutdown.complete"})
+            return
@@ -0,0 +1,267 @@
+import asyncio
+import hashlib
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+from contextlib import aclosing
+
+import diskcache
+import redis
+from django.conf import settings
+from langchain_core.outputs import Generation, LLMResult
+
+from .scheduler import PRIORITY_PRODUCER, PRIORITY_RETRY, current_request_context
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_prompt(prompt):
+    """Strip template indentation and surrounding whitespace from a prompt"""
+    return "\n".join(line.strip() for line in prompt.strip().splitlines())
+
+
+class LLMCache:
+    """Thread-safe LRU of completions with TTL, plus optional tiers shared
+    across workers (Redis) and persisted on disk (diskcache)"""
+
+    REDIS_PREFIX = "llm-cache:"
+
+    def __init__(
+        self,
+        max_entries=1024,
+        ttl=3600,
+        directory=None,
+        size_limit=None,
+        redis_url=None,
+    ):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> (expires_at, text)
+        self._lock = threading.Lock()
+        self._disk = None
+        if directory:
+            self._disk = diskcache.Cache(str(directory), size_limit=size_limit or 2**30)
+        self._redis = redis.Redis.from_url(redis_url) if redis_url else None
+        self.memory_hits = 0
+        self.shared_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    @classmethod
+    def from_settings(cls):
+        config = settings.LLM_CACHE
+        return cls(
+            max_entries=config["MAX_ENTRIES"],
+            ttl=config["TTL"],
+            directory=config.get("DISK_DIRECTORY"),
+            size_limit=config.get("DISK_SIZE_LIMIT"),
+            redis_url=config.get("REDIS_URL"),
+        )
+
+    @staticmethod
+    def make_key(model, temperature, prompt, options=None):
+        payload = json.dumps(
+            [model, temperature, options or {}, normalize_prompt(prompt)],
+            sort_keys=True,
+            default=str,
+        )
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def get(self, key):
+        text = self._get_memory(key)
+        if text is None:
+            text = self._get_remote(key)
+        return text
+
+    def set(self, key, text):
+        self._remember(key, text)
+        self._set_remote(key, text)
+
+    async def aget(self, key):
+        """Like get, but the Redis and disk tiers are read off the event loop"""
+        text = self._get_memory(key)
+        if text is None and (self._redis is not None or self._disk is not None):
+            return await asyncio.to_thread(self._get_remote, key)
+        if text is None:
+            self._count_miss()
+        return text
+
+    async def aset(self, key, text):
+        self._remember(key, text)
+        if self._redis is not None or self._disk is not None:
+            await asyncio.to_thread(self._set_remote, key, text)
+
+    def _get_memory(self, key):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires_at, text = entry
+                if expires_at > now:
+                    self._entries.move_to_end(key)
+                    self.memory_hits += 1
+                    return text
+                del self._entries[key]
+        return None
+
+    def _get_remote(self, key):
+        if self._redis is not None:
+            try:
+                text = self._redis.get(self.REDIS_PREFIX + key)
+            except redis.RedisError as e:
+                logger.warning("LLM cache Redis error: %s", e)
+                text = None
+            if text is not None:
+                text = text.decode()
+                self._remember(key, text)
+                with self._lock:
+                    self.shared_hits += 1
+                return text
+
+        if self._disk is not None:
+            text = self._disk.get(key)
+            if text is not None:
+                self._remember(key, text)
+                with self._lock:
+                    self.disk_hits += 1
+                return text
+
+        self._count_miss()
+        return None
+
+    def _count_miss(self):
+        with self._lock:
+            self.misses += 1
+
+    def _set_remote(self, key, text):
+        if self._redis is not None:
+            try:
+                self._redis.set(self.REDIS_PREFIX + key, text, ex=self.ttl)
+            except redis.RedisError as e:
+                logger.warning("LLM cache Redis error: %s", e)
+        if self._disk is not None:
+            self._disk.set(key, text, expire=self.ttl)
+
+    def _remember(self, key, text):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, text)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            hits = self.memory_hits + self.shared_hits + self.disk_hits
+            lookups = hits + self.misses
+            return {
+                "memory_hits": self.memory_hits,
+                "shared_hits": self.shared_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": hits / lookups if lookups else 0.0,
+                "entries": len(self._entries),
+            }
+
+
+class CachedLLM:
+    """Wraps an Ollama LLM so identical prompts are answered from LLMCache
+
+    Concurrent identical requests share a single in-flight call. Streams are
+    only cached when they run to completion.
+
+    Producer and retry calls bypass the cache unless cache_producer is set:
+    their completions are sampled, and a retry whose prompt repeats the
+    previous attempt would replay the draft that was just rejected.
+    """
+
+    def __init__(self, llm, cache, cache_producer=False):
+        self.llm = llm
+        self.cache = cache
+        self.cache_producer = cache_producer
+        self._inflight = {}
+
+    def __getattr__(self, name):
+        return getattr(self.llm, name)
+
+    def _bypassed(self):
+        priority = current_request_context().priority
+        return not self.cache_producer and priority in (
+            PRIORITY_PRODUCER,
+            PRIORITY_RETRY,
+        )
+
+    def _key(self, prompt, kwargs):
+        options = kwargs.get("options") or {}
+        temperature = options.get("temperature", self.llm.temperature)
+        return self.cache.make_key(self.llm.model, temperature, prompt, options)
+
+    async def agenerate(self, prompts, **kwargs):
+        if self._bypassed():
+            return await self.llm.agenerate(prompts, **kwargs)
+        generations = []
+        for prompt in prompts:
+            generations.append([await self._generate_one(prompt, kwargs)])
+        return LLMResult(generations=generations)
+
+    async def _generate_one(self, prompt, kwargs):
+        key = self._key(prompt, kwargs)
+        while True:
+            text = await self.cache.aget(key)
+            if text is not None:
+                return Generation(text=text, generation_info={"cached": True})
+
+            inflight = self._inflight.get(key)
+            if inflight is None:
+                break
+            try:
+                return Generation(text=await asyncio.shield(inflight))
+            except asyncio.CancelledError:
+                # Retry only when the leading request was cancelled, not us
+                if not inflight.cancelled():
+                    raise
+
+        inflight = asyncio.get_running_loop().create_future()
+        self._inflight[key] = inflight
+        try:
+            result = await self.llm.agenerate([prompt], **kwargs)
+            generation = result.generations[0][0]
+            await self.cache.aset(key, generation.text)
+            inflight.set_result(generation.text)
+            return generation
+        except asyncio.CancelledError:
+            inflight.cancel()
+            raise
+        except Exception as e:
+            inflight.set_exception(e)
+            inflight.exception()  # Mark retrieved when nobody else is waiting
+            raise
+        finally:
+            self._inflight.pop(key, None)
+
+    async def aremember(self, prompt, text, **kwargs):
+        """Cache text as the completion of prompt, e.g. the part of a stream
+        read before its consumer stopped it because it had enough"""
+        if not self._bypassed():
+            await self.cache.aset(self._key(prompt, kwargs), text)
+
+    async def astream(self, prompt, **kwargs):
+        if self._bypassed():
+            async with aclosing(self.llm.astream(prompt, **kwargs)) as stream:
+                async for chunk in stream:
+                    yield chunk
+            return
+
+        key = self._key(prompt, kwargs)
+        text = await self.cache.aget(key)
+        if text is not None:
+            yield text
+            return
+
+        chunks = []
+        async with aclosing(self.llm.astream(prompt, **kwargs)) as stream:
+            async for chunk in stream:
+                chunks.append(chunk)
+                yield chunk
+        await self.cache.aset(key, "".join(chunks))
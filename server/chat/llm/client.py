@@ -0,0 +1,152 @@
+import asyncio
+import contextvars
+import logging
+import threading
+import time
+from concurrent.futures import Future
+from contextlib import contextmanager
+from dataclasses import dataclass
+from itertools import zip_longest
+
+import httpx
+from django.conf import settings
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_ollama import OllamaLLM
+
+from ..context import estimator
+from ..lifespan import on_startup
+from .options import ollama_options
+
+logger = logging.getLogger(__name__)
+
+
+def client_kwargs():
+    """httpx settings shared by every Ollama client: pool size and timeouts"""
+    config = settings.OLLAMA_CLIENT
+    return {
+        "timeout": httpx.Timeout(
+            config["READ_TIMEOUT"], connect=config["CONNECT_TIMEOUT"]
+        ),
+        "limits": httpx.Limits(
+            max_connections=config["MAX_CONNECTIONS"],
+            max_keepalive_connections=config["MAX_KEEPALIVE_CONNECTIONS"],
+            keepalive_expiry=config["KEEPALIVE_EXPIRY"],
+        ),
+    }
+
+
+@dataclass
+class PromptEvalStats:
+    calls: int = 0
+    tokens: int = 0
+    seconds: float = 0.0
+
+
+_prompt_eval_stats = contextvars.ContextVar("prompt_eval_stats", default=None)
+
+
+@contextmanager
+def track_prompt_eval():
+    """Add up the prompt evaluation Ollama reports for LLM calls in this block"""
+    stats = PromptEvalStats()
+    token = _prompt_eval_stats.set(stats)
+    try:
+        yield stats
+    finally:
+        _prompt_eval_stats.reset(token)
+
+
+class PromptEvalReporter(BaseCallbackHandler):
+    """Feeds prompt_eval_count/duration of finished calls into track_prompt_eval
+    and calibrates the context budget's token estimator with them, for
+    generated and streamed calls alike"""
+
+    run_inline = True
+
+    def __init__(self):
+        self._prompts = {}  # run_id -> prompts of calls in progress
+
+    def on_llm_start(self, serialized, prompts, *, run_id, **kwargs):
+        self._prompts[run_id] = prompts
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        self._prompts.pop(run_id, None)
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        prompts = self._prompts.pop(run_id, ())
+        stats = _prompt_eval_stats.get()
+        for prompt, generations in zip_longest(prompts, response.generations):
+            for generation in generations or ():
+                info = generation.generation_info or {}
+                # Both are left out when the whole prompt came from the cache
+                estimator.calibrate(prompt, info.get("prompt_eval_count"))
+                if stats is not None:
+                    stats.calls += 1
+                    stats.tokens += info.get("prompt_eval_count") or 0
+                    stats.seconds += (info.get("prompt_eval_duration") or 0) / 1e9
+
+
+def create_llm(**fields):
+    """Build an OllamaLLM on the configured server, pool and keep_alive"""
+    fields.setdefault("base_url", settings.OLLAMA_BASE_URL)
+    fields.setdefault("keep_alive", settings.OLLAMA_CLIENT["KEEP_ALIVE"])
+    fields.setdefault("callbacks", [PromptEvalReporter()])
+    return OllamaLLM(client_kwargs=client_kwargs(), **fields)
+
+
+_warmup = None
+_warmup_lock = threading.Lock()
+_warmup_llms = []
+
+
+def warm_up(llm):
+    """Load the model into Ollama and run one short prompt through it"""
+    started = time.perf_counter()
+    # Same options as real requests: a different num_ctx makes Ollama
+    # reload the model on the first user message
+    llm.generate(
+        [settings.OLLAMA_CLIENT["WARMUP_PROMPT"]],
+        options=ollama_options(llm, num_predict=1),
+    )
+    logger.info("Warmed up %s in %.2fs", llm.model, time.perf_counter() - started)
+
+
+def _warm_up_all():
+    for llm in _warmup_llms:
+        try:
+            warm_up(llm)
+        except Exception as e:
+            logger.warning("Warmup of %s failed: %s", llm.model, e)
+
+
+def register_warmup(llm):
+    """Preload this model when the server starts"""
+    _warmup_llms.append(llm)
+    return llm
+
+
+def start_warmup():
+    """Start warming registered models in a background thread, once.
+
+    Returns a Future that completes when every model is loaded.
+    """
+    global _warmup
+    with _warmup_lock:
+        if _warmup is None:
+            _warmup = Future()
+            if settings.OLLAMA_CLIENT["WARMUP"]:
+
+                def run():
+                    _warm_up_all()
+                    _warmup.set_result(None)
+
+                threading.Thread(target=run, name="ollama-warmup", daemon=True).start()
+            else:
+                _warmup.set_result(None)
+        return _warmup
+
+
+@on_startup
+async def wait_for_warmup():
+    # Under a lifespan-aware server, traffic starts after the model is loaded
+    await asyncio.wrap_future(start_warmup())
@@ -0,0 +1,25 @@
+# Sampling options OllamaLLM sends with every request. Passing `options`
+# to agenerate/astream replaces all of them, so overrides start from these.
+OPTION_FIELDS = (
+    "mirostat",
+    "mirostat_eta",
+    "mirostat_tau",
+    "num_ctx",
+    "num_gpu",
+    "num_thread",
+    "num_predict",
+    "repeat_last_n",
+    "repeat_penalty",
+    "temperature",
+    "stop",
+    "tfs_z",
+    "top_k",
+    "top_p",
+)
+
+
+def ollama_options(llm, **overrides):
+    """Return the LLM's default Ollama options with the given overrides"""
+    options = {field: getattr(llm, field) for field in OPTION_FIELDS}
+    options.update(overrides)
+    return options
@@ -0,0 +1,284 @@
+import asyncio
+import contextvars
+import random
+import time
+import uuid
+from collections import OrderedDict, deque
+from contextlib import aclosing, asynccontextmanager, contextmanager
+from dataclasses import dataclass, replace
+
+import redis.asyncio as redis
+from django.conf import settings
+
+from .. import metrics
+
+# Lower values are served first
+PRIORITY_PRODUCER = 0
+PRIORITY_REVIEWER = 1
+PRIORITY_RETRY = 2
+PRIORITY_BACKGROUND = 3
+
+
+@dataclass(frozen=True)
+class RequestContext:
+    session: str = None
+    priority: int = PRIORITY_PRODUCER
+    on_queued: object = None  # async callable receiving the queue position
+
+
+_request_context = contextvars.ContextVar(
+    "llm_request_context", default=RequestContext()
+)
+
+
+@contextmanager
+def llm_request_context(**changes):
+    """Set the session, priority or queued callback for LLM calls in this block"""
+    token = _request_context.set(replace(_request_context.get(), **changes))
+    try:
+        yield
+    finally:
+        _request_context.reset(token)
+
+
+def current_request_context():
+    """The session and priority LLM calls are currently made for"""
+    return _request_context.get()
+
+
+class SchedulerFull(Exception):
+    pass
+
+
+class RedisSlotLimiter:
+    """Cluster-wide cap on concurrent Ollama requests shared by all workers.
+
+    Slots are leases in a Redis sorted set scored by expiry time, so a
+    crashed worker's slots free themselves after LEASE_TTL. Held leases are
+    renewed while a long generation is still running.
+    """
+
+    ACQUIRE_SCRIPT = """
+    local now = redis.call('TIME')
+    local now_ms = now[1] * 1000 + math.floor(now[2] / 1000)
+    redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now_ms)
+    if redis.call('ZCARD', KEYS[1]) < tonumber(ARGV[1]) then
+        redis.call('ZADD', KEYS[1], now_ms + tonumber(ARGV[2]), ARGV[3])
+        return 1
+    end
+    return 0
+    """
+
+    RENEW_SCRIPT = """
+    local now = redis.call('TIME')
+    local now_ms = now[1] * 1000 + math.floor(now[2] / 1000)
+    return redis.call('ZADD', KEYS[1], 'XX', now_ms + tonumber(ARGV[1]), ARGV[2])
+    """
+
+    def __init__(
+        self, url, limit, lease_ttl=120, poll_interval=0.05, key="llm-scheduler:slots"
+    ):
+        self.limit = limit
+        self.lease_ttl_ms = int(lease_ttl * 1000)
+        self.poll_interval = poll_interval
+        self.key = key
+        self._redis = redis.Redis.from_url(url)
+
+    async def acquire(self):
+        token = uuid.uuid4().hex
+        while True:
+            acquired = await self._redis.eval(
+                self.ACQUIRE_SCRIPT, 1, self.key, self.limit, self.lease_ttl_ms, token
+            )
+            if acquired:
+                return token
+            # Jitter keeps workers from polling in lockstep
+            await asyncio.sleep(self.poll_interval * (0.5 + random.random()))
+
+    async def release(self, token):
+        await self._redis.zrem(self.key, token)
+
+    async def _keep_alive(self, token):
+        while True:
+            await asyncio.sleep(self.lease_ttl_ms / 3000)
+            await self._redis.eval(
+                self.RENEW_SCRIPT, 1, self.key, self.lease_ttl_ms, token
+            )
+
+    @asynccontextmanager
+    async def slot(self):
+        token = await self.acquire()
+        renewal = asyncio.create_task(self._keep_alive(token))
+        try:
+            yield
+        finally:
+            renewal.cancel()
+            await asyncio.shield(self.release(token))
+
+
+class LLMScheduler:
+    """Caps concurrent Ollama requests with priority classes and per-session
+    round-robin, so one busy session cannot starve the others"""
+
+    def __init__(
+        self,
+        max_concurrency=2,
+        max_queue_depth=64,
+        max_session_queue_depth=4,
+        global_limiter=None,
+    ):
+        self.max_concurrency = max_concurrency
+        # Optional RedisSlotLimiter shared with the other workers
+        self.global_limiter = global_limiter
+        self.max_queue_depth = max_queue_depth
+        self.max_session_queue_depth = max_session_queue_depth
+        self.active = 0
+        # priority -> OrderedDict(session -> deque of waiter futures)
+        self._queues = {}
+
+    @classmethod
+    def from_settings(cls):
+        config = settings.LLM_SCHEDULER
+        global_limiter = None
+        if config.get("REDIS_URL"):
+            global_limiter = RedisSlotLimiter(
+                config["REDIS_URL"],
+                config["GLOBAL_MAX_CONCURRENCY"],
+                lease_ttl=config["LEASE_TTL"],
+            )
+        return cls(
+            max_concurrency=config["MAX_CONCURRENCY"],
+            max_queue_depth=config["MAX_QUEUE_DEPTH"],
+            max_session_queue_depth=config["MAX_SESSION_QUEUE_DEPTH"],
+            global_limiter=global_limiter,
+        )
+
+    @property
+    def queue_depth(self):
+        return sum(
+            len(waiters)
+            for sessions in self._queues.values()
+            for waiters in sessions.values()
+        )
+
+    def _session_depth(self, session):
+        return sum(len(sessions.get(session, ())) for sessions in self._queues.values())
+
+    def _position(self, priority, session, waiter):
+        """Estimate how many requests will be served before this one, plus one"""
+        ahead = sum(
+            len(waiters)
+            for other_priority, sessions in self._queues.items()
+            if other_priority < priority
+            for waiters in sessions.values()
+        )
+        sessions = self._queues[priority]
+        rank = sessions[session].index(waiter)
+        before_us = True
+        for other_session, waiters in sessions.items():
+            if other_session == session:
+                before_us = False
+                continue
+            ahead += min(len(waiters), rank + 1 if before_us else rank)
+        return ahead + rank + 1
+
+    async def acquire(self, session=None, priority=PRIORITY_PRODUCER, on_queued=None):
+        if self.active < self.max_concurrency and not self.queue_depth:
+            self.active += 1
+            return
+
+        if self.queue_depth >= self.max_queue_depth:
+            raise SchedulerFull("The assistant is busy, please try again shortly")
+        if self._session_depth(session) >= self.max_session_queue_depth:
+            raise SchedulerFull("Too many pending requests for this session")
+
+        waiter = asyncio.get_running_loop().create_future()
+        sessions = self._queues.setdefault(priority, OrderedDict())
+        sessions.setdefault(session, deque()).append(waiter)
+
+        try:
+            if on_queued:
+                await on_queued(self._position(priority, session, waiter))
+            await waiter
+        except BaseException:
+            if waiter.done() and not waiter.cancelled():
+                # The slot was handed to us before we stopped waiting
+                self.release()
+            else:
+                waiter.cancel()
+                self._discard(priority, session, waiter)
+            raise
+
+    def _discard(self, priority, session, waiter):
+        sessions = self._queues.get(priority, {})
+        waiters = sessions.get(session)
+        if waiters and waiter in waiters:
+            waiters.remove(waiter)
+            if not waiters:
+                del sessions[session]
+
+    def _next_waiter(self):
+        for priority in sorted(self._queues):
+            sessions = self._queues[priority]
+            while sessions:
+                session, waiters = next(iter(sessions.items()))
+                waiter = waiters.popleft()
+                if waiters:
+                    # Round-robin: the session goes to the back of its class
+                    sessions.move_to_end(session)
+                else:
+                    del sessions[session]
+                if not waiter.done():
+                    return waiter
+        return None
+
+    def release(self):
+        waiter = self._next_waiter()
+        if waiter is not None:
+            waiter.set_result(None)  # Hand the slot over directly
+        else:
+            self.active -= 1
+
+    @asynccontextmanager
+    async def slot(self, session=None, priority=PRIORITY_PRODUCER, on_queued=None):
+        started = time.perf_counter()
+        await self.acquire(session, priority, on_queued)
+        try:
+            if self.global_limiter is None:
+                metrics.queue_wait_seconds.observe(
+                    time.perf_counter() - started, priority=priority
+                )
+                yield
+            else:
+                async with self.global_limiter.slot():
+                    metrics.queue_wait_seconds.observe(
+                        time.perf_counter() - started, priority=priority
+                    )
+                    yield
+        finally:
+            self.release()
+
+
+class ScheduledLLM:
+    """Wraps an Ollama LLM so every call waits for an LLMScheduler slot"""
+
+    def __init__(self, llm, scheduler):
+        self.llm = llm
+        self.scheduler = scheduler
+
+    def __getattr__(self, name):
+        return getattr(self.llm, name)
+
+    def _slot(self):
+        context = _request_context.get()
+        return self.scheduler.slot(context.session, context.priority, context.on_queued)
+
+    async def agenerate(self, prompts, **kwargs):
+        async with self._slot():
+            return await self.llm.agenerate(prompts, **kwargs)
+
+    async def astream(self, prompt, **kwargs):
+        # aclosing: a consumer that stops early also ends the Ollama request
+        async with self._slot(), aclosing(self.llm.astream(prompt, **kwargs)) as stream:
+            async for chunk in stream:
+                yield chunk
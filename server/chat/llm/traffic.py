@@ -0,0 +1,250 @@
+"""Record Ollama traffic to a compressed log and replay it without Ollama.
+
+The log is JSON lines compressed with zstandard, one frame per batch of
+records, so it can be appended to across restarts and read back as a
+single stream.
+"""
+
+import asyncio
+import atexit
+import io
+import json
+import logging
+import threading
+import time
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import aclosing
+from pathlib import Path
+
+import zstandard
+from django.conf import settings
+from langchain_core.outputs import Generation, LLMResult
+
+from .cache import LLMCache
+from .scheduler import current_request_context
+
+logger = logging.getLogger(__name__)
+
+
+class TrafficLog:
+    """Append-only zstd-compressed JSONL log of LLM calls"""
+
+    def __init__(self, path, level=10, flush_every=32):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.flush_every = flush_every
+        self._compressor = zstandard.ZstdCompressor(level=level)
+        self._pending = []
+        self._lock = threading.Lock()
+        # Compression and file writes stay off the event loop
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="traffic")
+        # Records still buffered are written when the server shuts down
+        atexit.register(self.flush)
+
+    @classmethod
+    def from_settings(cls):
+        config = settings.LLM_TRAFFIC
+        return cls(
+            config["LOG_PATH"],
+            level=config["COMPRESSION_LEVEL"],
+            flush_every=config["FLUSH_EVERY"],
+        )
+
+    def append(self, record):
+        line = json.dumps(record, ensure_ascii=False, default=str)
+        with self._lock:
+            self._pending.append(line)
+            full = len(self._pending) >= self.flush_every
+        if full:
+            self._writer.submit(self.flush)
+
+    def flush(self):
+        """Compress the buffered records into one frame at the end of the log"""
+        with self._lock:
+            if not self._pending:
+                return
+            data = "\n".join(self._pending).encode() + b"\n"
+            self._pending = []
+            with open(self.path, "ab") as log_file:
+                log_file.write(self._compressor.compress(data))
+
+
+def read_traffic(path):
+    """Yield the records of a traffic log in the order they were written"""
+    with open(path, "rb") as log_file:
+        reader = zstandard.ZstdDecompressor().stream_reader(
+            log_file, read_across_frames=True
+        )
+        for line in io.TextIOWrapper(reader, encoding="utf-8"):
+            if line.strip():
+                yield json.loads(line)
+
+
+def _params(llm, kwargs):
+    options = kwargs.get("options") or {}
+    return {
+        "model": llm.model,
+        "temperature": options.get("temperature", llm.temperature),
+        "options": options,
+    }
+
+
+def _key(prompt, params):
+    return LLMCache.make_key(
+        params["model"], params["temperature"], prompt, params["options"]
+    )
+
+
+class RecordingLLM:
+    """Wraps an Ollama LLM and logs every prompt, its options, the completion
+    and how long Ollama took, for ReplayLLM and offline comparisons"""
+
+    def __init__(self, llm, log):
+        self.llm = llm
+        self.log = log
+
+    def __getattr__(self, name):
+        return getattr(self.llm, name)
+
+    def _record(self, kind, prompt, kwargs, started, started_at):
+        context = current_request_context()
+        return {
+            "kind": kind,
+            "session": context.session,
+            "priority": context.priority,
+            "params": _params(self.llm, kwargs),
+            "prompt": prompt,
+            "started_at": started_at,
+            "duration": time.perf_counter() - started,
+        }
+
+    async def agenerate(self, prompts, **kwargs):
+        started_at = time.time()
+        started = time.perf_counter()
+        result = await self.llm.agenerate(prompts, **kwargs)
+        for prompt, generations in zip(prompts, result.generations):
+            record = self._record("generate", prompt, kwargs, started, started_at)
+            record["completion"] = generations[0].text
+            record["info"] = generations[0].generation_info
+            self.log.append(record)
+        return result
+
+    async def astream(self, prompt, **kwargs):
+        started_at = time.time()
+        started = time.perf_counter()
+        chunks = []
+        offsets = []  # Seconds from the request to each chunk
+        complete = False
+        try:
+            async with aclosing(self.llm.astream(prompt, **kwargs)) as stream:
+                async for chunk in stream:
+                    offsets.append(time.perf_counter() - started)
+                    chunks.append(chunk)
+                    yield chunk
+            complete = True
+        finally:
+            # Streams closed early (reviewer verdict decided, turn cancelled)
+            # are kept too, as far as they got
+            record = self._record("stream", prompt, kwargs, started, started_at)
+            record["completion"] = "".join(chunks)
+            record["chunk_sizes"] = [len(chunk) for chunk in chunks]
+            record["offsets"] = [round(offset, 4) for offset in offsets]
+            record["complete"] = complete
+            self.log.append(record)
+
+
+class ReplayMiss(LookupError):
+    pass
+
+
+class ReplayLLM:
+    """Serves completions from a traffic log instead of calling Ollama.
+
+    A prompt is matched on the same key as LLMCache (model, temperature,
+    options, normalized prompt); repeated prompts get their recordings in
+    order. Unless strict, an unseen prompt gets the next unused recording
+    of the same priority, so conversations still run after prompt changes.
+    Latencies are the recorded ones times LATENCY_SCALE (0: full speed).
+    """
+
+    def __init__(self, llm, records, latency_scale=1.0, strict=False):
+        self.llm = llm  # Only for its model and option fields
+        self.latency_scale = latency_scale
+        self.strict = strict
+        self._by_key = defaultdict(deque)
+        self._by_priority = defaultdict(deque)
+        self._served = set()
+        for record in records:
+            self._by_key[_key(record["prompt"], record["params"])].append(record)
+            self._by_priority[record["priority"]].append(record)
+        self.hits = 0
+        self.fallbacks = 0
+
+    @classmethod
+    def from_settings(cls, llm):
+        config = settings.LLM_TRAFFIC
+        records = list(read_traffic(config["LOG_PATH"]))
+        logger.info("Replaying %d LLM calls from %s", len(records), config["LOG_PATH"])
+        return cls(
+            llm,
+            records,
+            latency_scale=config["LATENCY_SCALE"],
+            strict=config["STRICT"],
+        )
+
+    def __getattr__(self, name):
+        return getattr(self.llm, name)
+
+    def _next(self, queue):
+        while queue:
+            record = queue.popleft()
+            if id(record) not in self._served:
+                self._served.add(id(record))
+                return record
+        return None
+
+    def _lookup(self, prompt, kwargs):
+        record = self._next(self._by_key[_key(prompt, _params(self.llm, kwargs))])
+        if record is not None:
+            self.hits += 1
+            return record
+        if not self.strict:
+            priority = current_request_context().priority
+            record = self._next(self._by_priority[priority])
+            if record is not None:
+                self.fallbacks += 1
+                return record
+        raise ReplayMiss(f"No recorded completion for prompt: {prompt[:80]!r}")
+
+    async def _sleep(self, seconds):
+        if self.latency_scale and seconds > 0:
+            await asyncio.sleep(seconds * self.latency_scale)
+
+    async def agenerate(self, prompts, **kwargs):
+        generations = []
+        for prompt in prompts:
+            record = self._lookup(prompt, kwargs)
+            await self._sleep(record["duration"])
+            generations.append(
+                [
+                    Generation(
+                        text=record["completion"],
+                        generation_info=record.get("info"),
+                    )
+                ]
+            )
+        return LLMResult(generations=generations)
+
+    async def astream(self, prompt, **kwargs):
+        record = self._lookup(prompt, kwargs)
+        text = record["completion"]
+        sizes = record.get("chunk_sizes") or [len(text)]
+        offsets = record.get("offsets") or [record["duration"]]
+        elapsed = 0.0
+        position = 0
+        for size, offset in zip(sizes, offsets):
+            await self._sleep(offset - elapsed)
+            elapsed = offset
+            yield text[position : position + size]
+            position += size
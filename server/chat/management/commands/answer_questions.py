@@ -0,0 +1,161 @@
+import asyncio
+import json
+import sys
+import time
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from documents.models import Document
+from documents.retrieval import SessionIndex, aretrieve
+
+from chat.context import ContextAssembler
+from chat.llm.client import track_prompt_eval
+from chat.llm.scheduler import llm_request_context
+from chat.pipeline import AnswerPipeline, build_llm, load_context_snapshot
+from chat.stats import percentile
+
+
+class Command(BaseCommand):
+    help = (
+        "Answer a JSONL file of questions with the producer/reviewer pipeline. "
+        'Each line is {"question": ..., "session": <id>} or '
+        '{"question": ..., "documents": [<id>, ...]}, with an optional "id". '
+        "Writes one JSONL result per question, in completion order."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("input", help="JSONL file of questions")
+        parser.add_argument("--output", "-o", help="Result JSONL file, default stdout")
+        parser.add_argument(
+            "--concurrency",
+            type=int,
+            default=settings.LLM_SCHEDULER["MAX_CONCURRENCY"],
+            help="Questions answered at the same time",
+        )
+        parser.add_argument("--limit", type=int, help="Stop after this many questions")
+        parser.add_argument(
+            "--use-cache",
+            action="store_true",
+            help="Answer repeated prompts from the shared LLM cache, which may "
+            "hold completions from earlier runs and live traffic",
+        )
+
+    def handle(self, *args, **options):
+        try:
+            source = open(options["input"])
+        except OSError as e:
+            raise CommandError(f"Cannot read {options['input']}: {e}")
+        output = open(options["output"], "w") if options["output"] else sys.stdout
+
+        self.llm = build_llm(cache=options["use_cache"])
+        self.pipeline = AnswerPipeline(self.llm)
+        self.context_assembler = ContextAssembler()
+        self.document_indexes = {}  # frozenset of document ids -> SessionIndex
+        try:
+            with source:
+                results = asyncio.run(self.run(source, output, options))
+        finally:
+            if output is not sys.stdout:
+                output.close()
+        self.report(results)
+
+    async def run(self, source, output, options):
+        questions = enumerate(source)
+        limit = options["limit"]
+        results = []
+
+        async def worker():
+            # Workers share one iterator so the file is read as it is answered
+            for index, line in questions:
+                if limit is not None and index >= limit:
+                    return
+                if not line.strip():
+                    continue
+                result = await self.answer_line(index, line)
+                results.append(result)
+                output.write(json.dumps(result) + "\n")
+                output.flush()
+
+        await asyncio.gather(*(worker() for _ in range(options["concurrency"])))
+        return results
+
+    async def answer_line(self, index, line):
+        started = time.perf_counter()
+        result = {"index": index}
+        try:
+            item = json.loads(line)
+            question = item["question"]
+            result.update(
+                id=item.get("id"),
+                session=item.get("session"),
+                documents=item.get("documents"),
+                question=question,
+            )
+            # Each question is its own session for the scheduler's fairness
+            with llm_request_context(session=f"batch_{index}", on_queued=None):
+                raw_context = await self.load_context(item, question)
+                context = self.context_assembler.assemble(
+                    raw_context, question, self.pipeline.producer.template
+                )
+                context_seconds = time.perf_counter() - started
+                with track_prompt_eval() as prompt_eval:
+                    answer = await self.pipeline.answer(context["question"], context)
+            result.update(
+                answer=answer.text,
+                approved=answer.approved,
+                attempts=answer.attempts,
+                scores=answer.scores,
+                prompt_eval_tokens=prompt_eval.tokens,
+                latency={
+                    "context": context_seconds,
+                    "answer": time.perf_counter() - started - context_seconds,
+                    "total": time.perf_counter() - started,
+                },
+            )
+        except Exception as e:
+            result["error"] = f"{type(e).__name__}: {e}"
+        return result
+
+    async def load_context(self, item, question):
+        """History and summary of the session, plus the top document chunks
+        of the session or of the listed documents"""
+        context = {"history": [], "documents": [], "summary": ""}
+        session_id = item.get("session")
+        if session_id:
+            snapshot = await database_sync_to_async(load_context_snapshot)(session_id)
+            context["history"] = list(snapshot["history"])
+            context["summary"] = snapshot["summary"]
+            chunks = await aretrieve(session_id, question)
+        elif item.get("documents"):
+            index = await self.document_index(item["documents"])
+            chunks = await aretrieve(None, question, index=index)
+        else:
+            chunks = []
+        context["documents"] = [(title, text) for title, text, score in chunks]
+        return context
+
+    async def document_index(self, document_ids):
+        key = frozenset(document_ids)
+        index = self.document_indexes.get(key)
+        if index is None:
+            index = await database_sync_to_async(SessionIndex.from_documents)(
+                Document.objects.filter(id__in=key)
+            )
+            self.document_indexes[key] = index
+        return index
+
+    def report(self, results):
+        answered = [result for result in results if "error" not in result]
+        errors = len(results) - len(answered)
+        if not answered:
+            self.stderr.write(f"0 answered, {errors} errors")
+            return
+        approved = sum(result["approved"] for result in answered)
+        attempts = sum(result["attempts"] for result in answered)
+        totals = [result["latency"]["total"] for result in answered]
+        self.stderr.write(
+            f"{len(answered)} answered, {approved} approved, {errors} errors, "
+            f"{attempts / len(answered):.2f} attempts on average, "
+            f"p50 {percentile(totals, 0.5):.2f}s, p99 {percentile(totals, 0.99):.2f}s"
+        )
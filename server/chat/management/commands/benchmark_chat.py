@@ -0,0 +1,173 @@
+import asyncio
+import json
+import os
+import shutil
+import tempfile
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import override_settings
+
+from chat import consumers
+from chat.benchmark.fake_ollama import FakeOllama
+from chat.benchmark.load import LoadTest
+
+
+class Command(BaseCommand):
+    help = (
+        "Load-test the WebSocket chat pipeline against a fake Ollama server "
+        "and report p50/p99 latency and throughput per stage"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sessions", type=int, default=50)
+        parser.add_argument("--messages", type=int, default=3, help="Per session")
+        parser.add_argument(
+            "--uploads", type=int, default=0, help="Sessions that upload a PDF first"
+        )
+        parser.add_argument("--pages", type=int, default=5, help="Pages per PDF")
+        parser.add_argument(
+            "--token-rate", type=float, default=50.0, help="Fake tokens per second"
+        )
+        parser.add_argument(
+            "--latency", type=float, default=0.1, help="Fake time to first token"
+        )
+        parser.add_argument("--tokens", type=int, default=40, help="Tokens per answer")
+        parser.add_argument(
+            "--reject-rate",
+            type=float,
+            default=0.0,
+            help="Fraction of reviews that reject, to exercise retries",
+        )
+        parser.add_argument(
+            "--max-concurrency",
+            type=int,
+            default=settings.LLM_SCHEDULER["MAX_CONCURRENCY"],
+            help="Scheduler slots, i.e. the parallelism of the fake Ollama",
+        )
+        parser.add_argument("--timeout", type=float, default=600.0)
+        parser.add_argument("--output", help="Write the results as JSON")
+        parser.add_argument(
+            "--baseline", help="Fail if p99 regressed against this JSON result"
+        )
+        parser.add_argument("--max-regression", type=float, default=0.25)
+
+    def handle(self, *args, **options):
+        workdir = tempfile.mkdtemp(prefix="chat-benchmark-")
+        # A throwaway database; a file so the pipeline threads can share it
+        if connection.vendor == "sqlite":
+            connection.settings_dict["TEST"]["NAME"] = os.path.join(
+                workdir, "benchmark.sqlite3"
+            )
+        old_name = connection.creation.create_test_db(
+            verbosity=0, autoclobber=True, serialize=False
+        )
+        try:
+            # Not async_to_sync: that would run the upload view's sync code on
+            # this thread, nested inside the benchmark's own blocking call
+            results = asyncio.run(self.run_benchmark(workdir, options))
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            shutil.rmtree(workdir, ignore_errors=True)
+
+        self.report(results)
+        if options["output"]:
+            with open(options["output"], "w") as output:
+                json.dump(results, output, indent=2)
+        if options["baseline"]:
+            self.compare(results, options["baseline"], options["max_regression"])
+
+    async def run_benchmark(self, workdir, options):
+        fake = FakeOllama(
+            token_rate=options["token_rate"],
+            latency=options["latency"],
+            tokens=options["tokens"],
+            reject_rate=options["reject_rate"],
+        )
+        url = await fake.start()
+        overrides = override_settings(
+            OLLAMA_BASE_URL=url,
+            MEDIA_ROOT=os.path.join(workdir, "media"),
+            LLM_CACHE={**settings.LLM_CACHE, "ENABLED": False},
+            LLM_SCHEDULER={
+                **settings.LLM_SCHEDULER,
+                "MAX_CONCURRENCY": options["max_concurrency"],
+                "MAX_QUEUE_DEPTH": options["sessions"] * 4,
+                "REDIS_URL": None,
+            },
+            RETRIEVAL_CONFIG={
+                **settings.RETRIEVAL_CONFIG,
+                "EMBEDDER": "documents.retrieval.OllamaEmbedder",
+            },
+        )
+        production_llm = consumers.llm
+        production_answer_cache = consumers.answer_cache
+        try:
+            with overrides:
+                # Rebuild the chain so every agent talks to the fake server
+                consumers.llm = consumers.build_llm()
+                # Every turn goes through the pipeline being measured
+                consumers.answer_cache = None
+                load_test = LoadTest(
+                    sessions=options["sessions"],
+                    messages=options["messages"],
+                    uploads=options["uploads"],
+                    pages=options["pages"],
+                    timeout=options["timeout"],
+                )
+                results = await load_test.run()
+        finally:
+            consumers.llm = production_llm
+            consumers.answer_cache = production_answer_cache
+            await fake.stop()
+
+        results["config"] = {
+            key: options[key]
+            for key in (
+                "sessions",
+                "messages",
+                "uploads",
+                "pages",
+                "token_rate",
+                "latency",
+                "tokens",
+                "reject_rate",
+                "max_concurrency",
+            )
+        }
+        results["ollama_requests"] = fake.requests
+        return results
+
+    def report(self, results):
+        self.stdout.write(
+            f"{'stage':<20}{'count':>8}{'p50 ms':>10}{'p99 ms':>10}"
+            f"{'mean ms':>10}{'per s':>10}"
+        )
+        for stage, stats in results["stages"].items():
+            self.stdout.write(
+                f"{stage:<20}{stats['count']:>8}{stats['p50'] * 1000:>10.1f}"
+                f"{stats['p99'] * 1000:>10.1f}{stats['mean'] * 1000:>10.1f}"
+                f"{stats['throughput']:>10.2f}"
+            )
+        self.stdout.write(
+            f"{results['wall_seconds']:.1f}s wall, "
+            f"{results['ollama_requests']} Ollama requests, "
+            f"{results['errors']} errors"
+        )
+
+    def compare(self, results, baseline_path, max_regression):
+        with open(baseline_path) as baseline_file:
+            baseline = json.load(baseline_file)
+
+        regressions = []
+        for stage, stats in baseline["stages"].items():
+            current = results["stages"].get(stage)
+            if current and current["p99"] > stats["p99"] * (1 + max_regression):
+                regressions.append(
+                    f"{stage} p99 {current['p99'] * 1000:.1f}ms "
+                    f"(baseline {stats['p99'] * 1000:.1f}ms)"
+                )
+        if regressions:
+            raise CommandError("Performance regression: " + "; ".join(regressions))
+        self.stdout.write(self.style.SUCCESS("No p99 regression against baseline"))
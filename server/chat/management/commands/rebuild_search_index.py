@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+from django.db import DEFAULT_DB_ALIAS, transaction
+
+from chat.search import get_search_backend
+
+
+class Command(BaseCommand):
+    help = (
+        "Drop and rebuild the full-text index over messages and document "
+        "chunks, e.g. to purge chunks deleted since they were indexed."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--database", default=DEFAULT_DB_ALIAS)
+
+    def handle(self, *args, **options):
+        backend = get_search_backend(options["database"])
+        with transaction.atomic(using=options["database"]):
+            backend.rebuild()
+        self.stdout.write(f"Rebuilt the search index ({type(backend).__name__})")
@@ -0,0 +1,168 @@
+"""In-process counters and histograms rendered in the Prometheus text format.
+
+Each worker keeps its own values; with several Daphne workers, scrape each
+one and aggregate in Prometheus.
+"""
+
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+REGISTRY = []
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    pairs = ",".join(f'{name}="{_escape(value)}"' for name, value in labels)
+    return "{" + pairs + "}"
+
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value))
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}  # label values tuple -> metric-specific state
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _labels(self, key, *extra):
+        return tuple(zip(self.labelnames, key)) + extra
+
+    def render(self):
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.type}",
+        ]
+        with self._lock:
+            for key, state in sorted(self._values.items()):
+                lines.extend(self._render_samples(key, state))
+        return lines
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _render_samples(self, key, value):
+        yield f"{self.name}{_format_labels(self._labels(key))} {_format_value(value)}"
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * len(self.buckets), 0.0]
+            counts = state[0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+            state[1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the duration of the block, also when it raises"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def _render_samples(self, key, state):
+        counts, total = state
+        for bound, count in zip(self.buckets, counts):
+            labels = self._labels(key, ("le", _format_value(bound)))
+            yield f"{self.name}_bucket{_format_labels(labels)} {count}"
+        labels = _format_labels(self._labels(key))
+        yield f"{self.name}_sum{labels} {_format_value(total)}"
+        yield f"{self.name}_count{labels} {counts[-1]}"
+
+
+def render():
+    """Return every registered metric in the Prometheus text exposition format"""
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+connect_seconds = Histogram(
+    "chat_connect_seconds", "Time to accept a WebSocket and join its session group"
+)
+context_seconds = Histogram(
+    "chat_get_context_seconds", "Time to load history and retrieve document excerpts"
+)
+producer_seconds = Histogram(
+    "chat_producer_attempt_seconds",
+    "Duration of one producer attempt",
+    ["mode"],
+)
+review_seconds = Histogram("chat_review_seconds", "Duration of one reviewer evaluation")
+reviews_total = Counter(
+    "chat_reviews_total", "Reviewer verdicts, approved or rejected", ["status"]
+)
+retries_total = Counter(
+    "chat_producer_retries_total", "Producer attempts after a rejected one"
+)
+hedged_candidates_total = Counter(
+    "chat_hedged_candidates_total",
+    "Hedged producer candidates started, by whether their answer was used",
+    ["outcome"],
+)
+turn_seconds = Histogram(
+    "chat_turn_seconds", "Time from receiving a message to answering it", ["outcome"]
+)
+turn_prompt_eval_seconds = Histogram(
+    "chat_turn_prompt_eval_seconds", "Ollama prompt evaluation time per turn"
+)
+db_write_seconds = Histogram(
+    "chat_db_write_seconds", "Duration of one batched message write"
+)
+db_rows_written_total = Counter(
+    "chat_db_rows_written_total", "Messages written to the database", ["status"]
+)
+answer_cache_lookups_total = Counter(
+    "chat_answer_cache_lookups_total", "Semantic answer cache lookups", ["result"]
+)
+answer_cache_saved_seconds_total = Counter(
+    "chat_answer_cache_saved_seconds_total",
+    "Producer/reviewer time the answers served from cache originally took",
+)
+queue_wait_seconds = Histogram(
+    "llm_queue_wait_seconds",
+    "Time an LLM request waited for a scheduler slot",
+    ["priority"],
+)
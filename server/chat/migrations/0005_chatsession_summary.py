@@ -0,0 +1,23 @@
+# Generated by Django 5.1.6 on 2026-10-18 04:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("chat", "0004_remove_feedback_model_response"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="chatsession",
+            name="summarized_until",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="chatsession",
+            name="summary",
+            field=models.TextField(blank=True),
+        ),
+    ]
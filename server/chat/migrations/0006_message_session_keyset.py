@@ -0,0 +1,19 @@
+# Generated by Django 5.1.6 on 2026-10-18 05:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("chat", "0005_chatsession_summary"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="message",
+            index=models.Index(
+                fields=["session", "created_at", "id"], name="message_session_keyset"
+            ),
+        ),
+    ]
@@ -7,6 +7,9 @@ class ChatSession(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
+    # Rolling summary of every message up to summarized_until
+    summary = models.TextField(blank=True)
+    summarized_until = models.DateTimeField(null=True, blank=True)
 
     def __str__(self):
         return f"Chat {self.id} - {self.created_at.strftime('%Y-%m-%d %H:%M')}"
@@ -28,6 +31,12 @@ class Message(models.Model):
 
     class Meta:
         ordering = ["created_at"]
+        indexes = [
+            # Keyset pagination of a session's history, see SessionMessagesView
+            models.Index(
+                fields=["session", "created_at", "id"], name="message_session_keyset"
+            ),
+        ]
 
     def __str__(self):
         return f"{self.role}: {self.content[:50]}..."
@@ -0,0 +1,18 @@
+from rest_framework.permissions import BasePermission, IsAdminUser
+
+
+class SessionScoped(BasePermission):
+    """Allow requests that name the session they read, and admin users.
+
+    Sessions have no owner: knowing a session id is what grants access to
+    the conversation, so views must never hand out the ids of other
+    sessions, and only admin users may read across sessions.
+    """
+
+    message = "A session id is required"
+
+    def has_permission(self, request, view):
+        session_id = view.kwargs.get("session_id") or request.query_params.get(
+            "session"
+        )
+        return bool(session_id) or IsAdminUser().has_permission(request, view)
@@ -0,0 +1,162 @@
+import asyncio
+import atexit
+import logging
+import threading
+import time
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.db import IntegrityError, transaction
+
+from . import metrics
+from .lifespan import on_shutdown
+from .models import Message
+
+logger = logging.getLogger(__name__)
+
+
+class MessageWriter:
+    """Write-behind queue that persists Message rows from every consumer.
+
+    Rows are flushed with a single bulk_create transaction every
+    FLUSH_INTERVAL seconds, or as soon as MAX_BATCH rows are waiting. When
+    the batch violates a constraint, e.g. a session deleted mid-turn, its
+    rows are retried one at a time so only the offending rows fail.
+    save() only returns once its row is committed.
+    """
+
+    def __init__(self, flush_interval=0.005, max_batch=100):
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self._pending = []  # (message, future) pairs
+        self._timer = None
+        self._flushes = set()
+        # Batches handed to a flush that has not started writing them, and
+        # the number being written, so flush_sync can finish them at exit
+        self._unwritten = {}  # id -> messages
+        self._writing = 0
+        self._condition = threading.Condition()
+
+    @classmethod
+    def from_settings(cls):
+        config = settings.MESSAGE_WRITER
+        return cls(
+            flush_interval=config["FLUSH_INTERVAL"], max_batch=config["MAX_BATCH"]
+        )
+
+    async def save(self, message):
+        """Queue a message and wait until it is durably stored"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((message, future))
+
+        if len(self._pending) >= self.max_batch:
+            self._start_flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.flush_interval, self._start_flush)
+
+        await asyncio.shield(future)
+
+    def _start_flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._pending:
+            return
+
+        batch, self._pending = self._pending, []
+        messages = [message for message, _ in batch]
+        with self._condition:
+            self._unwritten[id(messages)] = messages
+        task = asyncio.get_running_loop().create_task(self._flush(batch, messages))
+        self._flushes.add(task)
+        task.add_done_callback(self._flushes.discard)
+
+    async def _flush(self, batch, messages):
+        started = time.perf_counter()
+        try:
+            errors = await database_sync_to_async(self._write_claimed)(messages)
+        except Exception as e:
+            logger.exception("Error saving %d messages: %s", len(batch), e)
+            errors = [e] * len(batch)
+        finally:
+            metrics.db_write_seconds.observe(time.perf_counter() - started)
+
+        failed = sum(error is not None for error in errors)
+        metrics.db_rows_written_total.inc(len(batch) - failed, status="ok")
+        if failed:
+            metrics.db_rows_written_total.inc(failed, status="failed")
+        for (_, future), error in zip(batch, errors):
+            if future.done():
+                continue
+            if error is None:
+                future.set_result(None)
+            else:
+                future.set_exception(error)
+                future.exception()  # Mark retrieved if the caller is gone
+
+    def _write_claimed(self, messages):
+        with self._condition:
+            if self._unwritten.pop(id(messages), None) is None:
+                return [None] * len(messages)  # Already written by flush_sync
+            self._writing += 1
+        try:
+            return self._write(messages)
+        finally:
+            with self._condition:
+                self._writing -= 1
+                self._condition.notify_all()
+
+    @staticmethod
+    def _write(messages):
+        """Write the rows, returning the error of each row that failed"""
+        try:
+            with transaction.atomic():
+                Message.objects.bulk_create(messages)
+            return [None] * len(messages)
+        except IntegrityError as e:
+            logger.warning(
+                "Batch of %d messages failed, retrying one by one: %s",
+                len(messages),
+                e,
+            )
+
+        errors = []
+        for message in messages:
+            try:
+                with transaction.atomic():
+                    Message.objects.bulk_create([message])
+            except IntegrityError as e:
+                logger.error("Error saving message %s: %s", message.id, e)
+                errors.append(e)
+            else:
+                errors.append(None)
+        return errors
+
+    async def close(self):
+        """Flush everything still queued, used on worker shutdown"""
+        self._start_flush()
+        if self._flushes:
+            await asyncio.gather(*self._flushes, return_exceptions=True)
+
+    def flush_sync(self, timeout=30):
+        """Last-resort flush at interpreter exit, when no event loop is running.
+
+        Waits for batches being written by other threads, then writes the
+        batches whose flush never got to run and the rows still queued.
+        """
+        with self._condition:
+            if not self._condition.wait_for(lambda: not self._writing, timeout):
+                logger.error("Gave up waiting for %d message writes", self._writing)
+            batches = list(self._unwritten.values())
+            self._unwritten.clear()
+        if self._pending:
+            batches.append([message for message, _ in self._pending])
+            self._pending = []
+        for messages in batches:
+            self._write(messages)
+
+
+message_writer = MessageWriter.from_settings()
+on_shutdown(message_writer.close)
+atexit.register(message_writer.flush_sync)
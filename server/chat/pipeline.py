@@ -0,0 +1,269 @@
+"""The producer/reviewer answering pipeline, independent of any transport.
+
+ChatConsumer runs it for WebSocket turns; the answer_questions management
+command runs it in bulk.
+"""
+
+import asyncio
+import logging
+import time
+from collections import deque
+from dataclasses import dataclass, field
+
+from django.conf import settings
+from langchain.schema import AIMessage, HumanMessage
+
+from . import metrics
+from .agents.producer import ProducerAgent
+from .agents.reviewer import ReviewerAgent
+from .llm.cache import CachedLLM, LLMCache
+from .llm.client import create_llm, register_warmup
+from .llm.options import ollama_options
+from .llm.scheduler import (
+    PRIORITY_PRODUCER,
+    PRIORITY_RETRY,
+    PRIORITY_REVIEWER,
+    LLMScheduler,
+    ScheduledLLM,
+    llm_request_context,
+)
+from .llm.traffic import RecordingLLM, ReplayLLM, TrafficLog
+from .models import ChatSession, Message
+
+logger = logging.getLogger(__name__)
+
+UNANSWERED = "Unable to generate satisfactory response after multiple attempts"
+
+
+def build_llm(cache=None):
+    """Build the LLM chain shared by every agent from the current settings
+
+    cache overrides LLM_CACHE["ENABLED"], e.g. so batch runs measure the
+    current model rather than completions cached by earlier runs.
+    """
+    # Initialize Ollama model with optimized settings; the client layer adds
+    # the shared connection pool, timeouts and keep_alive
+    ollama = create_llm(
+        model="llama3.2",
+        temperature=0.3,
+        num_ctx=4096,  # Increased context window for improved answer accuracy
+        num_thread=4,  # Optimize for multi-threading
+        stop=["</s>", "Human:", "Assistant:"],  # Better conversation control
+    )
+    mode = settings.LLM_TRAFFIC["MODE"]
+    if mode == "replay":
+        # Completions come from a recorded traffic log, Ollama is not used
+        chain = ReplayLLM.from_settings(ollama)
+    else:
+        # Preloaded at startup so the first message does not pay the model load
+        register_warmup(ollama)
+        chain = ollama
+        if mode == "record":
+            chain = RecordingLLM(ollama, TrafficLog.from_settings())
+
+    # Every Ollama call waits for a slot so bursts from one session cannot
+    # starve the others
+    chain = ScheduledLLM(chain, LLMScheduler.from_settings())
+
+    # Answer repeated prompts (reviewer checks, summaries) from cache
+    if settings.LLM_CACHE["ENABLED"] if cache is None else cache:
+        chain = CachedLLM(
+            chain,
+            LLMCache.from_settings(),
+            cache_producer=settings.LLM_CACHE["CACHE_PRODUCER"],
+        )
+    return chain
+
+
+def to_history_message(role, content):
+    if role == "user":
+        return HumanMessage(content=content)
+    return AIMessage(content=content)
+
+
+def load_context_snapshot(session_id):
+    """Recent history, summary and unsummarized message count of a session"""
+    session = ChatSession.objects.get(id=session_id)
+    messages = Message.objects.filter(session=session)
+
+    # Get recent chat history
+    window = settings.AGENT_CONFIG["HISTORY_WINDOW"]
+    recent = messages.order_by("-created_at").values_list("role", "content")
+    history = deque(maxlen=window)
+    for role, content in reversed(recent[:window]):
+        history.append(to_history_message(role, content))
+
+    # Older turns are covered by the rolling summary
+    if session.summarized_until:
+        messages = messages.filter(created_at__gt=session.summarized_until)
+    return {
+        "history": history,
+        "summary": session.summary,
+        "unsummarized": messages.count(),
+    }
+
+
+@dataclass
+class Answer:
+    text: str
+    approved: bool = False
+    attempts: int = 0
+    scores: list = field(default_factory=list)  # Reviewer score per attempt
+    cached: bool = False  # Served from the semantic answer cache
+
+
+class AnswerPipeline:
+    """Drafts an answer with ProducerAgent and has ReviewerAgent check it,
+    retrying with the reviewer's feedback up to MAX_RETRIES times.
+
+    With an AnswerCache, approved answers to questions asked about documents
+    are stored, and a similar question about the same documents is answered
+    from the cache without calling the LLM.
+    """
+
+    def __init__(self, llm, config=None, answer_cache=None):
+        self.llm = llm
+        self.config = config or settings.AGENT_CONFIG
+        self.answer_cache = answer_cache
+        self.producer = ProducerAgent(llm, layout=self.config.get("PROMPT_LAYOUT"))
+        self.reviewer = ReviewerAgent(
+            llm,
+            early_exit=self.config.get("REVIEW_EARLY_EXIT", False),
+            max_tokens=self.config.get("REVIEW_MAX_TOKENS"),
+        )
+
+    async def answer(self, question, context, on_delta=None, on_rejected=None):
+        """Return the first approved Answer.
+
+        on_delta(attempt, chunk) receives streamed producer tokens and
+        on_rejected(attempt) is awaited when a streamed draft is rejected.
+        """
+        cacheable = self._cacheable(context)
+        if cacheable:
+            text = self.answer_cache.lookup(
+                context["question_vector"], context["documents_fingerprint"]
+            )
+            if text is not None:
+                return Answer(text=text, approved=True, cached=True)
+
+        started = time.perf_counter()
+        result = await self.produce(question, context, on_delta, on_rejected)
+        if cacheable and result.approved:
+            self.answer_cache.store(
+                context["question_vector"],
+                context["documents_fingerprint"],
+                result.text,
+                seconds=time.perf_counter() - started,
+            )
+        return result
+
+    def _cacheable(self, context):
+        if self.answer_cache is None or context.get("question_vector") is None:
+            return False  # No cache, or no documents to answer from
+        # A follow-up can mean something else in another conversation
+        standalone = not context.get("history") and not context.get("summary")
+        return standalone or not settings.ANSWER_CACHE["STANDALONE_ONLY"]
+
+    async def produce(self, question, context, on_delta=None, on_rejected=None):
+        candidates = self.config.get("HEDGED_CANDIDATES", 0)
+        if candidates > 1:
+            return await self.answer_hedged(question, context, candidates)
+
+        result = Answer(text=UNANSWERED)
+        feedback = None
+
+        for attempt in range(self.config.get("MAX_RETRIES", 3)):
+            if attempt:
+                metrics.retries_total.inc()
+            result.attempts += 1
+            # Generate response with current context and feedback
+            with llm_request_context(
+                priority=PRIORITY_RETRY if attempt else PRIORITY_PRODUCER
+            ), metrics.producer_seconds.time(mode="stream" if on_delta else "generate"):
+                if on_delta:
+                    chunks = []
+                    async for chunk in self.producer.stream_response(
+                        context=context, question=question, feedback=feedback
+                    ):
+                        chunks.append(chunk)
+                        await on_delta(attempt, chunk)
+                    response = "".join(chunks).strip()
+                else:
+                    response = await self.producer.generate_response(
+                        context=context, question=question, feedback=feedback
+                    )
+
+            review = await self.review(response, context, question)
+            result.scores.append(review["score"])
+
+            if review["status"] == "approved":
+                result.text = review["response"]
+                result.approved = True
+                break
+
+            if on_rejected:
+                await on_rejected(attempt)
+
+            feedback = review.get("feedback", "General quality improvement needed")
+
+        return result
+
+    async def review(self, response, context, question):
+        with llm_request_context(
+            priority=PRIORITY_REVIEWER
+        ), metrics.review_seconds.time():
+            review = await self.reviewer.evaluate_response(
+                response=response, context=context, question=question
+            )
+        metrics.reviews_total.inc(status=review["status"])
+        return review
+
+    async def answer_hedged(self, question, context, candidates):
+        """
+        Start several producer candidates at once with varied temperature and
+        seed, review each as soon as it finishes, and return the first approved
+        answer. Candidates still in flight are cancelled.
+        """
+        temperature_step = self.config.get("HEDGED_TEMPERATURE_STEP", 0.2)
+
+        async def run_candidate(index):
+            options = ollama_options(
+                self.llm,
+                temperature=min(self.llm.temperature + index * temperature_step, 1.0),
+                seed=index,
+            )
+            with llm_request_context(
+                priority=PRIORITY_RETRY if index else PRIORITY_PRODUCER
+            ), metrics.producer_seconds.time(mode="hedged"):
+                response = await self.producer.generate_response(
+                    context=context, question=question, options=options
+                )
+            return await self.review(response, context, question)
+
+        tasks = [
+            asyncio.create_task(run_candidate(index)) for index in range(candidates)
+        ]
+        result = Answer(text=UNANSWERED)
+        try:
+            for next_review in asyncio.as_completed(tasks):
+                try:
+                    review = await next_review
+                except Exception as e:
+                    logger.warning("Hedged candidate failed: %s", e)
+                    continue
+                result.attempts += 1
+                result.scores.append(review["score"])
+                if review["status"] == "approved":
+                    result.text = review["response"]
+                    result.approved = True
+                    break
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+        wasted = candidates - 1 if result.approved else candidates
+        metrics.hedged_candidates_total.inc(candidates - wasted, outcome="used")
+        metrics.hedged_candidates_total.inc(wasted, outcome="wasted")
+        logger.info("Hedged generation: %d candidates, %d wasted", candidates, wasted)
+        return result
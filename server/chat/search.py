@@ -0,0 +1,428 @@
+"""Full-text search over chat messages and document chunks.
+
+SQLite uses FTS5: messages through an external-content table kept in sync
+by triggers, so the batched inserts of MessageWriter are indexed too, and
+keyed on a search_rowid column the triggers number (messages have UUID
+keys, and the implicit rowid can change on VACUUM), and
+chunks through a contentless table filled when they are embedded (their
+stored text is compressed). PostgreSQL uses a generated tsvector column on
+messages and a tsvector side table for chunks, both with GIN indexes.
+Other databases fall back to LIKE over messages and titles only.
+
+The tables, triggers and indexes are installed after every `migrate`, and
+`manage.py rebuild_search_index` rebuilds them from scratch.
+"""
+
+import logging
+import re
+
+from django.db import connections
+
+logger = logging.getLogger(__name__)
+
+MAX_TERMS = 32
+BATCH_SIZE = 500
+
+
+def query_terms(query):
+    """Words of a free-text query, stripped of any search syntax"""
+    return re.findall(r"\w+", query.lower())[:MAX_TERMS]
+
+
+def _iter_chunk_texts():
+    from documents.models import DocumentChunk
+
+    rows = DocumentChunk.objects.only("id", "text").order_by("id")
+    batch = []
+    for chunk in rows.iterator(chunk_size=BATCH_SIZE):
+        batch.append((chunk.id, chunk.text))
+        if len(batch) >= BATCH_SIZE:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class SearchBackend:
+    """LIKE fallback for databases without a full-text index"""
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def install(self):
+        pass
+
+    def rebuild(self):
+        pass
+
+    def filter_messages(self, queryset, query):
+        for term in query_terms(query):
+            queryset = queryset.filter(content__icontains=term)
+        return queryset
+
+    def search_messages(self, query, session_id=None, limit=20):
+        """Return [(message id, score, snippet)] best match first"""
+        from .models import Message
+
+        if not query_terms(query):
+            return []
+        queryset = self.filter_messages(Message.objects.all(), query)
+        if session_id:
+            queryset = queryset.filter(session_id=session_id)
+        rows = queryset.order_by("-created_at").values_list("id", "content")[:limit]
+        return [(message_id, 0.0, content[:200]) for message_id, content in rows]
+
+    def index_chunks(self, chunks):
+        """Add [(chunk id, text)] to the index"""
+
+    def chunk_match_sql(self, query):
+        """SQL and params selecting the content ids of matching chunks"""
+        return None
+
+    def search_chunks(self, query, content_ids=None, limit=20, match_all=True):
+        """Return [(chunk id, score)] best match first"""
+        return []
+
+
+class SQLiteSearchBackend(SearchBackend):
+    MESSAGE_TRIGGERS = {
+        "chat_message_fts_insert": """
+            CREATE TRIGGER chat_message_fts_insert AFTER INSERT ON chat_message
+            BEGIN
+                UPDATE chat_message SET search_rowid = (
+                    SELECT IFNULL(MAX(search_rowid), 0) + 1 FROM chat_message
+                ) WHERE rowid = new.rowid;
+                INSERT INTO chat_message_fts (rowid, content)
+                SELECT search_rowid, content FROM chat_message
+                WHERE rowid = new.rowid;
+            END""",
+        "chat_message_fts_delete": """
+            CREATE TRIGGER chat_message_fts_delete AFTER DELETE ON chat_message
+            BEGIN
+                INSERT INTO chat_message_fts (chat_message_fts, rowid, content)
+                VALUES ('delete', old.search_rowid, old.content);
+            END""",
+        "chat_message_fts_update": """
+            CREATE TRIGGER chat_message_fts_update AFTER UPDATE OF content
+            ON chat_message
+            BEGIN
+                INSERT INTO chat_message_fts (chat_message_fts, rowid, content)
+                VALUES ('delete', old.search_rowid, old.content);
+                INSERT INTO chat_message_fts (rowid, content)
+                VALUES (new.search_rowid, new.content);
+            END""",
+    }
+
+    @staticmethod
+    def match_expression(query, match_all=True):
+        terms = query_terms(query)
+        if not terms:
+            return None
+        return (" " if match_all else " OR ").join(f'"{term}"' for term in terms)
+
+    def _existing(self, cursor):
+        cursor.execute(
+            "SELECT name FROM sqlite_master WHERE type IN ('table', 'trigger')"
+        )
+        return {name for (name,) in cursor.fetchall()}
+
+    def _add_search_rowid(self, cursor):
+        """Add and number the column the message index is keyed on, unless
+        chat_message has it; returns whether it was added"""
+        columns = self.connection.introspection.get_table_description(
+            cursor, "chat_message"
+        )
+        if any(column.name == "search_rowid" for column in columns):
+            return False
+        cursor.execute("ALTER TABLE chat_message ADD COLUMN search_rowid INTEGER")
+        cursor.execute("UPDATE chat_message SET search_rowid = rowid")
+        cursor.execute(
+            "CREATE UNIQUE INDEX chat_message_search_rowid "
+            "ON chat_message (search_rowid)"
+        )
+        return True
+
+    def _drop_message_index(self, cursor):
+        for name in self.MESSAGE_TRIGGERS:
+            cursor.execute(f"DROP TRIGGER IF EXISTS {name}")
+        cursor.execute("DROP TABLE IF EXISTS chat_message_fts")
+
+    def install(self):
+        with self.connection.cursor() as cursor:
+            existing = self._existing(cursor)
+            if "chat_message" in existing:
+                # Missing after chat_message was rebuilt by a migration, which
+                # also drops the triggers
+                added = self._add_search_rowid(cursor)
+                cursor.execute(
+                    "SELECT sql FROM sqlite_master WHERE name = 'chat_message_fts'"
+                )
+                row = cursor.fetchone()
+                if row and "search_rowid" not in row[0]:
+                    # Index of an older version, keyed on the implicit rowid
+                    self._drop_message_index(cursor)
+                    existing = self._existing(cursor)
+                cursor.execute(
+                    "CREATE VIRTUAL TABLE IF NOT EXISTS chat_message_fts USING "
+                    "fts5(content, content='chat_message', "
+                    "content_rowid='search_rowid', tokenize='porter unicode61')"
+                )
+                missing = [
+                    name for name in self.MESSAGE_TRIGGERS if name not in existing
+                ]
+                for name in missing:
+                    cursor.execute(self.MESSAGE_TRIGGERS[name])
+                if missing or added:
+                    cursor.execute(
+                        "INSERT INTO chat_message_fts (chat_message_fts) VALUES ('rebuild')"
+                    )
+            if (
+                "documents_documentchunk" in existing
+                and "documents_chunk_fts" not in existing
+            ):
+                cursor.execute(
+                    "CREATE VIRTUAL TABLE documents_chunk_fts USING "
+                    "fts5(text, content='', tokenize='porter unicode61')"
+                )
+                created_chunk_index = True
+            else:
+                created_chunk_index = False
+        if created_chunk_index:
+            for batch in _iter_chunk_texts():
+                self.index_chunks(batch)
+
+    def rebuild(self):
+        with self.connection.cursor() as cursor:
+            self._drop_message_index(cursor)
+            cursor.execute("DROP TABLE IF EXISTS documents_chunk_fts")
+        self.install()
+
+    def filter_messages(self, queryset, query):
+        expression = self.match_expression(query)
+        if expression is None:
+            return queryset
+        return queryset.extra(
+            where=[
+                "chat_message.search_rowid IN (SELECT rowid FROM chat_message_fts "
+                "WHERE chat_message_fts MATCH %s)"
+            ],
+            params=[expression],
+        )
+
+    def search_messages(self, query, session_id=None, limit=20):
+        from .models import ChatSession, Message
+
+        expression = self.match_expression(query)
+        if expression is None:
+            return []
+        sql = (
+            "SELECT m.id, bm25(chat_message_fts), "
+            "snippet(chat_message_fts, 0, '[', ']', '...', 16) "
+            "FROM chat_message_fts JOIN chat_message m "
+            "ON m.search_rowid = chat_message_fts.rowid "
+            "WHERE chat_message_fts MATCH %s"
+        )
+        params = [expression]
+        if session_id:
+            sql += " AND m.session_id = %s"
+            params.append(
+                ChatSession._meta.pk.get_db_prep_value(session_id, self.connection)
+            )
+        sql += " ORDER BY bm25(chat_message_fts) LIMIT %s"
+        params.append(limit)
+        with self.connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            rows = cursor.fetchall()
+        # bm25 is lower for better matches; ids come back as stored (hex)
+        to_python = Message._meta.pk.to_python
+        return [
+            (to_python(message_id), -rank, snippet)
+            for message_id, rank, snippet in rows
+        ]
+
+    def index_chunks(self, chunks):
+        with self.connection.cursor() as cursor:
+            cursor.executemany(
+                "INSERT INTO documents_chunk_fts (rowid, text) VALUES (%s, %s)",
+                list(chunks),
+            )
+
+    def chunk_match_sql(self, query):
+        expression = self.match_expression(query)
+        if expression is None:
+            return None
+        # Deleted chunks stay in the contentless index until the next
+        # rebuild; the join leaves them out (chunk ids are never reused)
+        return (
+            "SELECT c.content_id FROM documents_chunk_fts "
+            "JOIN documents_documentchunk c ON c.id = documents_chunk_fts.rowid "
+            "WHERE documents_chunk_fts MATCH %s",
+            [expression],
+        )
+
+    def search_chunks(self, query, content_ids=None, limit=20, match_all=True):
+        expression = self.match_expression(query, match_all)
+        if expression is None:
+            return []
+        sql = (
+            "SELECT c.id, bm25(documents_chunk_fts) FROM documents_chunk_fts "
+            "JOIN documents_documentchunk c ON c.id = documents_chunk_fts.rowid "
+            "WHERE documents_chunk_fts MATCH %s"
+        )
+        params = [expression]
+        if content_ids is not None:
+            if not content_ids:
+                return []
+            sql += f" AND c.content_id IN ({', '.join(['%s'] * len(content_ids))})"
+            params.extend(content_ids)
+        sql += " ORDER BY bm25(documents_chunk_fts) LIMIT %s"
+        params.append(limit)
+        with self.connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            return [(chunk_id, -rank) for chunk_id, rank in cursor.fetchall()]
+
+
+class PostgresSearchBackend(SearchBackend):
+    CONFIG = "english"
+
+    def tsquery(self, query, match_all=True):
+        """SQL for a tsquery and its params, None for an empty query"""
+        terms = query_terms(query)
+        if not terms:
+            return None
+        if match_all:
+            return "plainto_tsquery(%s, %s)", [self.CONFIG, " ".join(terms)]
+        return "to_tsquery(%s, %s)", [self.CONFIG, " | ".join(terms)]
+
+    def install(self):
+        with self.connection.cursor() as cursor:
+            tables = self.connection.introspection.table_names(cursor)
+            if "chat_message" in tables:
+                cursor.execute(
+                    "ALTER TABLE chat_message ADD COLUMN IF NOT EXISTS search_vector "
+                    f"tsvector GENERATED ALWAYS AS (to_tsvector('{self.CONFIG}', "
+                    "content)) STORED"
+                )
+                cursor.execute(
+                    "CREATE INDEX IF NOT EXISTS chat_message_search_idx "
+                    "ON chat_message USING GIN (search_vector)"
+                )
+            if (
+                "documents_documentchunk" in tables
+                and "documents_chunk_search" not in tables
+            ):
+                cursor.execute(
+                    "CREATE TABLE documents_chunk_search ("
+                    "chunk_id bigint PRIMARY KEY REFERENCES documents_documentchunk "
+                    "(id) ON DELETE CASCADE, search_vector tsvector NOT NULL)"
+                )
+                cursor.execute(
+                    "CREATE INDEX documents_chunk_search_idx "
+                    "ON documents_chunk_search USING GIN (search_vector)"
+                )
+                created_chunk_index = True
+            else:
+                created_chunk_index = False
+        if created_chunk_index:
+            for batch in _iter_chunk_texts():
+                self.index_chunks(batch)
+
+    def rebuild(self):
+        with self.connection.cursor() as cursor:
+            cursor.execute("DROP TABLE IF EXISTS documents_chunk_search")
+            cursor.execute("DROP INDEX IF EXISTS chat_message_search_idx")
+            cursor.execute(
+                "ALTER TABLE chat_message DROP COLUMN IF EXISTS search_vector"
+            )
+        self.install()
+
+    def filter_messages(self, queryset, query):
+        tsquery = self.tsquery(query)
+        if tsquery is None:
+            return queryset
+        sql, params = tsquery
+        return queryset.extra(
+            where=[f"chat_message.search_vector @@ {sql}"], params=params
+        )
+
+    def search_messages(self, query, session_id=None, limit=20):
+        tsquery = self.tsquery(query)
+        if tsquery is None:
+            return []
+        sql, params = tsquery
+        statement = (
+            "SELECT id, ts_rank_cd(search_vector, q), "
+            "ts_headline(%s, content, q, 'MaxWords=32, MinWords=8') "
+            f"FROM chat_message, {sql} q WHERE search_vector @@ q"
+        )
+        params = [self.CONFIG, *params]
+        if session_id:
+            statement += " AND session_id = %s"
+            params.append(session_id)
+        statement += " ORDER BY 2 DESC LIMIT %s"
+        params.append(limit)
+        with self.connection.cursor() as cursor:
+            cursor.execute(statement, params)
+            return cursor.fetchall()
+
+    def index_chunks(self, chunks):
+        with self.connection.cursor() as cursor:
+            cursor.executemany(
+                "INSERT INTO documents_chunk_search (chunk_id, search_vector) "
+                "VALUES (%s, to_tsvector(%s, %s)) ON CONFLICT (chunk_id) "
+                "DO UPDATE SET search_vector = EXCLUDED.search_vector",
+                [(chunk_id, self.CONFIG, text) for chunk_id, text in chunks],
+            )
+
+    def chunk_match_sql(self, query):
+        tsquery = self.tsquery(query)
+        if tsquery is None:
+            return None
+        sql, params = tsquery
+        return (
+            "SELECT c.content_id FROM documents_chunk_search s "
+            "JOIN documents_documentchunk c ON c.id = s.chunk_id "
+            f"WHERE s.search_vector @@ {sql}",
+            params,
+        )
+
+    def search_chunks(self, query, content_ids=None, limit=20, match_all=True):
+        tsquery = self.tsquery(query, match_all)
+        if tsquery is None:
+            return []
+        sql, params = tsquery
+        statement = (
+            "SELECT c.id, ts_rank_cd(s.search_vector, q) "
+            "FROM documents_chunk_search s "
+            f"JOIN documents_documentchunk c ON c.id = s.chunk_id, {sql} q "
+            "WHERE s.search_vector @@ q"
+        )
+        if content_ids is not None:
+            statement += " AND c.content_id = ANY(%s)"
+            params = [*params, list(content_ids)]
+        statement += " ORDER BY 2 DESC LIMIT %s"
+        params = [*params, limit]
+        with self.connection.cursor() as cursor:
+            cursor.execute(statement, params)
+            return cursor.fetchall()
+
+
+BACKENDS = {
+    "sqlite": SQLiteSearchBackend,
+    "postgresql": PostgresSearchBackend,
+}
+
+
+def get_search_backend(using="default"):
+    connection = connections[using]
+    return BACKENDS.get(connection.vendor, SearchBackend)(connection)
+
+
+def install_search_index(using="default", **kwargs):
+    """post_migrate receiver: create or repair the full-text index"""
+    try:
+        get_search_backend(using).install()
+    except Exception as e:
+        # E.g. SQLite built without FTS5: searches fail at query time
+        # instead of migrations failing here
+        logger.warning("Could not install the full-text search index: %s", e)
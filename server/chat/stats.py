@@ -0,0 +1,10 @@
+"""Summary statistics shared by the benchmark and batch commands"""
+
+import math
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of a non-empty list"""
+    ordered = sorted(values)
+    rank = max(math.ceil(fraction * len(ordered)), 1)
+    return ordered[rank - 1]
@@ -1,3 +1,1429 @@
-from django.test import TestCase
+import asyncio
+import datetime
+import shutil
+import socket
+import tempfile
+import threading
+import uuid
+from unittest import mock, skipIf
 
-# Create your tests here.
+import redis.asyncio as redis
+from asgiref.sync import async_to_sync
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from channels.testing import WebsocketCommunicator
+from channels_redis.core import RedisChannelLayer
+from documents.models import Document, DocumentChunk, DocumentContent
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import IntegrityError, connection
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from langchain.schema import AIMessage, HumanMessage
+from langchain_core.outputs import Generation, GenerationChunk, LLMResult
+
+from . import consumers, metrics
+from .agents.producer import ProducerAgent
+from .agents.reviewer import ReviewerAgent
+from .answer_cache import AnswerCache
+from .benchmark.fake_ollama import FakeOllama
+from .benchmark.load import LoadTest
+from .consumers import ChatConsumer, summary_tasks
+from .context import ContextAssembler, TokenEstimator, format_document_chunk
+from .llm.cache import CachedLLM, LLMCache
+from .llm.client import PromptEvalReporter, track_prompt_eval
+from .llm.options import OPTION_FIELDS
+from .llm.scheduler import (
+    PRIORITY_PRODUCER,
+    PRIORITY_RETRY,
+    PRIORITY_REVIEWER,
+    LLMScheduler,
+    RedisSlotLimiter,
+    SchedulerFull,
+    llm_request_context,
+)
+from .llm.traffic import (
+    RecordingLLM,
+    ReplayLLM,
+    ReplayMiss,
+    TrafficLog,
+    read_traffic,
+)
+from .models import ChatSession, Message
+from .persistence import MessageWriter
+from .pipeline import AnswerPipeline, load_context_snapshot
+from .search import get_search_backend
+from .views import decode_cursor, encode_cursor
+
+try:
+    from fakeredis import TcpFakeServer
+except ImportError:  # fakeredis is a test-only dependency
+    TcpFakeServer = None
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+@skipIf(TcpFakeServer is None, "fakeredis is not installed")
+class FakeRedisTestCase(TransactionTestCase):
+    """Runs an in-process Redis server that every worker under test shares"""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        port = free_port()
+        cls.redis_url = f"redis://127.0.0.1:{port}/0"
+        cls.redis_server = TcpFakeServer(("127.0.0.1", port), server_type="redis")
+        cls.redis_thread = threading.Thread(
+            target=cls.redis_server.serve_forever, daemon=True
+        )
+        cls.redis_thread.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.redis_server.shutdown()
+        cls.redis_server.server_close()
+        super().tearDownClass()
+
+
+class MultiWorkerTests(FakeRedisTestCase):
+    def test_group_message_reaches_consumer_on_another_worker(self):
+        session_id = str(uuid.uuid4())
+        layers = {
+            "default": {
+                "BACKEND": "channels_redis.core.RedisChannelLayer",
+                "CONFIG": {"hosts": [self.redis_url]},
+            }
+        }
+
+        async def scenario():
+            communicator = WebsocketCommunicator(
+                ChatConsumer.as_asgi(), f"/ws/chat/?session_id={session_id}"
+            )
+            connected, _ = await communicator.connect()
+            self.assertTrue(connected)
+            self.assertIsInstance(get_channel_layer(), RedisChannelLayer)
+
+            # A separate layer instance plays the part of a second Daphne worker
+            other_worker = RedisChannelLayer(hosts=[self.redis_url])
+            group = f"chat_{session_id}"
+            # connect() joins the group after accepting, so wait for it
+            client = redis.Redis.from_url(self.redis_url)
+            while not await client.zcard(other_worker._group_key(group)):
+                await asyncio.sleep(0.01)
+            await client.aclose()
+
+            await other_worker.group_send(
+                group, {"type": "chat_message", "message": "hello"}
+            )
+            frame = await communicator.receive_json_from(timeout=5)
+            await communicator.disconnect()
+            await other_worker.flush()
+            return frame
+
+        with override_settings(CHANNEL_LAYERS=layers):
+            frame = async_to_sync(scenario)()
+        self.assertEqual(frame, {"type": "message", "message": "hello"})
+
+    def test_llm_cache_is_shared_between_workers(self):
+        first = LLMCache(redis_url=self.redis_url)
+        second = LLMCache(redis_url=self.redis_url)
+        key = LLMCache.make_key("llama3.2", 0.3, "What is in the report?")
+
+        first.set(key, "A summary of Q3 revenue.")
+        self.assertEqual(second.get(key), "A summary of Q3 revenue.")
+        self.assertEqual(second.stats()["shared_hits"], 1)
+
+        # The second lookup is served from that worker's own memory tier
+        self.assertEqual(second.get(key), "A summary of Q3 revenue.")
+        self.assertEqual(second.stats()["memory_hits"], 1)
+
+    def test_global_limiter_caps_concurrency_across_workers(self):
+        key = f"llm-scheduler:test:{uuid.uuid4()}"
+        workers = [
+            RedisSlotLimiter(self.redis_url, limit=2, poll_interval=0.01, key=key)
+            for _ in range(3)
+        ]
+        running = 0
+        peak = 0
+
+        async def generate(limiter):
+            nonlocal running, peak
+            async with limiter.slot():
+                running += 1
+                peak = max(peak, running)
+                await asyncio.sleep(0.05)
+                running -= 1
+
+        async def scenario():
+            await asyncio.gather(
+                *(generate(limiter) for limiter in workers for _ in range(3))
+            )
+
+        async_to_sync(scenario)()
+        self.assertEqual(peak, 2)
+
+    def test_expired_lease_frees_its_slot(self):
+        key = f"llm-scheduler:test:{uuid.uuid4()}"
+        crashed = RedisSlotLimiter(self.redis_url, limit=1, lease_ttl=0.1, key=key)
+        survivor = RedisSlotLimiter(self.redis_url, limit=1, lease_ttl=0.1, key=key)
+
+        async def scenario():
+            # Acquired and never released, as if the worker had died
+            await crashed.acquire()
+            await asyncio.wait_for(survivor.acquire(), timeout=5)
+
+        async_to_sync(scenario)()
+
+    def test_held_lease_is_renewed(self):
+        key = f"llm-scheduler:test:{uuid.uuid4()}"
+        holder = RedisSlotLimiter(self.redis_url, limit=1, lease_ttl=0.15, key=key)
+        waiter = RedisSlotLimiter(self.redis_url, limit=1, lease_ttl=0.15, key=key)
+
+        async def scenario():
+            async with holder.slot():
+                # Outlives several TTLs, the renewal keeps the slot taken
+                with self.assertRaises(asyncio.TimeoutError):
+                    await asyncio.wait_for(waiter.acquire(), timeout=0.5)
+            await asyncio.wait_for(waiter.acquire(), timeout=5)
+
+        async_to_sync(scenario)()
+
+
+class CountingLLM:
+    """Stands in for Ollama, numbering each completion it generates"""
+
+    model = "llama3.2"
+    temperature = 0.3
+
+    def __init__(self):
+        self.calls = 0
+
+    async def agenerate(self, prompts, **kwargs):
+        self.calls += 1
+        return LLMResult(generations=[[Generation(text=f"draft {self.calls}")]])
+
+    async def astream(self, prompt, **kwargs):
+        self.calls += 1
+        yield f"draft {self.calls}"
+
+
+class CachedLLMTests(SimpleTestCase):
+    def generate(self, llm, priority):
+        async def scenario():
+            with llm_request_context(priority=priority):
+                result = await llm.agenerate(["Summarize the report"])
+            return result.generations[0][0].text
+
+        return async_to_sync(scenario)()
+
+    def test_reviewer_prompts_are_cached(self):
+        llm = CachedLLM(CountingLLM(), LLMCache())
+        self.assertEqual(self.generate(llm, PRIORITY_REVIEWER), "draft 1")
+        self.assertEqual(self.generate(llm, PRIORITY_REVIEWER), "draft 1")
+
+    def test_retry_does_not_replay_the_rejected_draft(self):
+        llm = CachedLLM(CountingLLM(), LLMCache())
+        self.assertEqual(self.generate(llm, PRIORITY_RETRY), "draft 1")
+        self.assertEqual(self.generate(llm, PRIORITY_RETRY), "draft 2")
+
+        async def stream():
+            with llm_request_context(priority=PRIORITY_RETRY):
+                return [chunk async for chunk in llm.astream("Summarize the report")]
+
+        self.assertEqual(async_to_sync(stream)(), ["draft 3"])
+
+    def test_producer_cache_can_be_enabled(self):
+        llm = CachedLLM(CountingLLM(), LLMCache(), cache_producer=True)
+        self.assertEqual(self.generate(llm, PRIORITY_RETRY), "draft 1")
+        self.assertEqual(self.generate(llm, PRIORITY_RETRY), "draft 1")
+
+
+class LLMSchedulerTests(SimpleTestCase):
+    def run_queued(self, scheduler, requests):
+        """Queue (session, priority) requests behind a held slot and return
+        the order they are served in"""
+        served = []
+
+        async def request(session, priority):
+            async with scheduler.slot(session, priority):
+                served.append((session, priority))
+
+        async def scenario():
+            await scheduler.acquire()  # Keeps the queued requests waiting
+            tasks = []
+            for session, priority in requests:
+                tasks.append(asyncio.create_task(request(session, priority)))
+                await asyncio.sleep(0)  # Queue them in this order
+            scheduler.release()
+            await asyncio.gather(*tasks)
+
+        async_to_sync(scenario)()
+        return served
+
+    def test_sessions_take_turns_within_a_priority(self):
+        scheduler = LLMScheduler(max_concurrency=1)
+        served = self.run_queued(
+            scheduler,
+            [
+                ("a", PRIORITY_PRODUCER),
+                ("a", PRIORITY_PRODUCER),
+                ("a", PRIORITY_PRODUCER),
+                ("b", PRIORITY_PRODUCER),
+                ("c", PRIORITY_PRODUCER),
+            ],
+        )
+        self.assertEqual([session for session, _ in served], ["a", "b", "c", "a", "a"])
+
+    def test_producer_is_served_before_reviewer_before_retry(self):
+        scheduler = LLMScheduler(max_concurrency=1)
+        served = self.run_queued(
+            scheduler,
+            [
+                ("a", PRIORITY_RETRY),
+                ("b", PRIORITY_REVIEWER),
+                ("c", PRIORITY_PRODUCER),
+            ],
+        )
+        self.assertEqual(
+            served,
+            [
+                ("c", PRIORITY_PRODUCER),
+                ("b", PRIORITY_REVIEWER),
+                ("a", PRIORITY_RETRY),
+            ],
+        )
+        self.assertEqual(scheduler.active, 0)
+
+    def test_queued_position(self):
+        scheduler = LLMScheduler(max_concurrency=1)
+        positions = {}
+
+        async def request(name, session, priority):
+            async def on_queued(position):
+                positions[name] = position
+
+            async with scheduler.slot(session, priority, on_queued):
+                pass
+
+        async def scenario():
+            await scheduler.acquire()
+            tasks = []
+            for name, session, priority in [
+                ("a1", "a", PRIORITY_PRODUCER),
+                ("a2", "a", PRIORITY_PRODUCER),
+                ("a3", "a", PRIORITY_PRODUCER),
+                ("b1", "b", PRIORITY_PRODUCER),
+                ("r1", "c", PRIORITY_REVIEWER),
+            ]:
+                tasks.append(asyncio.create_task(request(name, session, priority)))
+                await asyncio.sleep(0)
+            scheduler.release()
+            await asyncio.gather(*tasks)
+
+        async_to_sync(scenario)()
+        # b1 is served right after a1 by round-robin; the reviewer request
+        # waits for every producer request queued before it
+        self.assertEqual(positions, {"a1": 1, "a2": 2, "a3": 3, "b1": 2, "r1": 5})
+
+    def test_full_queue_is_rejected(self):
+        scheduler = LLMScheduler(max_concurrency=1, max_queue_depth=2)
+
+        async def scenario():
+            await scheduler.acquire()
+            waiting = [
+                asyncio.create_task(scheduler.acquire(session))
+                for session in ("a", "b")
+            ]
+            await asyncio.sleep(0)
+            with self.assertRaisesMessage(SchedulerFull, "The assistant is busy"):
+                await scheduler.acquire("c")
+            for task in waiting:
+                task.cancel()
+            await asyncio.gather(*waiting, return_exceptions=True)
+            self.assertEqual(scheduler.queue_depth, 0)
+
+        async_to_sync(scenario)()
+
+    def test_full_session_queue_is_rejected(self):
+        scheduler = LLMScheduler(max_concurrency=1, max_session_queue_depth=2)
+
+        async def scenario():
+            await scheduler.acquire()
+            waiting = [
+                asyncio.create_task(scheduler.acquire("a", priority))
+                for priority in (PRIORITY_PRODUCER, PRIORITY_REVIEWER)
+            ]
+            await asyncio.sleep(0)
+            # The limit counts the session's requests across priorities
+            with self.assertRaisesMessage(SchedulerFull, "for this session"):
+                await scheduler.acquire("a", PRIORITY_RETRY)
+            # Other sessions can still queue
+            other = asyncio.create_task(scheduler.acquire("b"))
+            await asyncio.sleep(0)
+            self.assertEqual(scheduler.queue_depth, 3)
+            for task in [*waiting, other]:
+                task.cancel()
+            await asyncio.gather(*waiting, other, return_exceptions=True)
+
+        async_to_sync(scenario)()
+
+
+class ApprovingLLM(CountingLLM):
+    """Drafts numbered answers and approves every one it reviews"""
+
+    def __getattr__(self, name):
+        if name in OPTION_FIELDS:
+            return None
+        raise AttributeError(name)
+
+    async def agenerate(self, prompts, **kwargs):
+        if "Answer ONLY in this format" in prompts[0]:
+            text = "\n".join(f"{number}. YES" for number in range(1, 6))
+            return LLMResult(generations=[[Generation(text=text)]])
+        return await super().agenerate(prompts, **kwargs)
+
+
+class HedgedAnswerTests(SimpleTestCase):
+    def test_wasted_candidates_are_counted(self):
+        pipeline = AnswerPipeline(ApprovingLLM(), config={"HEDGED_CANDIDATES": 3})
+        context = {"documents": "", "history": [], "summary": ""}
+
+        def count(outcome):
+            return metrics.hedged_candidates_total._values.get((outcome,), 0)
+
+        used, wasted = count("used"), count("wasted")
+        answer = async_to_sync(pipeline.produce)("What is in the report?", context)
+        self.assertTrue(answer.approved)
+        self.assertEqual(count("used") - used, 1)
+        self.assertEqual(count("wasted") - wasted, 2)
+
+
+class AnswerCacheTests(SimpleTestCase):
+    def vector(self, similarity):
+        """Unit vector at the given cosine similarity to [1, 0]"""
+        return [similarity, (1 - similarity**2) ** 0.5]
+
+    def test_threshold(self):
+        cache = AnswerCache(threshold=0.92)
+        cache.store(self.vector(1), "report", "Revenue grew 12%.")
+        self.assertEqual(cache.lookup(self.vector(1), "report"), "Revenue grew 12%.")
+        self.assertEqual(cache.lookup(self.vector(0.95), "report"), "Revenue grew 12%.")
+        self.assertIsNone(cache.lookup(self.vector(0.9), "report"))
+        self.assertEqual(cache.stats()["hits"], 2)
+        self.assertEqual(cache.stats()["misses"], 1)
+
+    def test_other_documents_miss(self):
+        cache = AnswerCache()
+        cache.store(self.vector(1), "report", "Revenue grew 12%.")
+        self.assertIsNone(cache.lookup(self.vector(1), "other report"))
+
+    def test_expired_entries_miss(self):
+        cache = AnswerCache(ttl=0)
+        cache.store(self.vector(1), "report", "Revenue grew 12%.")
+        self.assertIsNone(cache.lookup(self.vector(1), "report"))
+
+    def test_least_recently_used_is_replaced(self):
+        cache = AnswerCache(max_entries=2)
+        cache.store(self.vector(1), "first", "first answer")
+        cache.store(self.vector(1), "second", "second answer")
+        cache.lookup(self.vector(1), "first")
+        cache.store(self.vector(1), "third", "third answer")
+        self.assertEqual(cache.lookup(self.vector(1), "first"), "first answer")
+        self.assertIsNone(cache.lookup(self.vector(1), "second"))
+        self.assertEqual(cache.lookup(self.vector(1), "third"), "third answer")
+
+    def test_pipeline_reuses_standalone_answers_only(self):
+        llm = ApprovingLLM()
+        pipeline = AnswerPipeline(
+            llm, config={"STREAM_RESPONSES": False}, answer_cache=AnswerCache()
+        )
+
+        def answer(fingerprint="report", history=()):
+            context = {
+                "documents": "Revenue grew 12% in Q3.",
+                "history": list(history),
+                "summary": "",
+                "question_vector": [1.0, 0.0],
+                "documents_fingerprint": fingerprint,
+            }
+            return async_to_sync(pipeline.answer)("How did revenue change?", context)
+
+        first = answer()
+        self.assertFalse(first.cached)
+        second = answer()
+        self.assertTrue(second.cached)
+        self.assertEqual(second.text, first.text)
+        # Another session's documents, or a follow-up in a conversation
+        self.assertFalse(answer(fingerprint="other report").cached)
+        self.assertFalse(answer(history=[HumanMessage(content="Hi")]).cached)
+        self.assertEqual(llm.calls, 3)
+
+
+class StreamingLLM(CountingLLM):
+    """Streams a scripted completion in the given chunks"""
+
+    def __init__(self, chunks):
+        super().__init__()
+        self.chunks = chunks
+        self.streamed = []
+
+    async def astream(self, prompt, **kwargs):
+        self.calls += 1
+        for chunk in self.chunks:
+            self.streamed.append(chunk)
+            yield chunk
+
+
+class ReviewerEarlyExitTests(SimpleTestCase):
+    documents = {"documents": "Q3 revenue grew 12%."}
+
+    def evaluate(self, llm, context):
+        reviewer = ReviewerAgent(llm, early_exit=True)
+        return async_to_sync(reviewer.evaluate_response)(
+            "Revenue grew 12%.", context, "How did revenue change?"
+        )
+
+    def test_is_decided(self):
+        reviewer = ReviewerAgent(None)
+        self.assertFalse(reviewer._is_decided({"relevance": True}, 3))
+        self.assertTrue(
+            reviewer._is_decided(
+                {"relevance": True, "context_usage": True, "coherence": True}, 3
+            )
+        )
+        # Three NOs leave two pending verdicts, short of the three required
+        self.assertTrue(
+            reviewer._is_decided(
+                {"relevance": False, "context_usage": False, "coherence": False}, 3
+            )
+        )
+        self.assertFalse(
+            reviewer._is_decided({"relevance": False, "context_usage": False}, 3)
+        )
+
+    def test_verdicts_split_across_chunks(self):
+        llm = StreamingLLM(["1. Y", "ES\n2", ". yes\n3.", " YES\n", "4. NO\n5. NO"])
+        review = self.evaluate(llm, self.documents)
+        self.assertEqual(review["status"], "approved")
+        self.assertEqual(review["score"], 3)
+        # Decided on the third verdict, the rest was never read
+        self.assertEqual(llm.streamed, llm.chunks[:4])
+
+    def test_missing_verdicts_count_as_no(self):
+        llm = StreamingLLM(["1. YES\n", "I cannot judge the rest."])
+        review = self.evaluate(llm, self.documents)
+        self.assertEqual(review["status"], "rejected")
+        self.assertEqual(review["score"], 1)
+        self.assertIn("Improve logical flow", review["feedback"])
+
+    def test_rejection_decided_early(self):
+        llm = StreamingLLM(["1. NO\n2. NO\n3. NO\n", "4. YES\n5. YES"])
+        review = self.evaluate(llm, self.documents)
+        self.assertEqual(review["status"], "rejected")
+        self.assertEqual(llm.streamed, llm.chunks[:1])
+
+    def test_decided_verdict_is_cached(self):
+        inner = StreamingLLM(["1. YES\n2. YES\n3. YES\n4.", " NO\n5. NO"])
+        llm = CachedLLM(inner, LLMCache())
+        with llm_request_context(priority=PRIORITY_REVIEWER):
+            first = self.evaluate(llm, self.documents)
+            second = self.evaluate(llm, self.documents)
+        self.assertEqual(inner.calls, 1)
+        self.assertEqual(first, second)
+        self.assertEqual(second["status"], "approved")
+
+
+class TrafficReplayTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.log = TrafficLog(f"{directory}/llm.jsonl.zst", flush_every=2)
+
+    def record(self):
+        """Two reviews of the same prompt and a streamed draft, recorded"""
+        llm = RecordingLLM(StreamingLLM(["Revenue ", "grew ", "12%."]), self.log)
+
+        async def scenario():
+            with llm_request_context(priority=PRIORITY_REVIEWER):
+                for _ in range(2):
+                    await llm.agenerate(["Review the answer"])
+            with llm_request_context(priority=PRIORITY_PRODUCER):
+                return [chunk async for chunk in llm.astream("Answer the question")]
+
+        chunks = async_to_sync(scenario)()
+        self.log.flush()
+        return chunks, list(read_traffic(self.log.path))
+
+    def test_records_are_read_back_in_order(self):
+        chunks, records = self.record()
+        self.assertEqual(chunks, ["Revenue ", "grew ", "12%."])
+        self.assertEqual(
+            [(record["kind"], record["completion"]) for record in records],
+            [
+                ("generate", "draft 1"),
+                ("generate", "draft 2"),
+                ("stream", "Revenue grew 12%."),
+            ],
+        )
+        self.assertEqual(records[2]["chunk_sizes"], [8, 5, 4])
+        self.assertTrue(records[2]["complete"])
+        self.assertEqual(records[0]["priority"], PRIORITY_REVIEWER)
+
+    def test_replay_serves_the_recorded_completions(self):
+        _, records = self.record()
+        replay = ReplayLLM(CountingLLM(), records, latency_scale=0, strict=True)
+
+        async def scenario():
+            reviews = [
+                (await replay.agenerate(["Review the answer"])).generations[0][0].text
+                for _ in range(2)
+            ]
+            chunks = [chunk async for chunk in replay.astream("Answer the question")]
+            return reviews, chunks
+
+        reviews, chunks = async_to_sync(scenario)()
+        # Repeated prompts get their recordings in order, chunked as streamed
+        self.assertEqual(reviews, ["draft 1", "draft 2"])
+        self.assertEqual(chunks, ["Revenue ", "grew ", "12%."])
+        self.assertEqual(replay.hits, 3)
+
+    def test_unrecorded_prompt(self):
+        _, records = self.record()
+
+        async def scenario(replay):
+            with llm_request_context(priority=PRIORITY_REVIEWER):
+                result = await replay.agenerate(["Review another answer"])
+            return result.generations[0][0].text
+
+        with self.assertRaises(ReplayMiss):
+            async_to_sync(scenario)(ReplayLLM(CountingLLM(), records, 0, strict=True))
+        # Unless strict, the next unused recording of the same priority
+        replay = ReplayLLM(CountingLLM(), records, latency_scale=0)
+        self.assertEqual(async_to_sync(scenario)(replay), "draft 1")
+        self.assertEqual(replay.fallbacks, 1)
+
+
+class PromptEvalReporterTests(SimpleTestCase):
+    def test_streamed_calls_calibrate_the_estimator(self):
+        estimator = TokenEstimator(chars_per_token=4.0, smoothing=0.5)
+        reporter = PromptEvalReporter()
+        run_id = uuid.uuid4()
+        # What BaseLLM.astream reports once the stream has finished
+        streamed = GenerationChunk(text="Hello") + GenerationChunk(
+            text=" there", generation_info={"prompt_eval_count": 100}
+        )
+
+        with mock.patch("chat.llm.client.estimator", estimator):
+            with track_prompt_eval() as stats:
+                reporter.on_llm_start({}, ["x" * 300], run_id=run_id)
+                reporter.on_llm_end(LLMResult(generations=[[streamed]]), run_id=run_id)
+        self.assertEqual(estimator.chars_per_token, 3.5)
+        self.assertEqual((stats.calls, stats.tokens), (1, 100))
+
+    def test_failed_calls_are_forgotten(self):
+        reporter = PromptEvalReporter()
+        run_id = uuid.uuid4()
+        reporter.on_llm_start({}, ["x" * 300], run_id=run_id)
+        reporter.on_llm_error(ValueError(), run_id=run_id)
+        self.assertEqual(reporter._prompts, {})
+
+
+class ProducerAgentTests(SimpleTestCase):
+    def test_layout_is_read_when_created(self):
+        llm = CountingLLM()
+        self.assertIs(ProducerAgent(llm).template, ProducerAgent.classic_template)
+        with self.settings(
+            AGENT_CONFIG={**settings.AGENT_CONFIG, "PROMPT_LAYOUT": "stable"}
+        ):
+            self.assertIs(ProducerAgent(llm).template, ProducerAgent.stable_template)
+            self.assertIs(
+                AnswerPipeline(llm).producer.template, ProducerAgent.template_for()
+            )
+        self.assertIs(
+            ProducerAgent(llm, layout="stable").template,
+            ProducerAgent.stable_template,
+        )
+
+    def test_stable_layout_ends_with_feedback_and_question(self):
+        producer = ProducerAgent(CountingLLM(), layout="stable")
+        context = {"history": [], "documents": "Revenue grew 12% in Q3."}
+        first = producer._build_prompt(context, "How did revenue change?", None)
+        retry = producer._build_prompt(context, "How did revenue change?", "Cite Q3.")
+        # Only the part from the feedback on differs, so the prefix is reused
+        prefix = first.index("Provide a natural conversational response")
+        self.assertEqual(first[:prefix], retry[:prefix])
+
+
+class ContextAssemblerTests(SimpleTestCase):
+    budget = {
+        "NUM_CTX": 200,
+        "RESERVED_OUTPUT": 50,
+        "RESERVED_FEEDBACK": 10,
+        "QUESTION": 20,
+        "DOCUMENTS_SHARE": 0.5,
+    }
+    question = "What changed in Q3?"  # 19 tokens, leaving 121 to share
+
+    def setUp(self):
+        # One character per token keeps the arithmetic readable
+        self.assembler = ContextAssembler(self.budget, TokenEstimator(1.0))
+
+    def excerpts(self, count):
+        """(title, text) excerpts that take 30 tokens each once formatted"""
+        overhead = len(format_document_chunk("A", ""))
+        return [("A", str(number) * (30 - overhead)) for number in range(count)]
+
+    def messages(self, count):
+        """Alternating history messages of 30 tokens each"""
+        return [
+            (HumanMessage if number % 2 else AIMessage)(content=str(number) * 28)
+            for number in range(count)
+        ]
+
+    def assemble(self, documents, history, question=None):
+        context = {"documents": documents, "history": history, "summary": ""}
+        return self.assembler.assemble(context, question or self.question)
+
+    def test_budget_is_split_between_documents_and_history(self):
+        documents, history = self.excerpts(3), self.messages(3)
+        context = self.assemble(documents, history)
+        # 60 of 121 tokens for each side: the best two excerpts and the two
+        # most recent messages
+        self.assertEqual(
+            context["documents"],
+            "".join(format_document_chunk(*excerpt) for excerpt in documents[:2]),
+        )
+        self.assertEqual(context["history"], history[1:])
+
+    def test_history_gets_the_room_documents_leave(self):
+        history = self.messages(4)
+        context = self.assemble(self.excerpts(1), history)
+        # 121 - 30 tokens of excerpts leave room for three messages
+        self.assertEqual(context["history"], history[1:])
+
+    def test_documents_get_the_room_history_leaves(self):
+        documents = self.excerpts(5)
+        context = self.assemble(documents, self.messages(1))
+        self.assertEqual(
+            context["documents"],
+            "".join(format_document_chunk(*excerpt) for excerpt in documents[:3]),
+        )
+
+    def test_summary_and_template_come_out_of_the_budget(self):
+        context = {"documents": self.excerpts(3), "history": [], "summary": "s" * 40}
+        kept = self.assembler.assemble(context, self.question, template="t" * 20)
+        # 121 - 40 - 20 tokens leave room for two excerpts
+        self.assertEqual(kept["documents"].count("Document 'A'"), 2)
+        self.assertEqual(kept["summary"], "s" * 40)
+
+    def test_oversized_question_keeps_its_end(self):
+        question = "Some background. " * 5 + "So what changed?"
+        context = self.assemble([], [], question)
+        self.assertEqual(context["question"], question[-20:])
+        self.assertTrue(context["question"].endswith("So what changed?"))
+
+
+class MessageWriterTests(TransactionTestCase):
+    def test_bad_row_fails_only_its_own_save(self):
+        session = ChatSession.objects.create()
+        deleted = ChatSession.objects.create()
+        writer = MessageWriter(flush_interval=0.01)
+        messages = [
+            Message(session=session, role="user", content="Hello"),
+            Message(session_id=deleted.id, role="user", content="Anyone there?"),
+            Message(session=session, role="assistant", content="Hi!"),
+        ]
+        deleted.delete()
+
+        async def scenario():
+            return await asyncio.gather(
+                *(writer.save(message) for message in messages),
+                return_exceptions=True,
+            )
+
+        results = async_to_sync(scenario)()
+        self.assertIsNone(results[0])
+        self.assertIsInstance(results[1], IntegrityError)
+        self.assertIsNone(results[2])
+        self.assertEqual(
+            list(Message.objects.values_list("content", flat=True)),
+            ["Hello", "Hi!"],
+        )
+
+    def test_flush_sync_writes_batches_whose_flush_never_ran(self):
+        session = ChatSession.objects.create()
+        writer = MessageWriter(flush_interval=60)
+
+        def never_run(flush):
+            flush.close()
+            return asyncio.get_running_loop().create_future()
+
+        async def scenario():
+            loop = asyncio.get_running_loop()
+            for content in ("Hello", "Hi!"):
+                writer._pending.append(
+                    (Message(session=session, role="user", content=content), None)
+                )
+            # A flush is started, but the loop stops before it runs
+            with mock.patch.object(loop, "create_task", never_run):
+                writer._start_flush()
+            writer._pending.append(
+                (Message(session=session, role="user", content="Bye"), None)
+            )
+
+        async_to_sync(scenario)()
+        writer.flush_sync()
+        self.assertEqual(Message.objects.count(), 3)
+
+
+@skipIf(connection.vendor != "sqlite", "SQLite FTS5 index")
+class SQLiteMessageIndexTests(TestCase):
+    def setUp(self):
+        self.backend = get_search_backend()
+        self.session = ChatSession.objects.create()
+        self.messages = [
+            Message.objects.create(session=self.session, role="user", content=text)
+            for text in ["How do I reset my password?", "Where is the report?"]
+        ]
+
+    def search(self, query):
+        return [message_id for message_id, _, _ in self.backend.search_messages(query)]
+
+    def execute(self, *statements):
+        with connection.cursor() as cursor:
+            for statement in statements:
+                cursor.execute(statement)
+
+    def test_index_survives_renumbered_rowids(self):
+        # What VACUUM may do to a table without an integer primary key
+        self.execute("UPDATE chat_message SET rowid = rowid + 1000")
+        self.assertEqual(self.search("password"), [self.messages[0].id])
+        self.assertEqual(
+            list(self.backend.filter_messages(Message.objects.all(), "report")),
+            [self.messages[1]],
+        )
+
+        Message.objects.filter(id=self.messages[0].id).update(content="New key")
+        self.messages[1].delete()
+        added = Message.objects.create(
+            session=self.session, role="user", content="The password again"
+        )
+        self.assertEqual(self.search("password"), [added.id])
+        self.assertEqual(self.search("key"), [self.messages[0].id])
+        self.assertEqual(self.search("report"), [])
+
+    def test_index_keyed_on_rowid_is_replaced(self):
+        # The index as installed by earlier versions, without its triggers
+        self.execute(
+            *(f"DROP TRIGGER {name}" for name in self.backend.MESSAGE_TRIGGERS),
+            "DROP TABLE chat_message_fts",
+            "DROP INDEX chat_message_search_rowid",
+            "ALTER TABLE chat_message DROP COLUMN search_rowid",
+            "CREATE VIRTUAL TABLE chat_message_fts USING fts5(content, "
+            "content='chat_message', tokenize='porter unicode61')",
+        )
+        self.backend.install()
+        self.execute("UPDATE chat_message SET rowid = rowid + 1000")
+        self.assertEqual(self.search("password"), [self.messages[0].id])
+
+
+class SearchViewTests(TestCase):
+    def setUp(self):
+        self.session = ChatSession.objects.create()
+        self.other = ChatSession.objects.create()
+        for session, text in [
+            (self.session, "How do I reset my password?"),
+            (self.other, "my secret password is hunter2"),
+        ]:
+            Message.objects.create(session=session, role="user", content=text)
+            self.add_document(session, f"The password policy. {text}")
+
+    def add_document(self, session, text):
+        content = DocumentContent.objects.create(
+            sha256=uuid.uuid4().hex, status=DocumentContent.STATUS_READY
+        )
+        chunk = DocumentChunk.objects.create(
+            content=content, index=0, text=text, embedding=b""
+        )
+        get_search_backend().index_chunks([(chunk.id, text)])
+        Document.objects.create(
+            session=session,
+            title="policy.pdf",
+            content=content,
+            status=Document.STATUS_READY,
+        )
+
+    def search(self, **params):
+        return self.client.get("/api/search/", params)
+
+    def test_search_is_scoped_to_the_session(self):
+        response = self.search(q="password", session=str(self.session.id))
+        self.assertEqual(response.status_code, 200)
+        messages = response.json()["messages"]
+        self.assertEqual(len(messages), 1)
+        self.assertEqual(messages[0]["session"], str(self.session.id))
+        self.assertIn("[password]", messages[0]["snippet"])
+        documents = response.json()["documents"]
+        self.assertEqual(len(documents), 1)
+        self.assertNotIn("hunter2", documents[0]["text"])
+        self.assertEqual(documents[0]["documents"][0]["session"], str(self.session.id))
+
+    def test_search_without_session_is_rejected(self):
+        response = self.search(q="password")
+        self.assertEqual(response.status_code, 403)
+        self.assertNotIn("hunter2", response.content.decode())
+
+    def test_admin_can_search_every_session(self):
+        admin = User.objects.create_user("admin", is_staff=True)
+        self.client.force_login(admin)
+        response = self.search(q="password", type="messages")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()["messages"]), 2)
+        self.assertNotIn("documents", response.json())
+
+    def test_invalid_requests(self):
+        session = str(self.session.id)
+        for params in [
+            {"q": "", "session": session},
+            {"q": "?!", "session": session},
+            {"q": "password", "session": session, "type": "files"},
+            {"q": "password", "session": "not-a-uuid"},
+            {"q": "password", "session": session, "limit": "ten"},
+            {"q": "password", "session": session, "limit": "0"},
+        ]:
+            with self.subTest(params=params):
+                self.assertEqual(self.search(**params).status_code, 400)
+
+
+class SessionMessagesViewTests(TestCase):
+    def setUp(self):
+        self.session = ChatSession.objects.create()
+        started = datetime.datetime(2026, 1, 1, tzinfo=datetime.timezone.utc)
+        self.messages = []
+        for number in range(5):
+            message = Message.objects.create(
+                session=self.session, role="user", content=f"message {number}"
+            )
+            # auto_now_add ignores a given value, so set it afterwards
+            message.created_at = started + datetime.timedelta(minutes=number)
+            Message.objects.filter(id=message.id).update(created_at=message.created_at)
+            self.messages.append(message)
+        self.url = f"/api/sessions/{self.session.id}/messages/"
+
+    def page(self, expected_status=200, headers=None, **params):
+        response = self.client.get(self.url, params, headers=headers or {})
+        self.assertEqual(response.status_code, expected_status)
+        return response
+
+    def contents(self, page):
+        return [message["content"] for message in page.json()["messages"]]
+
+    def test_cursor_round_trip(self):
+        message = self.messages[0]
+        cursor = encode_cursor(message.created_at, message.id)
+        self.assertNotIn("=", cursor)
+        self.assertEqual(decode_cursor(cursor), (message.created_at, message.id))
+        for cursor in ["", "not a cursor", encode_cursor(message.created_at, "x")]:
+            with self.subTest(cursor=cursor), self.assertRaises(ValueError):
+                decode_cursor(cursor)
+
+    def test_walk_backward_from_the_newest_page(self):
+        page = self.page(limit=2)
+        self.assertEqual(self.contents(page), ["message 3", "message 4"])
+        self.assertFalse(page.json()["has_newer"])
+
+        page = self.page(limit=2, before=page.json()["older"])
+        self.assertEqual(self.contents(page), ["message 1", "message 2"])
+        self.assertTrue(page.json()["has_newer"])
+
+        page = self.page(limit=2, before=page.json()["older"])
+        self.assertEqual(self.contents(page), ["message 0"])
+        self.assertIsNone(page.json()["older"])
+
+    def test_walk_forward(self):
+        first = self.messages[0]
+        page = self.page(limit=2, after=encode_cursor(first.created_at, first.id))
+        self.assertEqual(self.contents(page), ["message 1", "message 2"])
+        self.assertTrue(page.json()["has_newer"])
+
+        page = self.page(limit=2, after=page.json()["newer"])
+        self.assertEqual(self.contents(page), ["message 3", "message 4"])
+        self.assertFalse(page.json()["has_newer"])
+
+        # Nothing new yet: the cursor is handed back to poll with
+        cursor = page.json()["newer"]
+        page = self.page(limit=2, after=cursor)
+        self.assertEqual(self.contents(page), [])
+        self.assertEqual(page.json()["newer"], cursor)
+
+    def test_equal_timestamps_are_ordered_by_id(self):
+        created_at = self.messages[0].created_at
+        Message.objects.filter(session=self.session).update(created_at=created_at)
+        by_id = sorted(self.messages, key=lambda message: message.id)
+        expected = [message.content for message in by_id]
+
+        page = self.page(limit=2)
+        walked = self.contents(page)
+        while page.json()["older"]:
+            page = self.page(limit=2, before=page.json()["older"])
+            walked = self.contents(page) + walked
+        self.assertEqual(walked, expected)
+
+        cursor = encode_cursor(created_at, by_id[0].id)
+        page = self.page(limit=10, after=cursor)
+        self.assertEqual(self.contents(page), expected[1:])
+
+    def test_unchanged_page_is_not_modified(self):
+        page = self.page()
+        etag = page.headers["ETag"]
+        self.page(304, headers={"If-None-Match": etag})
+        Message.objects.create(session=self.session, role="user", content="new")
+        self.assertNotEqual(
+            self.page(headers={"If-None-Match": etag}).headers["ETag"], etag
+        )
+
+    def test_unknown_session(self):
+        self.url = f"/api/sessions/{uuid.uuid4()}/messages/"
+        self.page(404)
+
+    def test_invalid_requests(self):
+        cursor = encode_cursor(self.messages[0].created_at, self.messages[0].id)
+        for params in [
+            {"limit": "0"},
+            {"limit": "many"},
+            {"before": "not a cursor"},
+            {"before": cursor, "after": cursor},
+        ]:
+            with self.subTest(params=params):
+                self.page(400, **params)
+
+
+class ScriptedLLM:
+    """Stands in for the LLM chain in consumer tests: streams scripted drafts
+    word by word, reviews them with scripted verdicts and summarizes"""
+
+    model = "llama3.2"
+    temperature = 0.3
+
+    def __init__(self, drafts=("Revenue grew 12% in Q3.",), verdicts=()):
+        self.drafts = list(drafts)
+        self.verdicts = list(verdicts)  # Approval per review, then approve
+        self.prompts = []
+        self.hold = None  # An asyncio.Event drafts wait for, when set
+
+    def __getattr__(self, name):
+        if name in OPTION_FIELDS:
+            return None
+        raise AttributeError(name)
+
+    def complete(self, prompt):
+        if "Answer ONLY in this format" in prompt:
+            verdict = "YES" if not self.verdicts or self.verdicts.pop(0) else "NO"
+            return "\n".join(f"{number}. {verdict}" for number in range(1, 6))
+        if prompt.startswith("Update the running summary"):
+            return "The user asked about revenue."
+        return self.drafts.pop(0) if len(self.drafts) > 1 else self.drafts[0]
+
+    async def agenerate(self, prompts, **kwargs):
+        self.prompts.append(prompts[0])
+        if self.hold is not None:
+            await self.hold.wait()
+        text = self.complete(prompts[0])
+        return LLMResult(generations=[[Generation(text=text)]])
+
+    async def astream(self, prompt, **kwargs):
+        self.prompts.append(prompt)
+        if self.hold is not None:
+            await self.hold.wait()
+        words = self.complete(prompt).split(" ")
+        for index, word in enumerate(words):
+            yield word if index == len(words) - 1 else word + " "
+
+
+class ConsumerTestCase(TransactionTestCase):
+    """Runs ChatConsumer with a ScriptedLLM instead of Ollama"""
+
+    agent_config = {"STREAM_RESPONSES": True, "REVIEW_EARLY_EXIT": False}
+
+    def setUp(self):
+        self.llm = ScriptedLLM()
+        for patcher in [
+            mock.patch("chat.consumers.llm", self.llm),
+            mock.patch("chat.consumers.answer_cache", None),
+        ]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        agent_config = override_settings(
+            AGENT_CONFIG={**settings.AGENT_CONFIG, **self.agent_config}
+        )
+        agent_config.enable()
+        self.addCleanup(agent_config.disable)
+        self.session_id = str(uuid.uuid4())
+
+    async def connect(self, session_id=None):
+        communicator = WebsocketCommunicator(
+            ChatConsumer.as_asgi(),
+            f"/ws/chat/?session_id={session_id or self.session_id}",
+        )
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    async def frames_until(self, communicator, frame_type, timeout=5):
+        """Frames received up to and including the first of the given type"""
+        frames = []
+        while not frames or frames[-1]["type"] != frame_type:
+            frames.append(await communicator.receive_json_from(timeout=timeout))
+        return frames
+
+    async def ask(self, communicator, text="How did revenue change?"):
+        await communicator.send_json_to({"type": "message", "text": text})
+        return await self.frames_until(communicator, "message")
+
+
+class DeltaStreamingTests(ConsumerTestCase):
+    def test_deltas_add_up_to_the_answer(self):
+        async def scenario():
+            communicator = await self.connect()
+            frames = await self.ask(communicator)
+            await communicator.disconnect()
+            return frames
+
+        frames = async_to_sync(scenario)()
+        deltas = [frame for frame in frames if frame["type"] == "delta"]
+        self.assertEqual(
+            [delta["text"] for delta in deltas],
+            ["Revenue ", "grew ", "12% ", "in ", "Q3."],
+        )
+        self.assertTrue(all(delta["attempt"] == 0 for delta in deltas))
+        message = frames[-1]
+        self.assertEqual(message["message"], "Revenue grew 12% in Q3.")
+        self.assertEqual(
+            Message.objects.get(id=message["message_id"]).content, message["message"]
+        )
+
+    def test_rejected_draft_is_retracted(self):
+        self.llm.drafts = ["Revenue went somewhere.", "Revenue grew 12% in Q3."]
+        self.llm.verdicts = [False]
+
+        async def scenario():
+            communicator = await self.connect()
+            frames = await self.ask(communicator)
+            await communicator.disconnect()
+            return frames
+
+        frames = async_to_sync(scenario)()
+        rejected = [frame["type"] == "rejected" for frame in frames].index(True)
+        self.assertEqual(frames[rejected]["attempt"], 0)
+        drafts = [
+            "".join(
+                frame["text"]
+                for frame in part
+                if frame["type"] == "delta" and frame["attempt"] == attempt
+            )
+            for attempt, part in [(0, frames[:rejected]), (1, frames[rejected:])]
+        ]
+        self.assertEqual(drafts, ["Revenue went somewhere.", "Revenue grew 12% in Q3."])
+        self.assertEqual(frames[-1]["message"], "Revenue grew 12% in Q3.")
+
+    def test_no_deltas_without_streaming(self):
+        async def scenario():
+            communicator = await self.connect()
+            frames = await self.ask(communicator)
+            await communicator.disconnect()
+            return frames
+
+        with self.settings(
+            AGENT_CONFIG={**settings.AGENT_CONFIG, "STREAM_RESPONSES": False}
+        ):
+            frames = async_to_sync(scenario)()
+        self.assertNotIn("delta", [frame["type"] for frame in frames])
+        self.assertEqual(frames[-1]["message"], "Revenue grew 12% in Q3.")
+
+
+class SummaryTests(ConsumerTestCase):
+    agent_config = {
+        **ConsumerTestCase.agent_config,
+        "HISTORY_WINDOW": 2,
+        "SUMMARY_BATCH": 2,
+    }
+
+    def setUp(self):
+        super().setUp()
+        self.session = ChatSession.objects.create(id=self.session_id)
+        started = datetime.datetime(2026, 1, 1, tzinfo=datetime.timezone.utc)
+        self.messages = []
+        for number, role in enumerate(["user", "assistant"] * 2):
+            message = Message.objects.create(
+                session=self.session, role=role, content=f"earlier {number}"
+            )
+            message.created_at = started + datetime.timedelta(minutes=number)
+            Message.objects.filter(id=message.id).update(created_at=message.created_at)
+            self.messages.append(message)
+
+    def summary_prompts(self):
+        return [
+            prompt
+            for prompt in self.llm.prompts
+            if prompt.startswith("Update the running summary")
+        ]
+
+    async def ask_and_summarize(self, communicator, text):
+        await self.ask(communicator, text)
+        await asyncio.gather(*summary_tasks.values())
+        return await database_sync_to_async(ChatSession.objects.get)(id=self.session_id)
+
+    def test_messages_leaving_the_window_are_summarized_once(self):
+        async def scenario():
+            communicator = await self.connect()
+            sessions = [
+                await self.ask_and_summarize(communicator, "first question"),
+                await self.ask_and_summarize(communicator, "second question"),
+            ]
+            await communicator.disconnect()
+            return sessions
+
+        first, second = async_to_sync(scenario)()
+        first_prompt, second_prompt = self.summary_prompts()
+
+        # The seeded turns left the window, the new one is still in it
+        self.assertIn("No summary yet", first_prompt)
+        for message in self.messages:
+            self.assertIn(message.content, first_prompt)
+        self.assertNotIn("first question", first_prompt)
+        self.assertEqual(first.summary, "The user asked about revenue.")
+        self.assertEqual(first.summarized_until, self.messages[-1].created_at)
+
+        # Only the turn that left the window since is folded in
+        self.assertIn("The user asked about revenue.", second_prompt)
+        self.assertIn("first question", second_prompt)
+        self.assertNotIn("earlier 0", second_prompt)
+        self.assertNotIn("second question", second_prompt)
+        first_answer = Message.objects.filter(role="assistant").order_by("-created_at")[
+            1
+        ]
+        self.assertEqual(second.summarized_until, first_answer.created_at)
+
+        # The producer gets the summary instead of the summarized turns
+        draft = next(
+            prompt for prompt in self.llm.prompts if "second question" in prompt
+        )
+        self.assertIn("The user asked about revenue.", draft)
+        self.assertNotIn("earlier 0", draft)
+
+    def test_no_summary_while_the_history_fits_the_window(self):
+        async def scenario():
+            communicator = await self.connect()
+            session = await self.ask_and_summarize(communicator, "first question")
+            await communicator.disconnect()
+            return session
+
+        with self.settings(
+            AGENT_CONFIG={**settings.AGENT_CONFIG, "HISTORY_WINDOW": 10}
+        ):
+            session = async_to_sync(scenario)()
+        self.assertEqual(self.summary_prompts(), [])
+        self.assertIsNone(session.summarized_until)
+
+    def test_snapshot_counts_unsummarized_messages(self):
+        ChatSession.objects.filter(id=self.session.id).update(
+            summary="Earlier talk.", summarized_until=self.messages[1].created_at
+        )
+        snapshot = load_context_snapshot(self.session.id)
+        self.assertEqual(snapshot["summary"], "Earlier talk.")
+        self.assertEqual(snapshot["unsummarized"], 2)
+        self.assertEqual(
+            [message.content for message in snapshot["history"]],
+            ["earlier 2", "earlier 3"],
+        )
+
+
+class ContextSnapshotTests(ConsumerTestCase):
+    def test_other_connections_reload_after_a_turn(self):
+        loads = []
+
+        def load(session_id):
+            loads.append(session_id)
+            return load_context_snapshot(session_id)
+
+        async def scenario():
+            first, second = await self.connect(), await self.connect()
+            await self.ask(second, "question from second")
+            await self.ask(first, "question from first")
+            await self.ask(first, "follow-up from first")
+            loads_before = len(loads)
+            await self.ask(second, "follow-up from second")
+            await first.disconnect()
+            await second.disconnect()
+            return loads_before
+
+        with mock.patch(
+            "chat.consumers.load_context_snapshot", side_effect=load
+        ) as patched:
+            loads_before = async_to_sync(scenario)()
+
+        # Each connection loads once and keeps its snapshot across its own
+        # turns; the second reloads once the first saved a turn
+        self.assertEqual(loads_before, 2)
+        self.assertEqual(patched.call_count, 3)
+        draft = next(
+            prompt for prompt in self.llm.prompts if "follow-up from second" in prompt
+        )
+        self.assertIn("follow-up from first", draft)
+
+    def test_snapshot_is_updated_in_place(self):
+        async def scenario():
+            communicator = await self.connect()
+            await self.ask(communicator, "first question")
+            await self.ask(communicator, "second question")
+            await communicator.disconnect()
+
+        with mock.patch(
+            "chat.consumers.load_context_snapshot", side_effect=load_context_snapshot
+        ) as patched:
+            async_to_sync(scenario)()
+        self.assertEqual(patched.call_count, 1)
+        draft = next(
+            prompt for prompt in self.llm.prompts if "second question" in prompt
+        )
+        self.assertIn("first question", draft)
+
+
+class TurnCancellationTests(ConsumerTestCase):
+    async def start_turn(self, communicator, text):
+        """Send a message and wait until its draft is being generated"""
+        prompts = len(self.llm.prompts)
+        await communicator.send_json_to({"type": "message", "text": text})
+        while len(self.llm.prompts) == prompts:
+            await asyncio.sleep(0.01)
+
+    def saved_messages(self):
+        return list(
+            Message.objects.order_by("created_at").values_list("role", "content")
+        )
+
+    def test_cancel_stops_the_turn(self):
+        async def scenario():
+            self.llm.hold = asyncio.Event()
+            communicator = await self.connect()
+            await self.start_turn(communicator, "How did revenue change?")
+            await communicator.send_json_to({"type": "cancel"})
+            frames = await self.frames_until(communicator, "cancelled")
+            frames.append(await communicator.receive_json_from())
+            await communicator.disconnect()
+            return frames
+
+        frames = async_to_sync(scenario)()
+        self.assertEqual(frames[-1], {"type": "typing", "isTyping": False})
+        self.assertNotIn("message", [frame["type"] for frame in frames])
+        self.assertEqual(self.saved_messages(), [])
+
+    def test_disconnect_stops_the_turn(self):
+        async def scenario():
+            self.llm.hold = asyncio.Event()
+            communicator = await self.connect()
+            await self.start_turn(communicator, "How did revenue change?")
+            await communicator.disconnect()
+            # Had the turn survived, it would now draft, review and save
+            self.llm.hold.set()
+            await asyncio.sleep(0.1)
+
+        async_to_sync(scenario)()
+        self.assertEqual(len(self.llm.prompts), 1)
+        self.assertEqual(self.saved_messages(), [])
+
+    def test_new_message_supersedes_the_running_turn(self):
+        async def scenario():
+            self.llm.hold = asyncio.Event()
+            communicator = await self.connect()
+            await self.start_turn(communicator, "first question")
+            await communicator.send_json_to(
+                {"type": "message", "text": "second question"}
+            )
+            frames = await self.frames_until(communicator, "cancelled")
+            self.llm.hold.set()
+            frames += await self.frames_until(communicator, "message")
+            await communicator.disconnect()
+            return frames
+
+        with self.settings(
+            AGENT_CONFIG={**settings.AGENT_CONFIG, "SUPERSEDE_PREVIOUS_TURN": True}
+        ):
+            frames = async_to_sync(scenario)()
+        self.assertEqual(frames[-1]["message"], "Revenue grew 12% in Q3.")
+        self.assertEqual(
+            self.saved_messages(),
+            [("user", "second question"), ("assistant", "Revenue grew 12% in Q3.")],
+        )
+
+    def test_new_message_supersedes_turns_on_other_connections(self):
+        async def scenario():
+            self.llm.hold = asyncio.Event()
+            first, second = await self.connect(), await self.connect()
+            await self.start_turn(first, "first question")
+            await second.send_json_to({"type": "message", "text": "second question"})
+            frames = await self.frames_until(first, "cancelled")
+            self.llm.hold.set()
+            await self.frames_until(second, "message")
+            await first.disconnect()
+            await second.disconnect()
+            return frames
+
+        with self.settings(
+            AGENT_CONFIG={**settings.AGENT_CONFIG, "SUPERSEDE_PREVIOUS_TURN": True}
+        ):
+            frames = async_to_sync(scenario)()
+        self.assertNotIn("message", [frame["type"] for frame in frames])
+        self.assertEqual(
+            [content for role, content in self.saved_messages() if role == "user"],
+            ["second question"],
+        )
+
+
+class LoadTestTests(TransactionTestCase):
+    """The benchmark_chat load test, with uploads, against the fake Ollama"""
+
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        self.settings_overrides = {
+            "MEDIA_ROOT": media_root,
+            "LLM_CACHE": {**settings.LLM_CACHE, "ENABLED": False},
+            "LLM_SCHEDULER": {**settings.LLM_SCHEDULER, "REDIS_URL": None},
+            "RETRIEVAL_CONFIG": {
+                **settings.RETRIEVAL_CONFIG,
+                "EMBEDDER": "documents.retrieval.OllamaEmbedder",
+            },
+        }
+        # The embedder is created on first use, against the fake server
+        for patcher in [
+            mock.patch("documents.retrieval._embedder", None),
+            mock.patch.object(consumers, "answer_cache", None),
+        ]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_sessions_upload_and_chat(self):
+        fake = FakeOllama(token_rate=2000, latency=0, tokens=10)
+
+        async def scenario():
+            url = await fake.start()
+            try:
+                with self.settings(OLLAMA_BASE_URL=url, **self.settings_overrides):
+                    # Rebuild the chain so every agent talks to the fake server
+                    with mock.patch.object(consumers, "llm", consumers.build_llm()):
+                        load_test = LoadTest(
+                            sessions=2, messages=1, uploads=1, pages=2, timeout=5
+                        )
+                        return await load_test.run()
+            finally:
+                await fake.stop()
+
+        results = async_to_sync(scenario)()
+        self.assertEqual(results["errors"], 0)
+        self.assertEqual(results["stages"]["upload"]["count"], 1)
+        self.assertEqual(results["stages"]["turn"]["count"], 2)
+        self.assertEqual(Document.objects.get().status, Document.STATUS_READY)
@@ -1,7 +1,21 @@
+import base64
+import hashlib
+import uuid
+from datetime import datetime
+
+import orjson
+from django.db.models import Q
+from django.http import HttpResponse, HttpResponseNotModified
+from django.utils.http import parse_etags
+from documents.retrieval import search_documents
 from rest_framework import status
 from rest_framework.response import Response
 from rest_framework.views import APIView
 
+from . import metrics
+from .models import ChatSession, Message
+from .permissions import SessionScoped
+from .search import get_search_backend, query_terms
 from .serializers import FeedbackSerializer
 
 # Create your views here.
@@ -17,3 +31,183 @@ class FeedbackView(APIView):
                 status=status.HTTP_201_CREATED,
             )
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+
+class SearchView(APIView):
+    """Ranked full-text search over the messages and document excerpts of a
+    session.
+
+    GET /api/search/?q=<words>&session=<id>[&type=messages|documents][&limit=20]
+
+    Only admin users may leave the session out to search every session.
+    """
+
+    permission_classes = [SessionScoped]
+    MAX_LIMIT = 100
+
+    def get(self, request):
+        query = request.query_params.get("q", "")
+        if not query_terms(query):
+            return Response(
+                {"error": "Query has no words to search for"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        kind = request.query_params.get("type")
+        if kind not in (None, "messages", "documents"):
+            return Response(
+                {"error": "type must be messages or documents"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        session_id = request.query_params.get("session")
+        try:
+            if session_id:
+                session_id = uuid.UUID(session_id)
+            limit = int(request.query_params.get("limit", 20))
+            if limit < 1:
+                raise ValueError("limit must be positive")
+        except ValueError:
+            return Response(
+                {"error": "Invalid session or limit"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        limit = min(limit, self.MAX_LIMIT)
+
+        result = {"query": query}
+        if kind in (None, "messages"):
+            result["messages"] = self.search_messages(query, session_id, limit)
+        if kind in (None, "documents"):
+            result["documents"] = search_documents(query, session_id, limit)
+        return Response(result)
+
+    def search_messages(self, query, session_id, limit):
+        hits = get_search_backend().search_messages(query, session_id, limit)
+        messages = Message.objects.in_bulk([message_id for message_id, _, _ in hits])
+        return [
+            {
+                "id": message_id,
+                "session": messages[message_id].session_id,
+                "role": messages[message_id].role,
+                "created_at": messages[message_id].created_at,
+                "snippet": snippet,
+                "score": score,
+            }
+            for message_id, score, snippet in hits
+            if message_id in messages
+        ]
+
+
+def encode_cursor(created_at, message_id):
+    value = f"{created_at.isoformat()}|{message_id}".encode()
+    return base64.urlsafe_b64encode(value).decode().rstrip("=")
+
+
+def decode_cursor(cursor):
+    """Return (created_at, message id); raises ValueError if malformed"""
+    try:
+        value = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        created_at, message_id = value.split("|")
+        return datetime.fromisoformat(created_at), uuid.UUID(message_id)
+    except ValueError:  # Also covers base64 and UTF-8 errors
+        raise ValueError("Invalid cursor")
+
+
+class SessionMessagesView(APIView):
+    """A page of a session's history, oldest first.
+
+    GET /api/sessions/<id>/messages/[?limit=50][&before=<cursor>|&after=<cursor>]
+
+    Without a cursor the newest page is returned. `older` is the cursor for
+    the page before (null at the start of the session) and `newer` the one
+    for messages after this page; `has_newer` tells whether any exist yet.
+    Pages are keyset-paginated on (session, created_at, id), so every page
+    costs the same however long the session is. Responses carry an ETag and
+    honor If-None-Match.
+    """
+
+    permission_classes = [SessionScoped]
+    DEFAULT_LIMIT = 50
+    MAX_LIMIT = 200
+
+    def get(self, request, session_id):
+        try:
+            limit = int(request.query_params.get("limit", self.DEFAULT_LIMIT))
+            if limit < 1:
+                raise ValueError("limit must be positive")
+            before = request.query_params.get("before")
+            after = request.query_params.get("after")
+            if before and after:
+                raise ValueError("Pass before or after, not both")
+            cursor = decode_cursor(before or after) if before or after else None
+        except ValueError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        limit = min(limit, self.MAX_LIMIT)
+
+        messages = Message.objects.filter(session_id=session_id)
+        if cursor:
+            created_at, message_id = cursor
+            if after:
+                messages = messages.filter(
+                    Q(created_at__gt=created_at)
+                    | Q(created_at=created_at, id__gt=message_id)
+                )
+            else:
+                messages = messages.filter(
+                    Q(created_at__lt=created_at)
+                    | Q(created_at=created_at, id__lt=message_id)
+                )
+        if after:
+            messages = messages.order_by("created_at", "id")
+        else:
+            messages = messages.order_by("-created_at", "-id")
+
+        # One extra row tells whether another page follows
+        rows = list(
+            messages.values_list("id", "role", "content", "created_at")[: limit + 1]
+        )
+        more = len(rows) > limit
+        rows = rows[:limit]
+        if not after:
+            rows.reverse()
+        if not rows and not ChatSession.objects.filter(id=session_id).exists():
+            return Response(
+                {"error": "Session not found"}, status=status.HTTP_404_NOT_FOUND
+            )
+
+        older, newer = None, after
+        if rows:
+            first, last = rows[0], rows[-1]
+            # Pages fetched with after= always follow older messages
+            if more or after:
+                older = encode_cursor(first[3], first[0])
+            newer = encode_cursor(last[3], last[0])
+        payload = {
+            "session": session_id,
+            "messages": [
+                {"id": id_, "role": role, "content": content, "created_at": created_at}
+                for id_, role, content, created_at in rows
+            ],
+            "older": older,
+            "newer": newer,
+            "has_newer": more if after else bool(before and rows),
+        }
+        body = orjson.dumps(payload)
+        etag = f'"{hashlib.blake2b(body, digest_size=16).hexdigest()}"'
+
+        if_none_match = request.headers.get("If-None-Match")
+        if if_none_match and (
+            etag in parse_etags(if_none_match) or if_none_match.strip() == "*"
+        ):
+            response = HttpResponseNotModified()
+        else:
+            response = HttpResponse(body, content_type="application/json")
+        response["ETag"] = etag
+        # Clients may keep pages but must check with the server before reuse
+        response["Cache-Control"] = "private, no-cache"
+        return response
+
+
+def metrics_view(request):
+    """Prometheus scrape endpoint for this worker's counters and histograms"""
+    return HttpResponse(
+        metrics.render(), content_type="text/plain; version=0.0.4; charset=utf-8"
+    )
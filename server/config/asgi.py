@@ -9,6 +9,8 @@ os.environ.setdefault("DJANGO_SETTINGS_MODULE", "config.settings")
 
 django_asgi_app = get_asgi_application()
 
+from chat.lifespan import lifespan_app
+from chat.llm.client import start_warmup
 from chat.routing import websocket_urlpatterns
 
 application = ProtocolTypeRouter(
@@ -17,5 +19,9 @@ application = ProtocolTypeRouter(
         "websocket": AllowedHostsOriginValidator(
             AuthMiddlewareStack(URLRouter(websocket_urlpatterns))
         ),
+        "lifespan": lifespan_app,
     }
 )
+
+# Daphne sends no lifespan events, so the warmup is started on import too
+start_warmup()
@@ -61,8 +61,24 @@ TEMPLATES = [
 WSGI_APPLICATION = "config.wsgi.application"
 ASGI_APPLICATION = "config.asgi.application"
 
+# Redis enables multi-worker mode: group events, the LLM cache and the
+# scheduler's concurrency cap are shared by every Daphne process
+REDIS_URL = os.environ.get("REDIS_URL")
+if not REDIS_URL and os.environ.get("REDIS_HOST"):
+    REDIS_URL = (
+        f"redis://{os.environ['REDIS_HOST']}:{os.environ.get('REDIS_PORT', 6379)}/0"
+    )
+
 # Channels configuration
-CHANNEL_LAYERS = {"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}}
+if REDIS_URL:
+    CHANNEL_LAYERS = {
+        "default": {
+            "BACKEND": "channels_redis.core.RedisChannelLayer",
+            "CONFIG": {"hosts": [REDIS_URL]},
+        }
+    }
+else:
+    CHANNEL_LAYERS = {"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}}
 
 # Database
 DATABASES = {
@@ -111,12 +127,156 @@ CORS_ALLOW_ALL_ORIGINS = True
 # Add Ollama settings
 OLLAMA_BASE_URL = "http://localhost:11434"
 
+# HTTP connection pool, timeouts and model keep_alive shared by the Ollama
+# clients. With WARMUP, the chat model is loaded at server startup.
+OLLAMA_CLIENT = {
+    "CONNECT_TIMEOUT": 5.0,
+    "READ_TIMEOUT": 300.0,  # Long generations queued behind others
+    "MAX_CONNECTIONS": 16,
+    "MAX_KEEPALIVE_CONNECTIONS": 8,
+    "KEEPALIVE_EXPIRY": 60.0,
+    "KEEP_ALIVE": "30m",  # How long Ollama keeps the model in memory
+    "WARMUP": True,
+    "WARMUP_PROMPT": "Hello",
+}
+
+# Document retrieval: chunks are embedded at upload and the top-k are
+# selected per question, so prompt size does not grow with uploads
+RETRIEVAL_CONFIG = {
+    "EMBEDDER": "documents.retrieval.OllamaEmbedder",
+    "EMBEDDING_MODEL": "nomic-embed-text",
+    "CHUNK_SIZE": 1000,
+    "CHUNK_OVERLAP": 150,
+    "TOP_K": 4,
+    # "lexical" ranks chunks with the full-text index (chat.search) instead,
+    # with no embedding request per question
+    "RETRIEVER": "embedding",
+    # Session indexes kept in memory per worker; the least recently used
+    # are dropped and rebuilt from the stored embeddings when asked again
+    "MAX_SESSION_INDEXES": 256,
+}
+
 # Maximum upload file size: 10MB
 DATA_UPLOAD_MAX_MEMORY_SIZE = 10 * 1024 * 1024
 FILE_UPLOAD_MAX_MEMORY_SIZE = 10 * 1024 * 1024
 
+# LLM response cache: in-process LRU plus an optional diskcache tier,
+# keyed on model, temperature and the normalized prompt
+LLM_CACHE = {
+    "ENABLED": True,
+    "MAX_ENTRIES": 1024,
+    "TTL": 60 * 60,
+    "DISK_DIRECTORY": BASE_DIR / "cache" / "llm",  # None disables the disk tier
+    "DISK_SIZE_LIMIT": 256 * 1024 * 1024,
+    "REDIS_URL": REDIS_URL,  # Shared tier between workers
+    # Producer drafts are sampled, and a retry repeating its previous prompt
+    # would get the rejected draft back, so only reviewer and summarizer
+    # calls are cached unless this is set
+    "CACHE_PRODUCER": False,
+}
+
+# Opt-in semantic answer cache: approved answers are reused when a question
+# about the same set of documents embeds within THRESHOLD cosine similarity
+# of a cached one. STANDALONE_ONLY limits it to questions asked without
+# prior conversation, whose meaning does not depend on the session.
+ANSWER_CACHE = {
+    "ENABLED": False,
+    "MAX_ENTRIES": 2048,
+    "THRESHOLD": 0.92,
+    "TTL": 24 * 60 * 60,
+    "STANDALONE_ONLY": True,
+    "MARK_CACHED": True,  # Add "cached": true to message frames
+}
+
+# Ollama request scheduler: concurrency cap, per-session round-robin and
+# queue-depth limits for every LLM call
+LLM_SCHEDULER = {
+    "MAX_CONCURRENCY": 2,
+    "MAX_QUEUE_DEPTH": 64,
+    "MAX_SESSION_QUEUE_DEPTH": 4,
+    # With Redis, a cluster-wide cap on top of each worker's MAX_CONCURRENCY
+    "REDIS_URL": REDIS_URL,
+    "GLOBAL_MAX_CONCURRENCY": 4,
+    "LEASE_TTL": 120,
+}
+
+# Record every Ollama call (prompt, options, completion, timings) to a
+# zstd-compressed JSONL log, or answer from such a log instead of Ollama.
+# LLM_TRAFFIC_MODE=record or replay; replay latencies are the recorded ones
+# times LATENCY_SCALE, 0 re-runs conversations at full speed.
+LLM_TRAFFIC = {
+    "MODE": os.environ.get("LLM_TRAFFIC_MODE"),
+    "LOG_PATH": os.environ.get(
+        "LLM_TRAFFIC_LOG", BASE_DIR / "traffic" / "llm.jsonl.zst"
+    ),
+    "COMPRESSION_LEVEL": 10,
+    "FLUSH_EVERY": 32,  # Records per compressed frame
+    "LATENCY_SCALE": float(os.environ.get("LLM_TRAFFIC_LATENCY_SCALE", 1.0)),
+    # Replay: fail on an unrecorded prompt instead of serving the next unused
+    # recording of the same kind (producer, reviewer, ...)
+    "STRICT": False,
+}
+
+# Token budget for producer prompts; the estimate is calibrated against the
+# prompt_eval_count Ollama reports. Not opt-in: without a budget Ollama
+# silently cuts prompts longer than num_ctx, often losing the question.
+# NUM_CTX must match num_ctx in chat.pipeline.create_llm.
+CONTEXT_BUDGET = {
+    "NUM_CTX": 4096,
+    "RESERVED_OUTPUT": 768,
+    "RESERVED_FEEDBACK": 128,
+    "QUESTION": 512,
+    "DOCUMENTS_SHARE": 0.6,
+    "CHARS_PER_TOKEN": 3.8,
+}
+
+# Write-behind message persistence: rows from all consumers are committed
+# together every FLUSH_INTERVAL seconds or MAX_BATCH rows
+MESSAGE_WRITER = {
+    "FLUSH_INTERVAL": 0.005,
+    "MAX_BATCH": 100,
+}
+
+# Background PDF extraction: pages are split across a bounded process pool
+DOCUMENT_PIPELINE = {
+    "MAX_WORKERS": 2,
+    "MAX_CONCURRENT_DOCUMENTS": 2,
+    "PAGES_PER_TASK": 25,
+}
+
+# Extracted page and chunk text is stored zstd-compressed. With
+# USE_DICTIONARY, new rows use the newest dictionary trained with
+# `manage.py train_text_dictionary`, which suits short pages and chunks
+DOCUMENT_STORAGE = {
+    "COMPRESSION_LEVEL": 10,
+    "USE_DICTIONARY": True,
+}
+
 AGENT_CONFIG = {
     "MAX_RETRIES": 3,
+    # Stream producer tokens to the client as "delta" frames
+    "STREAM_RESPONSES": True,
+    # Opt-in: race this many producer candidates and keep the first approved
+    # one (0 disables; drafts are not streamed in this mode)
+    "HEDGED_CANDIDATES": 0,
+    "HEDGED_TEMPERATURE_STEP": 0.2,
+    # Opt-in: stop streaming the review once the verdict is decided, and cap
+    # reviewer output at this many tokens (None leaves it uncapped, e.g. 32)
+    "REVIEW_EARLY_EXIT": False,
+    "REVIEW_MAX_TOKENS": None,
+    # Cancel a session's running turn when a newer message arrives, instead
+    # of answering both in order
+    "SUPERSEDE_PREVIOUS_TURN": False,
+    # "classic" is the original layout with the feedback in the middle.
+    # Opt-in: "stable" keeps the prompt prefix (instructions, documents,
+    # history) identical across retries so Ollama reuses its KV cache
+    "PROMPT_LAYOUT": "classic",
+    # Recent messages sent verbatim; older ones are folded into a rolling
+    # per-session summary in the background, SUMMARY_BATCH at a time
+    "HISTORY_WINDOW": 5,
+    "SUMMARY_BATCH": 4,
+    "SUMMARY_MAX_BATCH": 20,
+    "SUMMARY_MAX_WORDS": 200,
     "REVIEW_ASPECTS": [
         "relevance",
         "context_usage",
@@ -124,3 +284,28 @@ AGENT_CONFIG = {
         "instruction_adherence",
     ],
 }
+
+# Level-gated logging for the chat and documents apps. Prompts and model
+# output are only logged at DEBUG, set CHAT_LOG_LEVEL=DEBUG to see them.
+LOGGING = {
+    "version": 1,
+    "disable_existing_loggers": False,
+    "formatters": {
+        "structured": {
+            "format": "%(asctime)s level=%(levelname)s logger=%(name)s %(message)s",
+        },
+    },
+    "handlers": {
+        "console": {"class": "logging.StreamHandler", "formatter": "structured"},
+    },
+    "loggers": {
+        "chat": {
+            "handlers": ["console"],
+            "level": os.environ.get("CHAT_LOG_LEVEL", "INFO"),
+        },
+        "documents": {
+            "handlers": ["console"],
+            "level": os.environ.get("CHAT_LOG_LEVEL", "INFO"),
+        },
+    },
+}
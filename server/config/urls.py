@@ -1,4 +1,4 @@
-from chat.views import FeedbackView
+from chat.views import FeedbackView, SearchView, SessionMessagesView, metrics_view
 from django.conf import settings
 from django.conf.urls.static import static
 from django.contrib import admin
@@ -8,6 +8,13 @@ urlpatterns = [
     path("admin/", admin.site.urls),
     path("api/", include("documents.urls")),
     path("api/feedback/", FeedbackView.as_view(), name="feedback"),
+    path("api/search/", SearchView.as_view(), name="search"),
+    path(
+        "api/sessions/<uuid:session_id>/messages/",
+        SessionMessagesView.as_view(),
+        name="session-messages",
+    ),
+    path("metrics", metrics_view, name="metrics"),
 ]
 
 if settings.DEBUG:
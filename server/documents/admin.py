@@ -1,12 +1,27 @@
+from chat.search import get_search_backend
 from django.contrib import admin
+from django.db.models import Q
+from django.db.models.expressions import RawSQL
 from .models import Document
 
 @admin.register(Document)
 class DocumentAdmin(admin.ModelAdmin):
     list_display = ('id', 'title', 'session', 'uploaded_at', 'has_content')
     list_filter = ('uploaded_at',)
-    search_fields = ('title', 'content')
-    
+    search_fields = ('title',)
+    list_select_related = ('content',)
+    raw_id_fields = ('content',)
+
+    def get_search_results(self, request, queryset, search_term):
+        # Titles, plus the extracted text through the full-text index
+        if not search_term:
+            return queryset, False
+        matches = Q(title__icontains=search_term)
+        chunk_match = get_search_backend().chunk_match_sql(search_term)
+        if chunk_match:
+            matches |= Q(content_id__in=RawSQL(*chunk_match))
+        return queryset.filter(matches), False
+
     @admin.display(boolean=True, description='Has extracted content')
     def has_content(self, obj):
-        return bool(obj.content)
\ No newline at end of file
+        return obj.content.page_count > 0
\ No newline at end of file
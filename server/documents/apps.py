@@ -1,5 +1,13 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_delete
 
 class DocumentsConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
-    name = 'documents'
\ No newline at end of file
+    name = 'documents'
+
+    def ready(self):
+        from .models import Document
+        from .pipeline import release_content
+
+        # Uploads share content rows, deleted with the last document using them
+        post_delete.connect(release_content, sender=Document)
@@ -0,0 +1,104 @@
+"""zstd compression for extracted document text.
+
+Text is compressed with the newest TextDictionary when
+DOCUMENT_STORAGE["USE_DICTIONARY"] is set; every frame names the dictionary
+it was written with, so older dictionaries keep decompressing their rows.
+A process picks the newest dictionary once, so servers use a freshly
+trained one after a restart.
+"""
+
+import threading
+
+import zstandard
+from django.conf import settings
+from django.db import models
+
+_lock = threading.Lock()
+_dictionaries = {}  # dict_id -> ZstdCompressionDict
+_newest_id = None  # 0: compress without a dictionary
+_local = threading.local()  # zstd (de)compressors are not thread-safe
+
+
+def _dictionary(dict_id):
+    from .models import TextDictionary
+
+    with _lock:
+        dictionary = _dictionaries.get(dict_id)
+        if dictionary is None:
+            data = TextDictionary.objects.get(dict_id=dict_id).data
+            dictionary = zstandard.ZstdCompressionDict(bytes(data))
+            _dictionaries[dict_id] = dictionary
+        return dictionary
+
+
+def _newest_dictionary_id():
+    from .models import TextDictionary
+
+    global _newest_id
+    with _lock:
+        if _newest_id is None:
+            _newest_id = 0
+            if settings.DOCUMENT_STORAGE["USE_DICTIONARY"]:
+                newest = TextDictionary.objects.order_by("-created_at").first()
+                if newest is not None:
+                    _newest_id = newest.dict_id
+        return _newest_id
+
+
+def reset_dictionaries():
+    """Forget loaded dictionaries, e.g. after training a new one"""
+    global _newest_id
+    with _lock:
+        _dictionaries.clear()
+        _newest_id = None
+    _local.__dict__.clear()
+
+
+def _codec(kind, dict_id):
+    codecs = _local.__dict__.setdefault(kind, {})
+    codec = codecs.get(dict_id)
+    if codec is None:
+        dictionary = _dictionary(dict_id) if dict_id else None
+        if kind == "compressor":
+            codec = zstandard.ZstdCompressor(
+                level=settings.DOCUMENT_STORAGE["COMPRESSION_LEVEL"],
+                dict_data=dictionary,
+            )
+        else:
+            codec = zstandard.ZstdDecompressor(dict_data=dictionary)
+        codecs[dict_id] = codec
+    return codec
+
+
+def compress_text(text):
+    return _codec("compressor", _newest_dictionary_id()).compress(text.encode())
+
+
+def decompress_text(data):
+    if not data:
+        return ""
+    data = bytes(data)
+    dict_id = zstandard.get_frame_parameters(data).dict_id
+    return _codec("decompressor", dict_id).decompress(data).decode()
+
+
+class CompressedTextField(models.BinaryField):
+    """A text field stored as a zstd frame; reads and writes str"""
+
+    def from_db_value(self, value, expression, connection):
+        if value is None:
+            return value
+        return decompress_text(value)
+
+    def to_python(self, value):
+        if value is None or isinstance(value, str):
+            return value
+        return decompress_text(value)
+
+    def get_db_prep_value(self, value, connection, prepared=False):
+        if isinstance(value, str):
+            value = compress_text(value)
+        return super().get_db_prep_value(value, connection, prepared)
+
+    def value_to_string(self, obj):
+        return self.value_from_object(obj)
@@ -0,0 +1,21 @@
+"""PDF text extraction helpers run inside the extraction process pool.
+
+This module must stay free of Django imports so that spawned worker
+processes can import it without configuring settings.
+"""
+
+import PyPDF2
+
+
+def count_pages(file_path):
+    with open(file_path, "rb") as pdf_file:
+        return len(PyPDF2.PdfReader(pdf_file).pages)
+
+
+def extract_page_range(file_path, start, stop):
+    """Return the text of pages [start, stop) as a list of strings"""
+    with open(file_path, "rb") as pdf_file:
+        reader = PyPDF2.PdfReader(pdf_file)
+        return [
+            reader.pages[number].extract_text() or "" for number in range(start, stop)
+        ]
@@ -0,0 +1,73 @@
+from datetime import timedelta
+
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from documents.models import DocumentContent
+from documents.pipeline import delete_orphaned_contents
+
+UPLOAD_DIRECTORY = "documents"
+
+
+class Command(BaseCommand):
+    help = (
+        "Delete stored contents no document uses any more, with their pages, "
+        "chunks and files, and PDF files no content refers to, such as the "
+        "duplicates merged when contents were introduced."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--pending",
+            action="store_true",
+            help="Also delete unused contents still marked pending, e.g. left "
+            "behind by a crash; only safe while no upload is being processed",
+        )
+        parser.add_argument(
+            "--min-age",
+            type=int,
+            default=60,
+            help="Minutes a file must be untouched before it is deleted, so "
+            "uploads being saved are left alone",
+        )
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="List what would be deleted without deleting it",
+        )
+
+    def handle(self, *args, **options):
+        if options["dry_run"]:
+            orphans = DocumentContent.objects.filter(documents__isnull=True)
+            if not options["pending"]:
+                orphans = orphans.exclude(status=DocumentContent.STATUS_PENDING)
+            for sha256 in orphans.values_list("sha256", flat=True):
+                self.stdout.write(f"Unused content {sha256}")
+        else:
+            deleted = delete_orphaned_contents(pending=options["pending"])
+            self.stdout.write(f"Deleted {deleted} unused contents")
+
+        cutoff = timezone.now() - timedelta(minutes=options["min_age"])
+        referenced = set(DocumentContent.objects.values_list("file", flat=True))
+        stray = 0
+        for name in self.stored_files(UPLOAD_DIRECTORY):
+            if name in referenced or default_storage.get_modified_time(name) > cutoff:
+                continue
+            stray += 1
+            if options["dry_run"]:
+                self.stdout.write(f"Unreferenced file {name}")
+            else:
+                default_storage.delete(name)
+        if not options["dry_run"]:
+            self.stdout.write(f"Deleted {stray} unreferenced files")
+
+    def stored_files(self, directory):
+        try:
+            directories, files = default_storage.listdir(directory)
+        except FileNotFoundError:
+            return
+        for name in files:
+            yield f"{directory}/{name}"
+        for name in directories:
+            yield from self.stored_files(f"{directory}/{name}")
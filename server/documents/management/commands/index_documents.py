@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from documents.retrieval import index_unindexed_contents
+
+
+class Command(BaseCommand):
+    help = (
+        "Chunk and embed the documents extracted before chunking was "
+        "introduced, so retrieval finds them. Run it once after upgrading."
+    )
+
+    def handle(self, *args, **options):
+        count = index_unindexed_contents()
+        self.stdout.write(f"Indexed {count} contents")
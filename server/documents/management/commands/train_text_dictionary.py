@@ -0,0 +1,77 @@
+import zstandard
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Sum
+from django.db.models.functions import Length
+
+from documents.compression import reset_dictionaries
+from documents.models import DocumentChunk, DocumentPage, TextDictionary
+
+BATCH_SIZE = 500
+
+
+class Command(BaseCommand):
+    help = (
+        "Train a zstd dictionary on stored page and chunk text. New text is "
+        "compressed with it once servers restart; --recompress rewrites the "
+        "existing rows with it now."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--size", type=int, default=112640, help="Dictionary size in bytes"
+        )
+        parser.add_argument(
+            "--samples",
+            type=int,
+            default=5000,
+            help="Pages and chunks, each, sampled for training",
+        )
+        parser.add_argument(
+            "--recompress",
+            action="store_true",
+            help="Rewrite all stored text with the new dictionary",
+        )
+
+    def handle(self, *args, **options):
+        samples = [
+            text.encode()
+            for model in (DocumentPage, DocumentChunk)
+            for text in model.objects.order_by("?").values_list("text", flat=True)[
+                : options["samples"]
+            ]
+            if text
+        ]
+        try:
+            dictionary = zstandard.train_dictionary(options["size"], samples)
+        except zstandard.ZstdError as e:
+            raise CommandError(f"Training on {len(samples)} samples failed: {e}")
+
+        # The id derives from the content, so retraining on the same text
+        # gives the dictionary already stored
+        TextDictionary.objects.get_or_create(
+            dict_id=dictionary.dict_id(), defaults={"data": dictionary.as_bytes()}
+        )
+        reset_dictionaries()
+        self.stdout.write(
+            f"Trained dictionary {dictionary.dict_id()} on {len(samples)} samples"
+        )
+
+        if options["recompress"]:
+            for model in (DocumentPage, DocumentChunk):
+                before = self.stored_bytes(model)
+                self.recompress(model)
+                self.stdout.write(
+                    f"{model.__name__}: {before} -> {self.stored_bytes(model)} bytes"
+                )
+
+    def stored_bytes(self, model):
+        return model.objects.aggregate(size=Sum(Length("text")))["size"] or 0
+
+    def recompress(self, model):
+        batch = []
+        for row in model.objects.only("id", "text").iterator(chunk_size=BATCH_SIZE):
+            batch.append(row)  # Read as str, so saving compresses again
+            if len(batch) >= BATCH_SIZE:
+                model.objects.bulk_update(batch, ["text"])
+                batch.clear()
+        model.objects.bulk_update(batch, ["text"])
@@ -0,0 +1,66 @@
+# Generated by Django 5.1.6 on 2026-10-18 04:04
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def move_content_to_pages(apps, schema_editor):
+    """Store legacy single-blob content as the first page of each document"""
+    Document = apps.get_model("documents", "Document")
+    DocumentPage = apps.get_model("documents", "DocumentPage")
+    for document in Document.objects.exclude(content="").iterator():
+        DocumentPage.objects.create(document=document, number=1, text=document.content)
+        document.page_count = 1
+        document.save(update_fields=["page_count"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("documents", "0003_document_status"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="document",
+            name="page_count",
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.CreateModel(
+            name="DocumentPage",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("number", models.PositiveIntegerField()),
+                ("text", models.TextField(blank=True)),
+                (
+                    "document",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="pages",
+                        to="documents.document",
+                    ),
+                ),
+            ],
+            options={
+                "ordering": ["document", "number"],
+                "constraints": [
+                    models.UniqueConstraint(
+                        fields=("document", "number"), name="unique_document_page"
+                    )
+                ],
+            },
+        ),
+        migrations.RunPython(move_content_to_pages, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name="document",
+            name="content",
+        ),
+    ]
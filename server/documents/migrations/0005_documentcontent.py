@@ -0,0 +1,209 @@
+# Generated by Django 5.1.6 on 2026-10-18 09:12
+
+import hashlib
+
+import django.db.models.deletion
+import documents.models
+from django.db import migrations, models
+
+
+def file_sha256(document):
+    digest = hashlib.sha256()
+    try:
+        with document.file.open("rb") as upload:
+            for chunk in upload.chunks():
+                digest.update(chunk)
+    except (OSError, ValueError):
+        # The file is gone, keep the document on its own content row
+        return hashlib.sha256(f"missing:{document.id}".encode()).hexdigest()
+    return digest.hexdigest()
+
+
+def file_size(document):
+    try:
+        return document.file.size
+    except (OSError, ValueError):
+        return 0
+
+
+def move_files_to_contents(apps, schema_editor):
+    """Give every document a content row, one per distinct file hash.
+
+    Pages and chunks move to the content; those of later duplicates are
+    dropped. Extracted documents are visited first so a content keeps the
+    text of a ready document rather than of a pending or failed one. The
+    files of dropped duplicates stay on disk until delete_orphaned_contents
+    removes them.
+    """
+    Document = apps.get_model("documents", "Document")
+    DocumentContent = apps.get_model("documents", "DocumentContent")
+    DocumentPage = apps.get_model("documents", "DocumentPage")
+    DocumentChunk = apps.get_model("documents", "DocumentChunk")
+    documents = Document.objects.order_by("id")
+    ordered = list(documents.filter(status="ready")) + list(
+        documents.exclude(status="ready")
+    )
+    for document in ordered:
+        content, created = DocumentContent.objects.get_or_create(
+            sha256=file_sha256(document),
+            defaults={
+                "file": document.file.name,
+                "size": file_size(document),
+                "page_count": document.page_count,
+                "status": document.status,
+            },
+        )
+        if created:
+            DocumentPage.objects.filter(document=document).update(content=content)
+            DocumentChunk.objects.filter(document=document).update(content=content)
+        else:
+            DocumentPage.objects.filter(document=document).delete()
+            DocumentChunk.objects.filter(document=document).delete()
+        document.content = content
+        document.save(update_fields=["content"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("documents", "0004_documentpage"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="DocumentContent",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("sha256", models.CharField(max_length=64, unique=True)),
+                (
+                    "file",
+                    models.FileField(upload_to=documents.models.content_path),
+                ),
+                ("size", models.PositiveBigIntegerField(default=0)),
+                ("page_count", models.PositiveIntegerField(default=0)),
+                (
+                    "status",
+                    models.CharField(
+                        choices=[
+                            ("pending", "Pending"),
+                            ("ready", "Ready"),
+                            ("failed", "Failed"),
+                        ],
+                        default="pending",
+                        max_length=10,
+                    ),
+                ),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name="document",
+            name="content",
+            field=models.ForeignKey(
+                null=True,
+                on_delete=django.db.models.deletion.PROTECT,
+                related_name="documents",
+                to="documents.documentcontent",
+            ),
+        ),
+        migrations.AddField(
+            model_name="documentpage",
+            name="content",
+            field=models.ForeignKey(
+                null=True,
+                on_delete=django.db.models.deletion.CASCADE,
+                related_name="pages",
+                to="documents.documentcontent",
+            ),
+        ),
+        migrations.AddField(
+            model_name="documentchunk",
+            name="content",
+            field=models.ForeignKey(
+                null=True,
+                on_delete=django.db.models.deletion.CASCADE,
+                related_name="chunks",
+                to="documents.documentcontent",
+            ),
+        ),
+        migrations.RunPython(move_files_to_contents, migrations.RunPython.noop),
+        migrations.RemoveConstraint(
+            model_name="documentpage",
+            name="unique_document_page",
+        ),
+        migrations.RemoveConstraint(
+            model_name="documentchunk",
+            name="unique_document_chunk",
+        ),
+        migrations.AlterModelOptions(
+            name="documentpage",
+            options={"ordering": ["content", "number"]},
+        ),
+        migrations.AlterModelOptions(
+            name="documentchunk",
+            options={"ordering": ["content", "index"]},
+        ),
+        migrations.RemoveField(
+            model_name="documentpage",
+            name="document",
+        ),
+        migrations.RemoveField(
+            model_name="documentchunk",
+            name="document",
+        ),
+        migrations.RemoveField(
+            model_name="document",
+            name="file",
+        ),
+        migrations.RemoveField(
+            model_name="document",
+            name="page_count",
+        ),
+        migrations.AlterField(
+            model_name="document",
+            name="content",
+            field=models.ForeignKey(
+                on_delete=django.db.models.deletion.PROTECT,
+                related_name="documents",
+                to="documents.documentcontent",
+            ),
+        ),
+        migrations.AlterField(
+            model_name="documentpage",
+            name="content",
+            field=models.ForeignKey(
+                on_delete=django.db.models.deletion.CASCADE,
+                related_name="pages",
+                to="documents.documentcontent",
+            ),
+        ),
+        migrations.AlterField(
+            model_name="documentchunk",
+            name="content",
+            field=models.ForeignKey(
+                on_delete=django.db.models.deletion.CASCADE,
+                related_name="chunks",
+                to="documents.documentcontent",
+            ),
+        ),
+        migrations.AddConstraint(
+            model_name="documentpage",
+            constraint=models.UniqueConstraint(
+                fields=("content", "number"), name="unique_content_page"
+            ),
+        ),
+        migrations.AddConstraint(
+            model_name="documentchunk",
+            constraint=models.UniqueConstraint(
+                fields=("content", "index"), name="unique_content_chunk"
+            ),
+        ),
+    ]
@@ -0,0 +1,96 @@
+# Generated by Django 5.1.6 on 2026-10-18 10:05
+
+import documents.compression
+from django.db import migrations, models
+
+BATCH_SIZE = 500
+
+
+def copy_text(apps, source, target):
+    for model_name in ("DocumentPage", "DocumentChunk"):
+        model = apps.get_model("documents", model_name)
+        batch = []
+        for row in model.objects.only("id", source).iterator(chunk_size=BATCH_SIZE):
+            setattr(row, target, getattr(row, source))
+            batch.append(row)
+            if len(batch) >= BATCH_SIZE:
+                model.objects.bulk_update(batch, [target])
+                batch.clear()
+        model.objects.bulk_update(batch, [target])
+
+
+def compress_text(apps, schema_editor):
+    copy_text(apps, "plain_text", "text")
+
+
+def decompress_text(apps, schema_editor):
+    copy_text(apps, "text", "plain_text")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("documents", "0005_documentcontent"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="TextDictionary",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("dict_id", models.PositiveBigIntegerField(unique=True)),
+                ("data", models.BinaryField()),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.RenameField(
+            model_name="documentpage",
+            old_name="text",
+            new_name="plain_text",
+        ),
+        migrations.RenameField(
+            model_name="documentchunk",
+            old_name="text",
+            new_name="plain_text",
+        ),
+        migrations.AddField(
+            model_name="documentpage",
+            name="text",
+            field=documents.compression.CompressedTextField(blank=True, default=b""),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name="documentchunk",
+            name="text",
+            field=documents.compression.CompressedTextField(default=b""),
+            preserve_default=False,
+        ),
+        migrations.RunPython(compress_text, decompress_text),
+        # A default lets the plain columns be added back when reversing
+        migrations.AlterField(
+            model_name="documentpage",
+            name="plain_text",
+            field=models.TextField(blank=True, default=""),
+        ),
+        migrations.AlterField(
+            model_name="documentchunk",
+            name="plain_text",
+            field=models.TextField(default=""),
+        ),
+        migrations.RemoveField(
+            model_name="documentpage",
+            name="plain_text",
+        ),
+        migrations.RemoveField(
+            model_name="documentchunk",
+            name="plain_text",
+        ),
+    ]
@@ -1,12 +1,113 @@
 from django.db import models
 from chat.models import ChatSession
+from .compression import CompressedTextField
 
 class Document(models.Model):
+    STATUS_PENDING = 'pending'
+    STATUS_READY = 'ready'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = [
+        (STATUS_PENDING, 'Pending'),
+        (STATUS_READY, 'Ready'),
+        (STATUS_FAILED, 'Failed'),
+    ]
+
     session = models.ForeignKey(ChatSession, on_delete=models.CASCADE, related_name='documents')
     title = models.CharField(max_length=255)
-    file = models.FileField(upload_to='documents/')
-    content = models.TextField(blank=True)  # Extracted text content
+    # Uploads of the same bytes share one file, extraction and index
+    content = models.ForeignKey('DocumentContent', on_delete=models.PROTECT, related_name='documents')
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=STATUS_PENDING)
     uploaded_at = models.DateTimeField(auto_now_add=True)
-    
+
     def __str__(self):
         return self.title
+
+    def iter_page_texts(self, first_page=1, last_page=None):
+        return self.content.iter_page_texts(first_page, last_page)
+
+    def get_text(self, first_page=1, last_page=None):
+        return self.content.get_text(first_page, last_page)
+
+
+def content_path(instance, filename):
+    return f'documents/{instance.sha256[:2]}/{instance.sha256}.pdf'
+
+
+class DocumentContent(models.Model):
+    """An uploaded PDF stored once per SHA-256, with its pages and chunks"""
+    STATUS_PENDING = Document.STATUS_PENDING
+    STATUS_READY = Document.STATUS_READY
+    STATUS_FAILED = Document.STATUS_FAILED
+
+    sha256 = models.CharField(max_length=64, unique=True)
+    file = models.FileField(upload_to=content_path)
+    size = models.PositiveBigIntegerField(default=0)
+    page_count = models.PositiveIntegerField(default=0)
+    status = models.CharField(max_length=10, choices=Document.STATUS_CHOICES, default=STATUS_PENDING)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return self.sha256[:12]
+
+    def iter_page_texts(self, first_page=1, last_page=None):
+        """Yield extracted page texts in order, fetched lazily from the database"""
+        pages = self.pages.filter(number__gte=first_page)
+        if last_page is not None:
+            pages = pages.filter(number__lte=last_page)
+        return pages.order_by('number').values_list('text', flat=True).iterator(chunk_size=50)
+
+    def get_text(self, first_page=1, last_page=None):
+        """Return the extracted text of a page range"""
+        return ''.join(f'{text}\n\n' for text in self.iter_page_texts(first_page, last_page))
+
+
+class TextDictionary(models.Model):
+    """A zstd dictionary trained on stored text, see train_text_dictionary"""
+    dict_id = models.PositiveBigIntegerField(unique=True)
+    data = models.BinaryField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f'zstd dictionary {self.dict_id}'
+
+
+class DeferredTextManager(models.Manager):
+    """Leaves the compressed text out of queries unless it is asked for"""
+
+    def get_queryset(self):
+        return super().get_queryset().defer('text')
+
+
+class DocumentPage(models.Model):
+    content = models.ForeignKey(DocumentContent, on_delete=models.CASCADE, related_name='pages')
+    number = models.PositiveIntegerField()  # 1-based page number
+    text = CompressedTextField(blank=True)
+
+    objects = DeferredTextManager()
+
+    class Meta:
+        ordering = ['content', 'number']
+        constraints = [
+            models.UniqueConstraint(fields=['content', 'number'], name='unique_content_page'),
+        ]
+
+    def __str__(self):
+        return f'{self.content} p.{self.number}'
+
+
+class DocumentChunk(models.Model):
+    content = models.ForeignKey(DocumentContent, on_delete=models.CASCADE, related_name='chunks')
+    index = models.PositiveIntegerField()
+    text = CompressedTextField()
+    embedding = models.BinaryField()  # Normalized float32 vector
+
+    objects = DeferredTextManager()
+
+    class Meta:
+        ordering = ['content', 'index']
+        constraints = [
+            models.UniqueConstraint(fields=['content', 'index'], name='unique_content_chunk'),
+        ]
+
+    def __str__(self):
+        return f'{self.content} #{self.index}'
@@ -0,0 +1,207 @@
+import asyncio
+import logging
+import multiprocessing
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import IntegrityError, close_old_connections, transaction
+from django.db.models import ProtectedError
+
+from .extraction import count_pages, extract_page_range
+from .models import Document, DocumentContent, DocumentPage
+from .retrieval import index_content, invalidate_session_index
+
+logger = logging.getLogger(__name__)
+
+# Seconds a pipeline thread waits for a notification to be sent
+NOTIFY_TIMEOUT = 10
+
+_pools_lock = threading.Lock()
+_process_pool = None
+_job_pool = None
+
+
+def _get_pools():
+    """Create the extraction pools lazily so management commands never fork"""
+    global _process_pool, _job_pool
+    with _pools_lock:
+        if _process_pool is None:
+            config = settings.DOCUMENT_PIPELINE
+            # Spawn rather than fork: the server process is multi-threaded
+            _process_pool = ProcessPoolExecutor(
+                max_workers=config["MAX_WORKERS"],
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+            _job_pool = ThreadPoolExecutor(
+                max_workers=config["MAX_CONCURRENT_DOCUMENTS"],
+                thread_name_prefix="document-pipeline",
+            )
+        return _process_pool, _job_pool
+
+
+async def _running_loop():
+    return asyncio.get_running_loop()
+
+
+def enqueue_content(content):
+    """Schedule background extraction once the upload is committed"""
+    _, job_pool = _get_pools()
+    # The server's event loop, when called from a view served over ASGI, so
+    # the pipeline can notify the consumers running on it
+    loop = async_to_sync(_running_loop)()
+    transaction.on_commit(lambda: job_pool.submit(process_content, content.id, loop))
+
+
+def extract_pages(content):
+    """Extract a PDF into DocumentPage rows, page ranges split across workers
+
+    Only a bounded window of page ranges is in flight at a time and each
+    range is written with bulk_create as soon as it completes, so memory
+    stays flat regardless of the number of pages.
+    """
+    process_pool, _ = _get_pools()
+    config = settings.DOCUMENT_PIPELINE
+    file_path = content.file.path
+    page_count = count_pages(file_path)
+    pages_per_task = config["PAGES_PER_TASK"]
+
+    ranges = (
+        (start, min(start + pages_per_task, page_count))
+        for start in range(0, page_count, pages_per_task)
+    )
+    in_flight = deque()
+
+    def submit_next():
+        page_range = next(ranges, None)
+        if page_range is not None:
+            future = process_pool.submit(extract_page_range, file_path, *page_range)
+            in_flight.append((page_range[0], future))
+
+    for _ in range(config["MAX_WORKERS"] * 2):
+        submit_next()
+
+    while in_flight:
+        start, future = in_flight.popleft()
+        page_texts = future.result()
+        submit_next()
+        DocumentPage.objects.bulk_create(
+            DocumentPage(content=content, number=start + offset + 1, text=text)
+            for offset, text in enumerate(page_texts)
+        )
+
+    content.page_count = page_count
+    content.save(update_fields=["page_count"])
+    return page_count
+
+
+def process_content(content_id, loop=None):
+    """Extract and index uploaded bytes, then settle the documents using them
+
+    loop is the event loop to send notifications on, see
+    notify_document_status.
+    """
+    close_old_connections()
+    try:
+        content = DocumentContent.objects.get(id=content_id)
+        error = None
+        try:
+            # Leftovers of an earlier attempt that failed halfway
+            content.pages.all().delete()
+            content.chunks.all().delete()
+            extract_pages(content)
+
+            # Chunk and embed the text so prompts only carry relevant excerpts
+            index_content(content, content.iter_page_texts())
+            content.status = DocumentContent.STATUS_READY
+        except Exception as e:
+            logger.exception("Error processing document content %s: %s", content_id, e)
+            content.status = DocumentContent.STATUS_FAILED
+            error = str(e)
+
+        content.save(update_fields=["status"])
+        settle_documents(content, error, loop)
+        # The documents may have been deleted while it was processed
+        delete_orphaned_contents([content.id])
+    except DocumentContent.DoesNotExist:
+        pass
+    finally:
+        close_old_connections()
+
+
+def settle_documents(content, error=None, loop=None):
+    """Give the pending documents of a content its final status and notify
+    their sessions"""
+    for document in content.documents.filter(status=Document.STATUS_PENDING):
+        # Conditional so an upload racing the pipeline is notified only once
+        settled = Document.objects.filter(
+            id=document.id, status=Document.STATUS_PENDING
+        ).update(status=content.status)
+        if settled:
+            document.status = content.status
+            invalidate_session_index(document.session_id)
+            notify_document_status(document, error, loop)
+
+
+def delete_orphaned_contents(content_ids=None, pending=False):
+    """Delete contents no document uses any more, with their pages, chunks
+    and file. Contents still waiting for extraction are kept unless pending
+    is set, the pipeline deletes them once it is done. Returns the number of
+    contents deleted.
+    """
+    contents = DocumentContent.objects.filter(documents__isnull=True)
+    if content_ids is not None:
+        contents = contents.filter(id__in=content_ids)
+    if not pending:
+        contents = contents.exclude(status=DocumentContent.STATUS_PENDING)
+
+    deleted = 0
+    for content in contents.only("id", "file"):
+        try:
+            with transaction.atomic():
+                content.delete()
+        except (ProtectedError, IntegrityError):
+            continue  # Uploaded again in the meantime
+        deleted += 1
+        if content.file.name:
+            # Not before the delete commits, it could still roll back
+            transaction.on_commit(
+                lambda file=content.file: file.storage.delete(file.name)
+            )
+    return deleted
+
+
+def release_content(sender, instance, **kwargs):
+    """post_delete receiver: delete the content of a document once no other
+    document uses it"""
+    transaction.on_commit(lambda: delete_orphaned_contents([instance.content_id]))
+
+
+def notify_document_status(document, error=None, loop=None):
+    """Tell consumers of the document's session that its status changed
+
+    From a thread without an event loop, pass the loop the consumers run on:
+    the in-memory channel layer only wakes a consumer up when a message is
+    sent from its own loop.
+    """
+    group_send = get_channel_layer().group_send
+    group = f"chat_{document.session_id}"
+    message = {
+        "type": "document_status",
+        "document_id": document.id,
+        "title": document.title,
+        "status": document.status,
+        "error": error,
+    }
+    if loop is None or not loop.is_running():
+        async_to_sync(group_send)(group, message)
+        return
+    try:
+        asyncio.run_coroutine_threadsafe(group_send(group, message), loop).result(
+            NOTIFY_TIMEOUT
+        )
+    except Exception as e:
+        logger.warning("Could not notify session %s: %s", document.session_id, e)
@@ -0,0 +1,348 @@
+import asyncio
+import hashlib
+import re
+import threading
+from collections import OrderedDict, defaultdict
+from functools import cached_property
+
+import numpy as np
+from channels.db import database_sync_to_async
+from chat.llm.client import client_kwargs
+from chat.search import get_search_backend
+from django.conf import settings
+from django.utils.module_loading import import_string
+from langchain_ollama import OllamaEmbeddings
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+from .models import Document, DocumentChunk, DocumentContent
+
+EMBED_BATCH_SIZE = 32
+
+
+class OllamaEmbedder:
+    """Embeds text with a local Ollama embedding model"""
+
+    def __init__(self):
+        self.embeddings = OllamaEmbeddings(
+            model=settings.RETRIEVAL_CONFIG["EMBEDDING_MODEL"],
+            base_url=settings.OLLAMA_BASE_URL,
+            client_kwargs=client_kwargs(),
+        )
+
+    def embed_documents(self, texts):
+        return self.embeddings.embed_documents(texts)
+
+    def embed_query(self, text):
+        return self.embeddings.embed_query(text)
+
+
+class HashingEmbedder:
+    """Dependency-free bag-of-words embedder for offline use and testing"""
+
+    def __init__(self, dim=512):
+        self.dim = dim
+
+    def embed_documents(self, texts):
+        return [self.embed_query(text) for text in texts]
+
+    def embed_query(self, text):
+        vector = np.zeros(self.dim, dtype=np.float32)
+        for token in re.findall(r"\w+", text.lower()):
+            digest = hashlib.blake2b(token.encode(), digest_size=8).digest()
+            vector[int.from_bytes(digest, "little") % self.dim] += 1.0
+        return vector
+
+
+_embedder = None
+_embedder_lock = threading.Lock()
+
+
+def get_embedder():
+    """Return the embedder configured in RETRIEVAL_CONFIG['EMBEDDER']"""
+    global _embedder
+    with _embedder_lock:
+        if _embedder is None:
+            _embedder = import_string(settings.RETRIEVAL_CONFIG["EMBEDDER"])()
+        return _embedder
+
+
+def _normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+def split_text(text):
+    splitter = RecursiveCharacterTextSplitter(
+        chunk_size=settings.RETRIEVAL_CONFIG["CHUNK_SIZE"],
+        chunk_overlap=settings.RETRIEVAL_CONFIG["CHUNK_OVERLAP"],
+    )
+    return splitter.split_text(text)
+
+
+def _iter_chunks(page_texts):
+    for page_text in page_texts:
+        for chunk in split_text(page_text):
+            if chunk.strip():
+                yield chunk
+
+
+def index_unindexed_contents():
+    """Chunk and embed the contents extracted before chunking was introduced,
+    which retrieval would otherwise never find; returns how many there were"""
+    unindexed = DocumentContent.objects.filter(
+        status=DocumentContent.STATUS_READY, chunks__isnull=True, page_count__gt=0
+    ).distinct()
+    count = 0
+    for content in unindexed.iterator():
+        index_content(content, content.iter_page_texts())
+        count += 1
+    return count
+
+
+def index_content(content, page_texts):
+    """Split page texts into chunks, embed them and store them in batches"""
+    embedder = get_embedder()
+    count = 0
+    batch = []
+
+    def flush():
+        nonlocal count
+        vectors = _normalize(embedder.embed_documents(batch))
+        chunks = DocumentChunk.objects.bulk_create(
+            DocumentChunk(
+                content=content,
+                index=count + offset,
+                text=chunk,
+                embedding=vector.tobytes(),
+            )
+            for offset, (chunk, vector) in enumerate(zip(batch, vectors))
+        )
+        get_search_backend().index_chunks((chunk.id, chunk.text) for chunk in chunks)
+        count += len(batch)
+        batch.clear()
+
+    # Pages are consumed lazily so peak memory stays bounded by the batch
+    for chunk in _iter_chunks(page_texts):
+        batch.append(chunk)
+        if len(batch) >= EMBED_BATCH_SIZE:
+            flush()
+    if batch:
+        flush()
+
+    for session_id in content.documents.values_list("session_id", flat=True):
+        invalidate_session_index(session_id)
+    return count
+
+
+def _content_titles(documents):
+    """Map content id to title; the same file uploaded twice is searched
+    once, under its first title"""
+    content_titles = {}
+    for content_id, title in documents.order_by("id").values_list(
+        "content_id", "title"
+    ):
+        content_titles.setdefault(content_id, title)
+    return content_titles
+
+
+class SessionIndex:
+    """In-memory matrix of normalized chunk embeddings for one chat session"""
+
+    def __init__(self, titles, texts, matrix):
+        self.titles = titles
+        self.texts = texts
+        self.matrix = matrix
+
+    @classmethod
+    def load(cls, session_id):
+        return cls.from_documents(Document.objects.filter(session_id=session_id))
+
+    @classmethod
+    def from_documents(cls, documents):
+        """Index the chunks of a Document queryset, e.g. a fixed set of ids"""
+        # Documents still in the extraction pipeline are skipped
+        documents = documents.filter(status=Document.STATUS_READY)
+        content_titles = _content_titles(documents)
+        rows = DocumentChunk.objects.filter(content_id__in=list(content_titles))
+        rows = rows.order_by("content_id", "index").values_list(
+            "content_id", "text", "embedding"
+        )
+        titles, texts, vectors = [], [], []
+        for content_id, text, embedding in rows:
+            titles.append(content_titles[content_id])
+            texts.append(text)
+            vectors.append(np.frombuffer(embedding, dtype=np.float32))
+
+        if vectors and len({vector.shape[0] for vector in vectors}) == 1:
+            matrix = np.vstack(vectors)
+        else:
+            # Empty session, or embeddings from different embedders
+            titles, texts = [], []
+            matrix = np.empty((0, 0), dtype=np.float32)
+        return cls(titles, texts, matrix)
+
+    def __len__(self):
+        return len(self.texts)
+
+    @cached_property
+    def fingerprint(self):
+        """Hash of the indexed text, equal for sessions with the same documents"""
+        digest = hashlib.sha256()
+        for text in sorted(self.texts):
+            digest.update(text.encode())
+            digest.update(b"\0")
+        return digest.hexdigest()
+
+    def search(self, query_vector, k):
+        """Return (title, text, score) for the k most similar chunks"""
+        if not len(self):
+            return []
+        query = _normalize(query_vector)
+        if query.shape[0] != self.matrix.shape[1]:
+            return []
+
+        scores = self.matrix @ query
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(self.titles[i], self.texts[i], float(scores[i])) for i in top]
+
+
+_indexes = OrderedDict()  # session id -> SessionIndex, least recently used first
+_indexes_lock = threading.Lock()
+# Bumped by every invalidation, so an index loaded meanwhile is not cached
+_indexes_generation = 0
+
+
+def get_session_index(session_id):
+    key = str(session_id)
+    with _indexes_lock:
+        index = _indexes.get(key)
+        if index is not None:
+            _indexes.move_to_end(key)
+            return index
+        generation = _indexes_generation
+    index = SessionIndex.load(session_id)
+    with _indexes_lock:
+        # The index may already miss a document if the session changed
+        # while it loaded; use it for this question, but load it again next
+        if generation == _indexes_generation:
+            _indexes[key] = index
+            _indexes.move_to_end(key)
+            while len(_indexes) > settings.RETRIEVAL_CONFIG["MAX_SESSION_INDEXES"]:
+                _indexes.popitem(last=False)
+    return index
+
+
+def invalidate_session_index(session_id):
+    global _indexes_generation
+    with _indexes_lock:
+        _indexes.pop(str(session_id), None)
+        _indexes_generation += 1
+
+
+def retrieve(session_id, question, k=None, index=None):
+    """Return the top-k chunks of the session's documents for a question
+
+    Pass a prebuilt SessionIndex to search other documents instead.
+    """
+    return search(session_id, question, k, index)[0]
+
+
+def search(session_id, question, k=None, index=None):
+    """Like retrieve, but return (chunks, question embedding, documents
+    fingerprint); the last two are None when there are no documents"""
+    if index is None:
+        if settings.RETRIEVAL_CONFIG["RETRIEVER"] == "lexical":
+            return lexical_search(session_id, question, k), None, None
+        index = get_session_index(session_id)
+    return _rank(index, question, k)
+
+
+async def aretrieve(session_id, question, k=None, index=None):
+    """Async retrieve"""
+    return (await asearch(session_id, question, k, index))[0]
+
+
+async def asearch(session_id, question, k=None, index=None):
+    """Async search; only the database reads run in the database thread, the
+    embedding request runs in a thread of its own so it doesn't hold up the
+    queries of other connections"""
+    if index is None:
+        if settings.RETRIEVAL_CONFIG["RETRIEVER"] == "lexical":
+            chunks = await database_sync_to_async(lexical_search)(
+                session_id, question, k
+            )
+            return chunks, None, None
+        index = await database_sync_to_async(get_session_index)(session_id)
+    return await asyncio.to_thread(_rank, index, question, k)
+
+
+def _rank(index, question, k):
+    if not len(index):
+        return [], None, None
+    query_vector = get_embedder().embed_query(question)
+    chunks = index.search(query_vector, k or settings.RETRIEVAL_CONFIG["TOP_K"])
+    return chunks, query_vector, index.fingerprint
+
+
+def _chunk_hits(query, content_ids, limit, match_all):
+    """(content id, text, score) of the chunks best matching the query in
+    the full-text index"""
+    hits = get_search_backend().search_chunks(query, content_ids, limit, match_all)
+    rows = DocumentChunk.objects.filter(id__in=[chunk_id for chunk_id, _ in hits])
+    chunks = {
+        chunk_id: (content_id, text)
+        for chunk_id, content_id, text in rows.values_list("id", "content_id", "text")
+    }
+    return [
+        (*chunks[chunk_id], float(score))
+        for chunk_id, score in hits
+        if chunk_id in chunks
+    ]
+
+
+def lexical_search(session_id, question, k=None):
+    """Like retrieve, ranking the session's chunks with the full-text index
+    instead of embeddings, so no embedding request is made"""
+    content_titles = _content_titles(
+        Document.objects.filter(session_id=session_id, status=Document.STATUS_READY)
+    )
+    if not content_titles:
+        return []
+    hits = _chunk_hits(
+        question,
+        list(content_titles),
+        k or settings.RETRIEVAL_CONFIG["TOP_K"],
+        match_all=False,
+    )
+    return [
+        (content_titles[content_id], text, score) for content_id, text, score in hits
+    ]
+
+
+def search_documents(query, session_id, limit=20):
+    """Chunks containing every word of the query, best first, each with the
+    session's ready documents it belongs to. A session_id of None searches
+    the documents of every session."""
+    documents = Document.objects.filter(status=Document.STATUS_READY)
+    content_ids = None
+    if session_id is not None:
+        documents = documents.filter(session_id=session_id)
+        content_ids = list(documents.values_list("content_id", flat=True).distinct())
+    hits = _chunk_hits(query, content_ids, limit, match_all=True)
+
+    by_content = defaultdict(list)
+    rows = documents.filter(content_id__in={content_id for content_id, _, _ in hits})
+    rows = rows.order_by("id").values_list("id", "title", "session_id", "content_id")
+    for document_id, title, session_id, content_id in rows:
+        by_content[content_id].append(
+            {"id": document_id, "title": title, "session": session_id}
+        )
+    return [
+        {"text": text, "score": score, "documents": by_content[content_id]}
+        for content_id, text, score in hits
+        if by_content[content_id]
+    ]
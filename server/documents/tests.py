@@ -1,3 +1,406 @@
-from django.test import TestCase
+import hashlib
+import io
+import os
+import shutil
+import tempfile
+import threading
+from unittest import mock
 
-# Create your tests here.
+import zstandard
+from asgiref.sync import async_to_sync
+from channels.testing import WebsocketCommunicator
+from chat.benchmark.load import make_pdf
+from chat.consumers import ChatConsumer
+from chat.models import ChatSession
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import connection
+from django.test import (
+    AsyncClient,
+    SimpleTestCase,
+    TestCase,
+    TransactionTestCase,
+    override_settings,
+)
+
+from . import retrieval
+from .compression import reset_dictionaries
+from .extraction import count_pages, extract_page_range
+from .models import (
+    Document,
+    DocumentChunk,
+    DocumentContent,
+    DocumentPage,
+    TextDictionary,
+)
+from .pipeline import delete_orphaned_contents, extract_pages
+from .retrieval import (
+    HashingEmbedder,
+    SessionIndex,
+    asearch,
+    get_session_index,
+    index_content,
+    invalidate_session_index,
+    search,
+)
+
+
+def make_content(pages, status=DocumentContent.STATUS_READY):
+    """A stored content with the given page texts, as left by extraction"""
+    data = "\0".join(pages).encode()
+    content = DocumentContent.objects.create(
+        sha256=hashlib.sha256(data).hexdigest(),
+        file="documents/test.pdf",
+        size=len(data),
+        page_count=len(pages),
+        status=status,
+    )
+    DocumentPage.objects.bulk_create(
+        DocumentPage(content=content, number=number, text=text)
+        for number, text in enumerate(pages, 1)
+    )
+    return content
+
+
+def report_pages(count):
+    return [f"Page {number} of the report" for number in range(1, count + 1)]
+
+
+class MediaRootMixin:
+    """Stores uploads in a temporary MEDIA_ROOT"""
+
+    def setUp(self):
+        super().setUp()
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        media = override_settings(MEDIA_ROOT=media_root)
+        media.enable()
+        self.addCleanup(media.disable)
+
+
+class ExtractionTests(SimpleTestCase):
+    def setUp(self):
+        with tempfile.NamedTemporaryFile(suffix=".pdf", delete=False) as pdf_file:
+            pdf_file.write(make_pdf(report_pages(3)))
+        self.addCleanup(os.remove, pdf_file.name)
+        self.path = pdf_file.name
+
+    def test_count_pages(self):
+        self.assertEqual(count_pages(self.path), 3)
+
+    def test_extract_page_range(self):
+        self.assertEqual(
+            extract_page_range(self.path, 1, 3),
+            ["Page 2 of the report", "Page 3 of the report"],
+        )
+        self.assertEqual(extract_page_range(self.path, 3, 3), [])
+
+
+class PageTextTests(MediaRootMixin, TestCase):
+    @override_settings(
+        DOCUMENT_PIPELINE={**settings.DOCUMENT_PIPELINE, "PAGES_PER_TASK": 2}
+    )
+    def test_pages_are_stored_in_order_across_ranges(self):
+        content = DocumentContent.objects.create(sha256="0" * 64)
+        content.file.save("report.pdf", ContentFile(make_pdf(report_pages(5))))
+
+        self.assertEqual(extract_pages(content), 5)
+        self.assertEqual(content.page_count, 5)
+        self.assertEqual(list(content.iter_page_texts()), report_pages(5))
+
+    def test_page_ranges(self):
+        content = make_content(report_pages(4))
+        self.assertEqual(
+            list(content.iter_page_texts(2, 3)),
+            ["Page 2 of the report", "Page 3 of the report"],
+        )
+        self.assertEqual(list(content.iter_page_texts(4)), ["Page 4 of the report"])
+        self.assertEqual(list(content.iter_page_texts(5)), [])
+        self.assertEqual(
+            content.get_text(3), "Page 3 of the report\n\nPage 4 of the report\n\n"
+        )
+
+    def test_document_reads_its_content(self):
+        content = make_content(report_pages(2))
+        document = Document.objects.create(
+            session=ChatSession.objects.create(), title="report.pdf", content=content
+        )
+        self.assertEqual(document.get_text(), content.get_text())
+        self.assertEqual(list(document.iter_page_texts(2)), ["Page 2 of the report"])
+
+
+class ContentStoreTests(MediaRootMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch("documents.views.enqueue_content")
+        self.enqueue_content = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.pdf = make_pdf(report_pages(2))
+
+    def upload(self, session=None, pdf=None):
+        response = self.client.post(
+            "/api/upload/",
+            {
+                "file": SimpleUploadedFile("report.pdf", pdf or self.pdf),
+                "session_id": str(session or ChatSession.objects.create().id),
+            },
+        )
+        self.assertEqual(response.status_code, 202)
+        return Document.objects.get(id=response.json()["document_id"])
+
+    def test_same_bytes_are_stored_once(self):
+        first, second = self.upload(), self.upload()
+        self.assertEqual(first.content_id, second.content_id)
+        self.assertEqual(first.content.sha256, hashlib.sha256(self.pdf).hexdigest())
+        self.assertEqual(DocumentContent.objects.count(), 1)
+        self.enqueue_content.assert_called_once()
+
+        third = self.upload(pdf=make_pdf(report_pages(3)))
+        self.assertNotEqual(third.content_id, first.content_id)
+        self.assertEqual(self.enqueue_content.call_count, 2)
+
+    def test_extracted_content_is_ready_right_away(self):
+        content = self.upload().content
+        content.status = DocumentContent.STATUS_READY
+        content.save()
+        self.assertEqual(self.upload().status, Document.STATUS_READY)
+        self.enqueue_content.assert_called_once()
+
+    def test_failed_content_is_retried(self):
+        content = self.upload().content
+        content.status = DocumentContent.STATUS_FAILED
+        content.save()
+        self.assertEqual(self.upload().status, Document.STATUS_PENDING)
+        content.refresh_from_db()
+        self.assertEqual(content.status, DocumentContent.STATUS_PENDING)
+        self.assertEqual(self.enqueue_content.call_count, 2)
+
+    def test_content_is_deleted_with_its_last_document(self):
+        first, second = self.upload(), self.upload()
+        content = first.content
+        content.status = DocumentContent.STATUS_READY
+        content.save()
+        storage = content.file.storage
+
+        with self.captureOnCommitCallbacks(execute=True):
+            first.delete()
+        self.assertTrue(DocumentContent.objects.filter(id=content.id).exists())
+        self.assertTrue(storage.exists(content.file.name))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            second.delete()
+        self.assertFalse(DocumentContent.objects.filter(id=content.id).exists())
+        self.assertFalse(storage.exists(content.file.name))
+
+    def test_pending_orphans_are_kept_unless_asked(self):
+        ready = make_content(["Revenue grew 12% in Q3."])
+        pending = make_content(
+            ["Headcount stayed flat."], status=DocumentContent.STATUS_PENDING
+        )
+        used = self.upload().content
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(delete_orphaned_contents(), 1)
+        self.assertFalse(DocumentContent.objects.filter(id=ready.id).exists())
+        self.assertEqual(delete_orphaned_contents([used.id], pending=True), 0)
+        self.assertEqual(delete_orphaned_contents(pending=True), 1)
+        self.assertEqual(
+            list(DocumentContent.objects.values_list("id", flat=True)), [used.id]
+        )
+        self.assertFalse(DocumentPage.objects.filter(content=pending).exists())
+
+    def test_command_dry_run_deletes_nothing(self):
+        orphan = make_content(["Revenue grew 12% in Q3."])
+        output = io.StringIO()
+        call_command("delete_orphaned_contents", "--dry-run", stdout=output)
+        self.assertIn(f"Unused content {orphan.sha256}", output.getvalue())
+        self.assertTrue(DocumentContent.objects.filter(id=orphan.id).exists())
+
+
+class CompressedTextTests(TestCase):
+    def setUp(self):
+        reset_dictionaries()
+        self.addCleanup(reset_dictionaries)
+
+    def stored_frame(self, page):
+        """The bytes the page text is stored as"""
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"SELECT text FROM {DocumentPage._meta.db_table} WHERE id = %s",
+                [page.id],
+            )
+            return bytes(cursor.fetchone()[0])
+
+    def page_texts(self, count):
+        return [
+            f"Quarterly report, section {number}: revenue grew {number % 17} "
+            f"percent while operating costs fell {number % 5} percent in "
+            f"region {number % 9}, and headcount stayed at {100 + number}."
+            for number in range(count)
+        ]
+
+    def test_round_trip_without_dictionary(self):
+        content = make_content(["Revenue grew 12% — in Q3 📈", ""])
+        pages = list(DocumentPage.objects.filter(content=content).order_by("number"))
+        frame = self.stored_frame(pages[0])
+        self.assertEqual(zstandard.get_frame_parameters(frame).dict_id, 0)
+        self.assertEqual(
+            [page.text for page in content.pages.order_by("number")],
+            ["Revenue grew 12% — in Q3 📈", ""],
+        )
+        # Deferred by default, loaded and decompressed on access
+        self.assertEqual(DocumentPage.objects.get(id=pages[0].id).text, pages[0].text)
+
+    def test_round_trip_with_dictionary(self):
+        content = make_content(self.page_texts(400))
+        call_command(
+            "train_text_dictionary",
+            "--size",
+            "4096",
+            "--recompress",
+            stdout=io.StringIO(),
+        )
+        dict_id = TextDictionary.objects.get().dict_id
+
+        # Existing rows were rewritten with it, new ones use it too
+        page = content.pages.get(number=1)
+        self.assertEqual(
+            zstandard.get_frame_parameters(self.stored_frame(page)).dict_id, dict_id
+        )
+        new_page = DocumentPage.objects.create(
+            content=content, number=401, text="Revenue grew 12% in Q3."
+        )
+        self.assertEqual(
+            zstandard.get_frame_parameters(self.stored_frame(new_page)).dict_id,
+            dict_id,
+        )
+        self.assertEqual(list(content.iter_page_texts(1, 2)), self.page_texts(400)[:2])
+
+        # A process without it loads the dictionary a row names to read it
+        reset_dictionaries()
+        with self.settings(
+            DOCUMENT_STORAGE={**settings.DOCUMENT_STORAGE, "USE_DICTIONARY": False}
+        ):
+            self.assertEqual(content.get_text(401), "Revenue grew 12% in Q3.\n\n")
+            chunk = DocumentChunk.objects.create(
+                content=content, index=0, text="Headcount stayed flat.", embedding=b""
+            )
+        self.assertEqual(
+            DocumentChunk.objects.get(id=chunk.id).text, "Headcount stayed flat."
+        )
+
+
+class EmbedderMixin:
+    """Embeds with HashingEmbedder instead of Ollama"""
+
+    def setUp(self):
+        super().setUp()
+        self.embedder = HashingEmbedder()
+        patcher = mock.patch.object(retrieval, "_embedder", self.embedder)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.session = ChatSession.objects.create()
+        self.addCleanup(invalidate_session_index, self.session.id)
+
+    def add_document(self, pages, title="report.pdf", index=True):
+        content = make_content(pages)
+        if index:
+            index_content(content, content.iter_page_texts())
+        return Document.objects.create(
+            session=self.session,
+            title=title,
+            content=content,
+            status=Document.STATUS_READY,
+        )
+
+
+class SessionIndexTests(EmbedderMixin, TestCase):
+    def test_search_ranks_the_session_chunks(self):
+        self.add_document(["Revenue grew 12% in Q3.", "Headcount stayed flat."])
+        chunks, vector, fingerprint = search(self.session.id, "revenue growth Q3")
+        self.assertEqual(chunks[0][:2], ("report.pdf", "Revenue grew 12% in Q3."))
+        self.assertIsNotNone(vector)
+        self.assertIsNotNone(fingerprint)
+
+    def test_invalidation_while_loading_is_not_cached(self):
+        self.add_document(["Revenue grew 12% in Q3."])
+        load = SessionIndex.load
+
+        def load_and_invalidate(session_id):
+            index = load(session_id)
+            # E.g. a document became ready on another thread meanwhile
+            invalidate_session_index(session_id)
+            return index
+
+        with mock.patch.object(SessionIndex, "load", side_effect=load_and_invalidate):
+            stale = get_session_index(self.session.id)
+        self.assertIsNot(get_session_index(self.session.id), stale)
+        self.assertIs(
+            get_session_index(self.session.id), get_session_index(self.session.id)
+        )
+
+    def test_unindexed_content_is_indexed_by_command_only(self):
+        self.add_document(["Revenue grew 12% in Q3."], index=False)
+        self.assertEqual(search(self.session.id, "revenue")[0], [])
+
+        call_command("index_documents", stdout=mock.MagicMock())
+        invalidate_session_index(self.session.id)
+        self.assertEqual(len(search(self.session.id, "revenue")[0]), 1)
+
+
+class AsyncSearchTests(EmbedderMixin, TransactionTestCase):
+    def test_embedding_runs_outside_the_database_thread(self):
+        self.add_document(["Revenue grew 12% in Q3."])
+        threads = {}
+        load, embed_query = SessionIndex.load, self.embedder.embed_query
+
+        def record(name, function):
+            def wrapper(*args):
+                threads[name] = threading.current_thread()
+                return function(*args)
+
+            return wrapper
+
+        with mock.patch.object(
+            SessionIndex, "load", side_effect=record("load", load)
+        ), mock.patch.object(
+            self.embedder, "embed_query", side_effect=record("embed", embed_query)
+        ):
+            chunks, _, _ = async_to_sync(asearch)(self.session.id, "revenue")
+        self.assertEqual(len(chunks), 1)
+        self.assertIsNot(threads["embed"], threads["load"])
+
+
+class UploadNotificationTests(MediaRootMixin, EmbedderMixin, TransactionTestCase):
+    def test_ready_frame_follows_extraction(self):
+        pdf = make_pdf(["Revenue grew 12% in Q3.", "Headcount stayed flat."])
+
+        async def scenario():
+            communicator = WebsocketCommunicator(
+                ChatConsumer.as_asgi(), f"/ws/chat/?session_id={self.session.id}"
+            )
+            await communicator.connect()
+            response = await AsyncClient().post(
+                "/api/upload/",
+                {
+                    "file": SimpleUploadedFile("report.pdf", pdf),
+                    "session_id": str(self.session.id),
+                },
+            )
+            frames = [await communicator.receive_json_from(timeout=1)]
+            # Time for extraction to start its worker processes
+            frames.append(await communicator.receive_json_from(timeout=5))
+            await communicator.disconnect()
+            return response, frames
+
+        response, frames = async_to_sync(scenario)()
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(
+            [(frame["type"], frame["status"]) for frame in frames],
+            [("document", "pending"), ("document", "ready")],
+        )
+        document = Document.objects.get(id=frames[1]["document_id"])
+        self.assertEqual(document.status, Document.STATUS_READY)
+        self.assertEqual(document.content.page_count, 2)
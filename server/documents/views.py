@@ -1,16 +1,23 @@
-import PyPDF2
 from chat.models import ChatSession
 from rest_framework import status
 from rest_framework.parsers import FormParser, MultiPartParser
 from rest_framework.response import Response
 from rest_framework.views import APIView
 
-from .models import Document
+from .models import Document, DocumentContent
+from .pipeline import enqueue_content, notify_document_status, settle_documents
+from .uploads import ContentHashUploadHandler
 
 
 class DocumentUploadView(APIView):
     parser_classes = (MultiPartParser, FormParser)
 
+    def initialize_request(self, request, *args, **kwargs):
+        # Hash uploads as they stream in, before anything parses the body
+        self.content_hasher = ContentHashUploadHandler(request)
+        request.upload_handlers.insert(0, self.content_hasher)
+        return super().initialize_request(request, *args, **kwargs)
+
     def post(self, request, *args, **kwargs):
         # Validate file
         file_obj = request.FILES.get("file")
@@ -30,22 +37,39 @@ class DocumentUploadView(APIView):
         session = ChatSession.objects.get_or_create(id=session_id)[0]
 
         try:
+            # Bytes already uploaded, to any session, are not stored again
+            content, created = DocumentContent.objects.get_or_create(
+                sha256=self.content_hasher.digests["file"],
+                defaults={"file": file_obj, "size": file_obj.size},
+            )
             document = Document.objects.create(
-                session=session, title=file_obj.name, file=file_obj
+                session=session, title=file_obj.name, content=content
             )
 
-            # Extract text content
-            text_content = self._extract_pdf_text(document.file.path)
-            document.content = text_content
-            document.save()
+            # Extraction and indexing run in the background pipeline, once
+            # per content; a failed earlier attempt is retried
+            retry = DocumentContent.objects.filter(
+                id=content.id, status=DocumentContent.STATUS_FAILED
+            ).update(status=DocumentContent.STATUS_PENDING)
+            if created or retry:
+                enqueue_content(content)
+            notify_document_status(document)
+
+            # Content extracted for an earlier upload makes this one ready
+            # right away
+            content.refresh_from_db(fields=["status"])
+            if content.status == DocumentContent.STATUS_READY:
+                settle_documents(content)
+                document.refresh_from_db(fields=["status"])
 
             return Response(
                 {
-                    "message": "Document uploaded successfully",
+                    "message": "Document uploaded, processing started",
                     "document_id": document.id,
                     "title": document.title,
+                    "status": document.status,
                 },
-                status=status.HTTP_201_CREATED,
+                status=status.HTTP_202_ACCEPTED,
             )
 
         except Exception as e:
@@ -53,11 +77,3 @@ class DocumentUploadView(APIView):
                 {"error": f"Error processing PDF: {str(e)}"},
                 status=status.HTTP_500_INTERNAL_SERVER_ERROR,
             )
-
-    def _extract_pdf_text(self, file_path):
-        text_content = ""
-        with open(file_path, "rb") as pdf_file:
-            reader = PyPDF2.PdfReader(pdf_file)
-            for page in reader.pages:
-                text_content += page.extract_text() + "\n\n"
-        return text_content